@@ -1,193 +1,75 @@
 #!/usr/bin/env python3
+import argparse
 import sqlite3
-import matplotlib.pyplot as plt
-import pandas as pd
 from datetime import datetime
-import numpy as np
 import calendar
+from urllib.parse import quote
+from basket import DEFAULT_BASKET, get_basket_items
+from price_matrix import PriceMatrix
 
-def calculate_inflation_metrics(db_path='heb_products.db'):
+def read_basket_items(db_path, basket_name):
     """
-    Calculate various inflation metrics from the price history database
-    """
-    conn = sqlite3.connect(db_path)
-    
-    # 1. Calculate overall average price change since tracking began
-    overall_query = """
-    WITH first_last_prices AS (
-        SELECT 
-            p.product_id,
-            p.product_name,
-            p.category_name,
-            first_price.price AS first_price,
-            first_price.recorded_at AS first_date,
-            last_price.price AS last_price,
-            last_price.recorded_at AS last_date
-        FROM products p
-        JOIN (
-            SELECT product_id, price, recorded_at
-            FROM price_history ph1
-            WHERE recorded_at = (
-                SELECT MIN(recorded_at) FROM price_history ph2 
-                WHERE ph2.product_id = ph1.product_id
-            )
-        ) AS first_price ON p.product_id = first_price.product_id
-        JOIN (
-            SELECT product_id, price, recorded_at
-            FROM price_history ph1
-            WHERE recorded_at = (
-                SELECT MAX(recorded_at) FROM price_history ph2 
-                WHERE ph2.product_id = ph1.product_id
-            )
-        ) AS last_price ON p.product_id = last_price.product_id
-        WHERE first_price.recorded_at != last_price.recorded_at
-    )
-    SELECT 
-        COUNT(*) as total_products,
-        AVG((last_price - first_price) / first_price * 100) as avg_percent_change,
-        MIN(first_date) as earliest_date,
-        MAX(last_date) as latest_date,
-        SUM(CASE WHEN last_price > first_price THEN 1 ELSE 0 END) as num_increased,
-        SUM(CASE WHEN last_price < first_price THEN 1 ELSE 0 END) as num_decreased,
-        SUM(CASE WHEN last_price = first_price THEN 1 ELSE 0 END) as num_unchanged
-    FROM first_last_prices
+    {product_id: quantity} of a basket, read over a read-only connection.
+    A missing database or missing basket tables mean no basket; nothing
+    is created.
     """
-    
-    overall_df = pd.read_sql_query(overall_query, conn)
-    
-    # 2. Calculate monthly average prices (create a price index)
-    monthly_query = """
-    WITH monthly_avg AS (
-        SELECT 
-            strftime('%Y-%m', recorded_at) as year_month,
-            product_id,
-            AVG(price) as avg_price
-        FROM price_history
-        GROUP BY year_month, product_id
-    ),
-    baseline AS (
-        SELECT 
-            product_id,
-            avg_price as baseline_price
-        FROM monthly_avg
-        WHERE year_month = (SELECT MIN(year_month) FROM monthly_avg)
-    )
-    SELECT 
-        m.year_month,
-        COUNT(m.product_id) as num_products,
-        AVG(m.avg_price / b.baseline_price * 100) - 100 as avg_inflation_from_baseline,
-        AVG(m.avg_price) as avg_product_price
-    FROM monthly_avg m
-    JOIN baseline b ON m.product_id = b.product_id
-    GROUP BY m.year_month
-    ORDER BY m.year_month
-    """
-    
-    monthly_df = pd.read_sql_query(monthly_query, conn)
-    
-    # 3. Calculate inflation by category
-    category_query = """
-    WITH first_last_prices AS (
-        SELECT 
-            p.product_id,
-            p.product_name,
-            p.category_name,
-            first_price.price AS first_price,
-            first_price.recorded_at AS first_date,
-            last_price.price AS last_price,
-            last_price.recorded_at AS last_date
-        FROM products p
-        JOIN (
-            SELECT product_id, price, recorded_at
-            FROM price_history ph1
-            WHERE recorded_at = (
-                SELECT MIN(recorded_at) FROM price_history ph2 
-                WHERE ph2.product_id = ph1.product_id
-            )
-        ) AS first_price ON p.product_id = first_price.product_id
-        JOIN (
-            SELECT product_id, price, recorded_at
-            FROM price_history ph1
-            WHERE recorded_at = (
-                SELECT MAX(recorded_at) FROM price_history ph2 
-                WHERE ph2.product_id = ph1.product_id
-            )
-        ) AS last_price ON p.product_id = last_price.product_id
-        WHERE first_price.recorded_at != last_price.recorded_at
-    )
-    SELECT 
-        category_name,
-        COUNT(*) as num_products,
-        AVG((last_price - first_price) / first_price * 100) as avg_percent_change,
-        SUM(CASE WHEN last_price > first_price THEN 1 ELSE 0 END) as num_increased,
-        SUM(CASE WHEN last_price < first_price THEN 1 ELSE 0 END) as num_decreased
-    FROM first_last_prices
-    GROUP BY category_name
-    ORDER BY avg_percent_change DESC
+    try:
+        conn = sqlite3.connect(f"file:{quote(db_path)}?mode=ro", uri=True)
+    except sqlite3.OperationalError:
+        return {}
+    try:
+        return get_basket_items(conn, basket_name)
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        conn.close()
+
+def calculate_inflation_metrics(db_path='heb_products.db', store_id=None, parquet_dir=None,
+                                basket_name=DEFAULT_BASKET, start_month=None, end_month=None):
     """
-    
-    category_df = pd.read_sql_query(category_query, conn)
-    
-    # 4. Create a shopping basket analysis
-    # You could define your own basket of goods here
-    basket_items = [
-        "Milk, 1 Gallon",
-        "Eggs, Large Dozen",
-        "Bread, White Loaf",
-        "Chicken Breast, 1 lb",
-        "Ground Beef, 1 lb",
-        "Apples, 1 lb",
-        "Bananas, 1 lb",
-        "Potato, Russet, 5 lb",
-        "Rice, White, 2 lb",
-        "Pasta, Spaghetti, 1 lb"
-    ]
-    
-    # This is a placeholder, you'd need to map to your actual product IDs
-    # Create a table with your basket items in the database and run this query:
-    basket_query = """
-    WITH monthly_prices AS (
-        SELECT 
-            strftime('%Y-%m', recorded_at) as year_month,
-            p.product_id,
-            p.product_name,
-            AVG(ph.price) as avg_price
-        FROM products p
-        JOIN price_history ph ON p.product_id = ph.product_id
-        WHERE p.product_name LIKE '%Milk%' OR p.product_name LIKE '%Egg%' OR p.product_name LIKE '%Bread%'
-            OR p.product_name LIKE '%Chicken%' OR p.product_name LIKE '%Beef%' OR p.product_name LIKE '%Apple%'
-            OR p.product_name LIKE '%Banana%' OR p.product_name LIKE '%Potato%' OR p.product_name LIKE '%Rice%'
-            OR p.product_name LIKE '%Pasta%'
-        GROUP BY year_month, p.product_id, p.product_name
-    )
-    SELECT 
-        year_month,
-        SUM(avg_price) as basket_cost,
-        COUNT(DISTINCT product_id) as num_products
-    FROM monthly_prices
-    GROUP BY year_month
-    ORDER BY year_month
+    Calculate various inflation metrics from the price history database
+
+    Prices are tracked per (product, store). Pass store_id to restrict every
+    metric to one store; by default all stores are included. The prices are
+    loaded once into a PriceMatrix and every metric is computed from it.
+    With parquet_dir the prices are read from a price_export.py export
+    instead of the database, and only the month partitions between
+    start_month and end_month ('YYYY-MM', inclusive) are read. The basket is the named basket defined with
+    basket.py.
     """
+    if parquet_dir:
+        matrix = PriceMatrix.load_parquet(parquet_dir, store_id=store_id,
+                                          start_month=start_month, end_month=end_month)
+    else:
+        matrix = PriceMatrix.load(db_path, store_id=store_id)
     
-    try:
-        basket_df = pd.read_sql_query(basket_query, conn)
-    except:
-        basket_df = pd.DataFrame(columns=['year_month', 'basket_cost', 'num_products'])
-        print("Couldn't match basket items. Modify the query to match your actual product names.")
-    
-    conn.close()
+    # Shopping basket: the products mapped to the basket with basket.py
+    basket_items = read_basket_items(db_path, basket_name)
+    if not basket_items:
+        print(f"No basket named '{basket_name}'. Define one with basket.py, e.g.")
+        print(f"  python basket.py add {basket_name} \"Milk, 1 Gallon\" --match \"milk gallon\"")
     
     return {
-        'overall': overall_df,
-        'monthly': monthly_df,
-        'category': category_df,
-        'basket': basket_df
+        # Average first-to-last price change, from product_price_summary
+        'overall': matrix.overall_change(),
+        # Fixed-base monthly index over monthly_product_prices
+        'monthly': matrix.monthly_index(),
+        # Chained (geometric) index, robust to products entering and leaving
+        'chained': matrix.chained_index('jevons'),
+        'category': matrix.category_breakdown(),
+        'basket': matrix.basket_cost(basket_items),
+        'store': matrix.store_breakdown()
     }
 
 def create_inflation_visualizations(metrics):
     """
     Create visualizations of the inflation metrics
     """
+    # matplotlib is only loaded when charts are drawn
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
     # Create figure with subplots
     fig = plt.figure(figsize=(15, 12))
     
@@ -255,8 +137,8 @@ def format_inflation_report(metrics):
     Create a text report summarizing the inflation metrics
     """
     overall = metrics['overall'].iloc[0]
-    first_date = pd.to_datetime(overall['earliest_date']).strftime('%B %d, %Y')
-    last_date = pd.to_datetime(overall['latest_date']).strftime('%B %d, %Y')
+    first_date = datetime.strptime(overall['earliest_date'][:10], '%Y-%m-%d').strftime('%B %d, %Y')
+    last_date = datetime.strptime(overall['latest_date'][:10], '%Y-%m-%d').strftime('%B %d, %Y')
     monthly = metrics['monthly']
     category = metrics['category']
     
@@ -275,21 +157,39 @@ def format_inflation_report(metrics):
     
     # Monthly trend
     report.append("\nMONTHLY INFLATION TREND:")
-    for i, row in monthly.iterrows():
-        year_month = row['year_month']
+    for year_month, inflation in zip(monthly['year_month'], monthly['avg_inflation_from_baseline']):
         year, month = year_month.split('-')
         month_name = calendar.month_name[int(month)]
-        inflation = row['avg_inflation_from_baseline']
         report.append(f"- {month_name} {year}: {inflation:.2f}% (from baseline)")
     
+    # Chained index, which keeps comparing like with like as the assortment changes
+    chained = metrics.get('chained')
+    if chained is not None and len(chained) > 1:
+        report.append("\nCHAINED PRICE INDEX (geometric, first month = 100):")
+        for year_month, index, matched in zip(chained['year_month'], chained['index'],
+                                              chained['matched_products']):
+            year, month = year_month.split('-')
+            report.append(f"- {calendar.month_name[int(month)]} {year}: {index:.2f} "
+                          f"({matched} matched products)")
+    
     # Category breakdown
     report.append("\nINFLATION BY CATEGORY:")
-    for i, row in category.iterrows():
-        cat_name = row['category_name']
-        pct_change = row['avg_percent_change']
-        num_products = row['num_products']
+    for cat_name, pct_change, num_products in zip(category['category_name'],
+                                                  category['avg_percent_change'],
+                                                  category['num_products']):
         report.append(f"- {cat_name}: {pct_change:.2f}% across {num_products} products")
     
+    # Store breakdown, only worth showing once more than one store is tracked
+    store = metrics.get('store')
+    if store is not None and len(store) > 1:
+        report.append("\nINFLATION BY STORE:")
+        for store_id, pct_change, num_products, avg_last_price in zip(
+                store['store_id'], store['avg_percent_change'],
+                store['num_products'], store['avg_last_price']):
+            report.append(f"- Store {store_id}: {pct_change:.2f}% "
+                          f"across {num_products} products "
+                          f"(avg price ${avg_last_price:.2f})")
+    
     # Shopping basket
     if not metrics['basket'].empty and len(metrics['basket']) > 1:
         basket = metrics['basket']
@@ -312,14 +212,43 @@ def format_inflation_report(metrics):
     
     return "\n".join(report)
 
+def month_arg(value):
+    """argparse type for a 'YYYY-MM' month"""
+    try:
+        datetime.strptime(value, '%Y-%m')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected YYYY-MM, got '{value}'")
+    return value
+
 def main():
+    parser = argparse.ArgumentParser(description="Grocery price inflation report")
+    parser.add_argument('--db', default='heb_products.db', help="SQLite database path")
+    parser.add_argument('--store', type=int, default=None,
+                        help="only report on this store id (default: all stores)")
+    parser.add_argument('--parquet', metavar='DIR', default=None,
+                        help="read prices from a price_export.py export instead of --db")
+    parser.add_argument('--start-month', type=month_arg, default=None, metavar='YYYY-MM',
+                        help="with --parquet, only read months from this one on")
+    parser.add_argument('--end-month', type=month_arg, default=None, metavar='YYYY-MM',
+                        help="with --parquet, only read months up to this one")
+    parser.add_argument('--basket', default=DEFAULT_BASKET,
+                        help="basket defined with basket.py (default: %(default)s)")
+    parser.add_argument('--no-charts', action='store_true',
+                        help="only write the text report (skips loading matplotlib)")
+    args = parser.parse_args()
+    if (args.start_month or args.end_month) and not args.parquet:
+        parser.error("--start-month/--end-month need --parquet")
+    
     # Calculate metrics
     print("Calculating inflation metrics...")
-    metrics = calculate_inflation_metrics()
+    metrics = calculate_inflation_metrics(args.db, store_id=args.store, parquet_dir=args.parquet,
+                                          basket_name=args.basket, start_month=args.start_month,
+                                          end_month=args.end_month)
     
     # Create visualizations
-    print("Creating visualizations...")
-    create_inflation_visualizations(metrics)
+    if not args.no_charts:
+        print("Creating visualizations...")
+        create_inflation_visualizations(metrics)
     
     # Generate report
     print("Generating report...")
@@ -334,9 +263,10 @@ def main():
     
     print("\nReport and visualizations have been saved to:")
     print("- grocery_inflation_report.txt")
-    print("- grocery_inflation_metrics.png")
-    if not metrics['basket'].empty and len(metrics['basket']) > 1:
-        print("- grocery_basket_cost.png")
+    if not args.no_charts:
+        print("- grocery_inflation_metrics.png")
+        if not metrics['basket'].empty and len(metrics['basket']) > 1:
+            print("- grocery_basket_cost.png")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
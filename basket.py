@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Named shopping baskets mapped to concrete products.
+
+A basket is a list of items, each with a quantity and mapped to one or
+more product_ids. Products mapped to the same item are alternatives: the
+item is priced once, at the mean of its products' prices, so its cost is
+a join on the mapped ids only. Product names are
+indexed with FTS5 (products_fts) to find the ids when building a basket:
+
+    python basket.py search "milk gallon"
+    python basket.py add standard "Milk, 1 Gallon" --match "whole milk gallon"
+    python basket.py add standard "Eggs, Large Dozen" --product 1234567 --quantity 2
+    python basket.py show standard
+    python basket.py cost standard --store 793
+"""
+import argparse
+import sqlite3
+
+DEFAULT_BASKET = 'standard'
+
+def create_basket_tables(conn):
+    """Create the basket tables and the product name full-text index"""
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS baskets (
+            basket_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS basket_items (
+            basket_id INTEGER NOT NULL,
+            item_name TEXT NOT NULL,
+            product_id TEXT NOT NULL,
+            quantity REAL NOT NULL DEFAULT 1,
+            PRIMARY KEY (basket_id, item_name, product_id),
+            FOREIGN KEY (basket_id) REFERENCES baskets (basket_id),
+            FOREIGN KEY (product_id) REFERENCES products (product_id)
+        )
+    ''')
+
+    fts_exists = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'products_fts'").fetchone()
+    if not fts_exists:
+        try:
+            c.execute('''
+                CREATE VIRTUAL TABLE products_fts USING fts5(
+                    product_name, brand_name, category_name,
+                    content='products', content_rowid='id'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            print(f"Full-text search unavailable ({e}); basket search is disabled")
+            conn.commit()
+            return
+        c.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+
+    # Keep the external-content index in step with products
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts (rowid, product_name, brand_name, category_name)
+            VALUES (new.id, new.product_name, new.brand_name, new.category_name);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, product_name, brand_name, category_name)
+            VALUES ('delete', old.id, old.product_name, old.brand_name, old.category_name);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, product_name, brand_name, category_name)
+            VALUES ('delete', old.id, old.product_name, old.brand_name, old.category_name);
+            INSERT INTO products_fts (rowid, product_name, brand_name, category_name)
+            VALUES (new.id, new.product_name, new.brand_name, new.category_name);
+        END
+    ''')
+    conn.commit()
+
+def fts_query(query):
+    """
+    Plain words as an FTS5 query: each term double-quoted (embedded quotes
+    doubled) so punctuation such as "H-E-B", "2%" or "milk," is matched as
+    text instead of parsed as query syntax. Terms without letters or
+    digits are dropped.
+    """
+    terms = [term for term in query.split() if any(ch.isalnum() for ch in term)]
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+def search_products(conn, query, limit=10):
+    """Best full-text matches for query: (product_id, product_name, brand_name, category_name)"""
+    match = fts_query(query)
+    if not match:
+        return []
+    return conn.execute('''
+        SELECT p.product_id, p.product_name, p.brand_name, p.category_name
+        FROM products_fts f
+        JOIN products p ON p.id = f.rowid
+        WHERE products_fts MATCH ?
+        ORDER BY bm25(products_fts)
+        LIMIT ?
+    ''', (match, limit)).fetchall()
+
+def get_basket_id(conn, name, create=False):
+    row = conn.execute('SELECT basket_id FROM baskets WHERE name = ?', (name,)).fetchone()
+    if row:
+        return row[0]
+    if not create:
+        return None
+    with conn:
+        return conn.execute('INSERT INTO baskets (name) VALUES (?)', (name,)).lastrowid
+
+def add_basket_item(conn, basket_name, item_name, product_ids, quantity=1.0):
+    """
+    Map item_name in basket_name to product_ids, creating the basket if
+    needed. The quantity applies to the whole item.
+    """
+    basket_id = get_basket_id(conn, basket_name, create=True)
+    with conn:
+        conn.executemany('''
+            INSERT INTO basket_items (basket_id, item_name, product_id, quantity)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(basket_id, item_name, product_id) DO UPDATE SET quantity = excluded.quantity
+        ''', [(basket_id, item_name, product_id, quantity) for product_id in product_ids])
+        conn.execute('UPDATE basket_items SET quantity = ? WHERE basket_id = ? AND item_name = ?',
+                     (quantity, basket_id, item_name))
+    return basket_id
+
+def remove_basket_item(conn, basket_name, item_name):
+    basket_id = get_basket_id(conn, basket_name)
+    if basket_id is None:
+        return 0
+    with conn:
+        return conn.execute('DELETE FROM basket_items WHERE basket_id = ? AND item_name = ?',
+                            (basket_id, item_name)).rowcount
+
+def get_basket_items(conn, basket_name):
+    """
+    {item_name: (quantity, [product_id, ...])} for a basket; empty if it
+    does not exist
+    """
+    items = {}
+    for item_name, product_id, quantity in conn.execute('''
+        SELECT bi.item_name, bi.product_id, bi.quantity
+        FROM basket_items bi
+        JOIN baskets b ON b.basket_id = bi.basket_id
+        WHERE b.name = ?
+        ORDER BY bi.item_name, bi.product_id
+    ''', (basket_name,)):
+        item_quantity, product_ids = items.get(item_name, (quantity, []))
+        items[item_name] = (max(item_quantity, quantity), product_ids + [product_id])
+    return items
+
+def calculate_basket_cost(conn, basket_name, store_id=None):
+    """
+    Monthly cost of a basket: each item's price (the mean of its mapped
+    products' monthly average prices, across stores unless store_id is
+    given) times its quantity.
+    """
+    import pandas as pd
+    return pd.read_sql_query('''
+        WITH product_prices AS (
+            SELECT
+                m.year_month,
+                bi.item_name,
+                bi.product_id,
+                SUM(m.price_sum) * 1.0 / SUM(m.observations) AS avg_price
+            FROM baskets b
+            JOIN basket_items bi ON bi.basket_id = b.basket_id
+            JOIN monthly_product_prices m ON m.product_id = bi.product_id
+            WHERE b.name = :basket
+              AND (:store_id IS NULL OR m.store_id = :store_id)
+            GROUP BY m.year_month, bi.item_name, bi.product_id
+        ),
+        items AS (
+            SELECT bi.item_name, MAX(bi.quantity) AS quantity
+            FROM baskets b
+            JOIN basket_items bi ON bi.basket_id = b.basket_id
+            WHERE b.name = :basket
+            GROUP BY bi.item_name
+        ),
+        item_prices AS (
+            SELECT p.year_month, p.item_name, AVG(p.avg_price) * i.quantity AS item_cost
+            FROM product_prices p
+            JOIN items i ON i.item_name = p.item_name
+            GROUP BY p.year_month, p.item_name
+        )
+        SELECT
+            year_month,
+            SUM(item_cost) AS basket_cost,
+            COUNT(*) AS num_items
+        FROM item_prices
+        GROUP BY year_month
+        ORDER BY year_month
+    ''', conn, params={'basket': basket_name, 'store_id': store_id})
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage shopping baskets")
+    parser.add_argument('--db', default='heb_products.db', help="SQLite database path")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('search', help="full-text search of product names")
+    p.add_argument('query')
+    p.add_argument('--limit', type=int, default=10)
+
+    p = sub.add_parser('add', help="map a basket item to products")
+    p.add_argument('basket')
+    p.add_argument('item')
+    p.add_argument('--product', action='append', default=[], help="product_id (repeatable)")
+    p.add_argument('--match', help="use the best full-text match for this query")
+    p.add_argument('--quantity', type=float, default=1.0)
+
+    p = sub.add_parser('remove', help="remove an item from a basket")
+    p.add_argument('basket')
+    p.add_argument('item')
+
+    p = sub.add_parser('show', help="list baskets, or the items of one basket")
+    p.add_argument('basket', nargs='?')
+
+    p = sub.add_parser('cost', help="monthly cost of a basket")
+    p.add_argument('basket')
+    p.add_argument('--store', type=int, default=None)
+
+    args = parser.parse_args()
+    conn = sqlite3.connect(args.db)
+    create_basket_tables(conn)
+
+    if args.command == 'search':
+        try:
+            matches = search_products(conn, args.query, args.limit)
+        except sqlite3.OperationalError as e:
+            print(f"Search failed: {e}")
+            return
+        for product_id, name, brand, category in matches:
+            print(f"{product_id}\t{name}\t{brand or ''}\t{category}")
+
+    elif args.command == 'add':
+        product_ids = list(args.product)
+        if args.match:
+            try:
+                matches = search_products(conn, args.match, 1)
+            except sqlite3.OperationalError as e:
+                print(f"Search failed: {e}")
+                return
+            if not matches:
+                print(f"No product matches '{args.match}'")
+                return
+            print(f"Matched '{args.match}' to {matches[0][0]} ({matches[0][1]})")
+            product_ids.append(matches[0][0])
+        if not product_ids:
+            print("Give --product or --match")
+            return
+        add_basket_item(conn, args.basket, args.item, product_ids, args.quantity)
+        print(f"Added {args.item} to {args.basket} ({len(product_ids)} products)")
+
+    elif args.command == 'remove':
+        removed = remove_basket_item(conn, args.basket, args.item)
+        print(f"Removed {removed} mappings")
+
+    elif args.command == 'show':
+        if args.basket is None:
+            for name, items in conn.execute('''
+                SELECT b.name, COUNT(bi.product_id)
+                FROM baskets b LEFT JOIN basket_items bi ON bi.basket_id = b.basket_id
+                GROUP BY b.basket_id ORDER BY b.name
+            '''):
+                print(f"{name}: {items} products")
+        else:
+            for item, product_id, quantity, name in conn.execute('''
+                SELECT bi.item_name, bi.product_id, bi.quantity, p.product_name
+                FROM basket_items bi
+                JOIN baskets b ON b.basket_id = bi.basket_id
+                LEFT JOIN products p ON p.product_id = bi.product_id
+                WHERE b.name = ?
+                ORDER BY bi.item_name
+            ''', (args.basket,)):
+                print(f"{item}: {quantity:g} x {product_id} ({name})")
+
+    elif args.command == 'cost':
+        cost = calculate_basket_cost(conn, args.basket, store_id=args.store)
+        if cost.empty:
+            print(f"No prices for basket '{args.basket}'")
+        for year_month, basket_cost, num_items in zip(
+                cost['year_month'], cost['basket_cost'], cost['num_items']):
+            print(f"{year_month}: ${basket_cost:.2f} ({num_items} items)")
+
+    conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Analytics benchmark on synthetic price histories.
+
+`generate` builds a database shaped like heb_products.db with a chosen
+number of products, days of daily crawls and daily price-change rate,
+stored change-only the way scrape2.py stores it. `run` times every report
+and chart query, the PriceMatrix metrics and the full report pipeline,
+captures EXPLAIN QUERY PLAN for the SQL, and appends the result to a JSON
+lines file. `compare` shows how two stored runs differ:
+
+    python bench_analytics.py generate --db bench.db --products 50000 --days 1095 --change-rate 0.01
+    python bench_analytics.py run --db bench.db --label before
+    python bench_analytics.py run --db bench.db --label after
+    python bench_analytics.py compare before after
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+import scrape2
+import HEB_inflation
+import visualize_prices
+from basket import add_basket_item, calculate_basket_cost
+from price_matrix import PriceMatrix, SUMMARY_QUERY, MONTHLY_QUERY
+
+DEFAULT_RESULTS = 'bench_results.jsonl'
+BENCH_BASKET = 'bench'
+CRAWL_TIME = ' 06:00:00'
+
+CATEGORIES = ['Fruit & vegetables', 'Meat & seafood', 'Bakery & bread', 'Dairy & eggs',
+              'Pantry', 'Frozen food', 'Beverages', 'Snacks & candy', 'Deli & prepared food',
+              'Household', 'Health & beauty', 'Baby', 'Pets']
+NAME_WORDS = ['Organic', 'Whole', 'Milk', 'Eggs', 'Bread', 'Chicken', 'Beef', 'Apples',
+              'Bananas', 'Potatoes', 'Rice', 'Pasta', 'Cheese', 'Yogurt', 'Coffee', 'Juice',
+              'Cereal', 'Butter', 'Tortillas', 'Beans', 'Salsa', 'Soap', 'Tissue', 'Water']
+
+def generate_database(db_path, products=10000, days=365, change_rate=0.02, stores=(793,),
+                      start=date(2023, 1, 1), churn=0.2, seed=1, chunk=2000, schema='v1'):
+    """
+    Fill db_path with synthetic change-only price history.
+
+    Every product is crawled once a day; on each day its price changes with
+    probability change_rate. A `churn` fraction of products enters late or
+    leaves early. Intervals are split at month boundaries like scrape2.py's
+    compact mode. With schema='v2' the history is then migrated to the
+    price_history_v2 layout. Returns the number of price_history rows written.
+    """
+    rng = np.random.default_rng(seed)
+    conn = scrape2.create_database(db_path)
+    day_dates = [start + timedelta(days=d) for d in range(days)]
+    day_text = np.array([d.isoformat() for d in day_dates])
+    month_start = np.array([d.day == 1 for d in day_dates])
+
+    with conn:
+        conn.executemany('''
+            INSERT OR IGNORE INTO products
+                (category_id, category_name, product_id, product_name, brand_name, is_own_brand, sku_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(str(i % len(CATEGORIES)), CATEGORIES[i % len(CATEGORIES)], f"bench-{i}",
+               ' '.join(rng.choice(NAME_WORDS, 3)) + f" {i}", f"Brand {i % 50}", i % 7 == 0,
+               f"sku-{i}") for i in range(products)])
+
+    rows_written = 0
+    for store_id in stores:
+        for first in range(0, products, chunk):
+            n = min(chunk, products - first)
+            # Lifetime of each product in the assortment
+            enter = np.where(rng.random(n) < churn / 2, rng.integers(0, days, n), 0)
+            leave = np.where(rng.random(n) < churn / 2, rng.integers(0, days, n), days - 1)
+            leave = np.maximum(leave, enter)
+            day = np.arange(days)
+            alive = (day >= enter[:, None]) & (day <= leave[:, None])
+
+            changes = rng.random((n, days)) < change_rate
+            steps = np.where(changes, 1 + rng.normal(0.01, 0.05, (n, days)), 1.0)
+            base = rng.uniform(0.5, 25.0, n)
+            prices = np.round(base[:, None] * np.cumprod(np.clip(steps, 0.5, 1.5), axis=1), 2)
+
+            breaks = (changes | month_start | (day == enter[:, None])) & alive
+            product_idx, start_day = np.nonzero(breaks)
+            # An interval runs to the day before the next break of the same product
+            next_start = np.append(start_day[1:], 0)
+            same_product = np.append(product_idx[1:] == product_idx[:-1], False)
+            end_day = np.where(same_product, next_start - 1, leave[product_idx])
+
+            store_rows = zip(
+                (f"bench-{first + p}" for p in product_idx.tolist()),
+                prices[product_idx, start_day].tolist(),
+                (t + CRAWL_TIME for t in day_text[start_day]),
+                (t + CRAWL_TIME for t in day_text[end_day]),
+                (end_day - start_day + 1).tolist(),
+            )
+            with conn:
+                conn.executemany('''
+                    INSERT INTO price_history (product_id, price, recorded_at, last_seen, observations, store_id)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', [row + (store_id,) for row in store_rows])
+            rows_written += len(product_idx)
+
+    scrape2.rebuild_price_summary(conn)
+    scrape2.refresh_rollups(conn, full=True)
+    for i in range(0, products, max(1, products // 10)):
+        add_basket_item(conn, BENCH_BASKET, f"Bench item {i}", [f"bench-{i}"])
+    if schema == 'v2':
+        scrape2.migrate_price_history_v2(conn)
+    conn.execute('ANALYZE')
+    conn.close()
+    return rows_written
+
+def timed(func, repeat):
+    """Median wall time of func over `repeat` calls, and the last result"""
+    times = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times), result
+
+def query_plan(conn, sql, params=()):
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+def run_benchmark(db_path, repeat=3, store_id=None):
+    """Time every analytics step on db_path; returns the result record"""
+    db_path = os.path.abspath(db_path)
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    store_params = {'store_id': store_id}
+    timings = {}
+    plans = {}
+
+    def fetch(sql, params):
+        return lambda: conn.execute(sql, params).fetchall()
+
+    # Raw SQL behind the report and the charts
+    movers_params = {'top': 15, 'store_id': store_id}
+    for name, sql, params in [
+        ('summary_query', SUMMARY_QUERY, store_params),
+        ('monthly_query', MONTHLY_QUERY, store_params),
+        ('top_movers_query', visualize_prices.TOP_MOVERS_QUERY, movers_params),
+    ]:
+        timings[name], _ = timed(fetch(sql, params), repeat)
+        plans[name] = query_plan(conn, sql, params)
+
+    increases, decreases = visualize_prices.get_top_movers(cursor, 15, store_id)
+    chart_ids = [row[0] for row in increases[:5] + decreases[:5]]
+    timings['price_histories'], histories = timed(
+        lambda: visualize_prices.get_price_histories(cursor, chart_ids, store_id), repeat)
+    timings['basket_cost'], _ = timed(
+        lambda: calculate_basket_cost(conn, BENCH_BASKET, store_id), repeat)
+
+    # Vectorized metrics on one load
+    timings['matrix_load'], matrix = timed(lambda: PriceMatrix.load(db_path, store_id), repeat)
+    for name, func in [
+        ('overall_change', matrix.overall_change),
+        ('monthly_index', matrix.monthly_index),
+        ('chained_index', matrix.chained_index),
+        ('category_breakdown', matrix.category_breakdown),
+        ('store_breakdown', matrix.store_breakdown),
+        ('top_movers', matrix.top_movers),
+    ]:
+        timings[name], _ = timed(func, repeat)
+
+    # Chart rendering for the charted products
+    timings['ascii_charts'], _ = timed(
+        lambda: [visualize_prices.create_ascii_chart(data, height=40) for _, data in histories.values()],
+        repeat)
+    timings['sparklines'], _ = timed(
+        lambda: [visualize_prices.create_sparkline(data, 60) for _, data in histories.values()],
+        repeat)
+
+    # The whole report as HEB_inflation.py runs it, charts included
+    # (create_inflation_visualizations loads matplotlib with the Agg backend)
+    def report_pipeline():
+        metrics = HEB_inflation.calculate_inflation_metrics(db_path, store_id=store_id,
+                                                           basket_name=BENCH_BASKET)
+        HEB_inflation.create_inflation_visualizations(metrics)
+        return HEB_inflation.format_inflation_report(metrics)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        cwd = os.getcwd()
+        os.chdir(scratch)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                timings['report_pipeline'], _ = timed(report_pipeline, repeat)
+        finally:
+            os.chdir(cwd)
+
+    timings['rollup_refresh_noop'], _ = timed(lambda: scrape2.refresh_rollups(conn), repeat)
+
+    sizes = conn.execute('''
+        SELECT
+            (SELECT COUNT(*) FROM products),
+            (SELECT COUNT(*) FROM price_history),
+            (SELECT COALESCE(SUM(observations), 0) FROM price_history),
+            (SELECT COUNT(*) FROM monthly_product_prices)
+    ''').fetchone()
+    conn.close()
+    return {
+        'db': db_path,
+        'db_mb': os.path.getsize(db_path) / 1e6,
+        'products': sizes[0],
+        'history_rows': sizes[1],
+        'observations': sizes[2],
+        'monthly_rows': sizes[3],
+        'store_id': store_id,
+        'repeat': repeat,
+        'timings': timings,
+        'plans': plans,
+    }
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def find_result(results, label):
+    """Latest result with this label, or by position ('-1' is the latest)"""
+    matches = [r for r in results if r.get('label') == label]
+    if matches:
+        return matches[-1]
+    try:
+        return results[int(label)]
+    except (ValueError, IndexError):
+        return None
+
+def compare_results(old, new, threshold=0.2, min_delta=0.005):
+    """
+    Lines comparing two results. Steps slower by more than `threshold`
+    (a fraction) and by at least `min_delta` seconds are flagged.
+    """
+    lines = [f"{'step':<24}{'old':>12}{'new':>12}{'change':>10}"]
+    for step, new_time in new['timings'].items():
+        old_time = old['timings'].get(step)
+        if old_time is None:
+            lines.append(f"{step:<24}{'-':>12}{new_time * 1000:>10.1f}ms")
+            continue
+        change = (new_time - old_time) / old_time if old_time else 0.0
+        flag = '  REGRESSION' if change > threshold and new_time - old_time >= min_delta else ''
+        lines.append(f"{step:<24}{old_time * 1000:>10.1f}ms{new_time * 1000:>10.1f}ms"
+                     f"{change * 100:>+9.0f}%{flag}")
+    for step, plan in new['plans'].items():
+        if old['plans'].get(step) != plan:
+            lines.append(f"\nQuery plan changed for {step}:")
+            lines.extend(f"  old: {line}" for line in old['plans'].get(step, []))
+            lines.extend(f"  new: {line}" for line in plan)
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the report and chart queries on synthetic data")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('generate', help="build a synthetic database")
+    p.add_argument('--db', default='bench_products.db')
+    p.add_argument('--products', type=int, default=10000)
+    p.add_argument('--days', type=int, default=365, help="days of daily crawls")
+    p.add_argument('--change-rate', type=float, default=0.02,
+                   help="probability a product's price changes on a given day")
+    p.add_argument('--stores', default="793", help="comma-separated store ids")
+    p.add_argument('--churn', type=float, default=0.2,
+                   help="fraction of products entering late or leaving early")
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--schema', choices=['v1', 'v2'], default='v1',
+                   help="price_history layout (v2: scrape2.py --migrate-v2)")
+
+    p = sub.add_parser('run', help="time the analytics on a database and store the result")
+    p.add_argument('--db', default='bench_products.db')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--store', type=int, default=None)
+    p.add_argument('--label', default=None, help="name to compare this run by")
+    p.add_argument('--results', default=DEFAULT_RESULTS)
+    p.add_argument('--show-plans', action='store_true')
+
+    p = sub.add_parser('compare', help="compare two stored runs (labels or indexes, default -2 and -1)")
+    p.add_argument('old', nargs='?', default='-2')
+    p.add_argument('new', nargs='?', default='-1')
+    p.add_argument('--results', default=DEFAULT_RESULTS)
+    p.add_argument('--threshold', type=float, default=0.2,
+                   help="flag steps slower by more than this fraction")
+
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        if os.path.exists(args.db):
+            print(f"{args.db} already exists; pick another --db or remove it")
+            return
+        stores = [int(store_id) for store_id in args.stores.split(',') if store_id.strip()]
+        started = time.perf_counter()
+        rows = generate_database(args.db, args.products, args.days, args.change_rate,
+                                 stores, churn=args.churn, seed=args.seed, schema=args.schema)
+        print(f"Wrote {rows} price intervals for {args.products} products x {len(stores)} store(s) "
+              f"x {args.days} days in {time.perf_counter() - started:.1f}s")
+
+    elif args.command == 'run':
+        result = run_benchmark(args.db, args.repeat, args.store)
+        result['label'] = args.label
+        result['ran_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+        print(f"{result['products']} products, {result['history_rows']} history rows "
+              f"({result['observations']} observations), {result['db_mb']:.0f} MB")
+        for step, seconds in result['timings'].items():
+            print(f"  {step:<24}{seconds * 1000:>10.1f} ms")
+        if args.show_plans:
+            for step, plan in result['plans'].items():
+                print(f"\n{step}:")
+                for line in plan:
+                    print(f"  {line}")
+        print(f"Saved to {args.results}")
+
+    elif args.command == 'compare':
+        results = load_results(args.results)
+        old, new = find_result(results, args.old), find_result(results, args.new)
+        if old is None or new is None:
+            print("Need two stored runs to compare")
+            return
+        print(f"{old.get('label') or old['ran_at']} -> {new.get('label') or new['ran_at']}")
+        print("\n".join(compare_results(old, new, args.threshold)))
+
+if __name__ == "__main__":
+    main()
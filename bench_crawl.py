@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Offline crawl benchmark.
+
+Starts a local stand-in for heb.com's /graphql endpoint and runs the
+scrape2.py crawl path against it into a scratch database, then reports
+throughput, database write time and peak memory. Nothing leaves the
+machine, so every change to the crawler or the write path can be measured:
+
+    python bench_crawl.py --categories 20 --products 500 --workers 4
+    python bench_crawl.py --latency 80 --throttle-rate 0.05 --json
+    python bench_crawl.py --recorded recorded_pages/
+
+The server pages through synthetic browseCategory records (cursor
+pagination, 50 per page like the real API) or replays recorded responses:
+with --recorded DIR, DIR/<categoryId>.json holds the list of response
+bodies for that category in page order.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import resource
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import scrape2
+from crawl_metrics import CrawlMetrics
+
+PAGE_SIZE = 50
+
+class MockGraphQLServer:
+    """Local /graphql endpoint serving synthetic or recorded browseCategory pages"""
+
+    def __init__(self, products_per_category=200, latency=0.0, jitter=0.0,
+                 throttle_rate=0.0, retry_after=0, recorded_dir=None, price_seed=0):
+        self.products_per_category = products_per_category
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.price_seed = price_seed
+        self.recorded = load_recorded_pages(recorded_dir) if recorded_dir else None
+        self.lock = threading.Lock()
+        self.random = random.Random(1)
+        self.graphql_requests = 0
+        self.home_requests = 0
+        self.throttled = 0
+        self.server = None
+
+    def start(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with mock.lock:
+                    mock.home_requests += 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html')
+                self.end_headers()
+                self.wfile.write(b'<html></html>')
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                status, payload = mock.handle_query(json.loads(body)['query'])
+                self.send_response(status)
+                if status == 429:
+                    self.send_header('Retry-After', str(mock.retry_after))
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def handle_query(self, query):
+        """(status, body) for one GraphQL request"""
+        with self.lock:
+            self.graphql_requests += 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            throttled = self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttled += 1
+        if delay:
+            time.sleep(delay)
+        if throttled:
+            return 429, b'{"errors": [{"message": "Too Many Requests"}]}'
+
+        category_id = re.search(r'categoryId: "([^"]*)"', query).group(1)
+        store_id = int(re.search(r'storeId: (\d+)', query).group(1))
+        match = re.search(r'cursor: "([^"]*)"', query)
+        cursor = match.group(1) if match else ""
+
+        if self.recorded is not None:
+            page = self.recorded.get((category_id, cursor))
+            if page is None:
+                return 404, b'{"errors": [{"message": "not recorded"}]}'
+            return 200, page
+        return 200, json.dumps(self.synthetic_page(category_id, store_id, cursor)).encode()
+
+    def synthetic_page(self, category_id, store_id, cursor):
+        start = int(cursor) if cursor else 0
+        end = min(start + PAGE_SIZE, self.products_per_category)
+        records = []
+        for i in range(start, end):
+            # Deterministic prices that differ by store and by price_seed
+            cents = 99 + (i * 37 + store_id * 11 + self.price_seed * 7) % 2000
+            records.append({
+                'id': f"{category_id}-{i}",
+                'displayName': f"Product {i} of {category_id}",
+                'brand': {'name': f"Brand {i % 13}", 'isOwnBrand': i % 5 == 0},
+                'SKUs': [{
+                    'id': f"sku-{category_id}-{i}",
+                    'contextPrices': [{'listPrice': {'formattedAmount': f"${cents / 100:.2f}"}}],
+                }],
+            })
+        return {'data': {'browseCategory': {
+            'pageTitle': f"Category {category_id}",
+            'records': records,
+            'total': self.products_per_category,
+            'hasMoreRecords': end < self.products_per_category,
+            'nextCursor': str(end),
+        }}}
+
+def load_recorded_pages(recorded_dir):
+    """{(category_id, cursor): response body} from DIR/<categoryId>.json page lists"""
+    pages = {}
+    for name in os.listdir(recorded_dir):
+        if not name.endswith('.json'):
+            continue
+        category_id = name[:-len('.json')]
+        with open(os.path.join(recorded_dir, name)) as f:
+            responses = json.load(f)
+        cursor = ""
+        for response in responses:
+            pages[(category_id, cursor)] = json.dumps(response).encode()
+            cursor = response['data']['browseCategory'].get('nextCursor') or ""
+    return pages
+
+def recorded_categories(recorded_dir):
+    return sorted(name[:-len('.json')] for name in os.listdir(recorded_dir)
+                  if name.endswith('.json'))
+
+@contextlib.contextmanager
+def pointed_at(mock):
+    """Point scrape2 at the mock server for the duration of the block"""
+    saved = scrape2.URL, scrape2.HOME_URL
+    scrape2.URL = mock.base_url + '/graphql'
+    scrape2.HOME_URL = mock.base_url + '/'
+    try:
+        yield
+    finally:
+        scrape2.URL, scrape2.HOME_URL = saved
+
+def run_benchmark(mock, categories, stores, workers=1, rps=1000.0, history_mode='compact',
+                  db_path=None, verbose=False, queue_size=scrape2.PIPELINE_QUEUE_SIZE):
+    """Crawl every category of every store from the mock server and return the measurements"""
+    metrics = CrawlMetrics()
+    requests_before = mock.graphql_requests + mock.home_requests
+    throttled_before = mock.throttled
+
+    with tempfile.TemporaryDirectory() as scratch:
+        db_path = db_path or os.path.join(scratch, 'bench.db')
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        tracemalloc.start()
+        started = time.perf_counter()
+        with output, pointed_at(mock):
+            conn = scrape2.create_database(db_path, check_same_thread=workers <= 1 and not queue_size)
+            run_id, _ = scrape2.start_crawl_run(conn)
+            jobs = scrape2.build_jobs(stores, categories)
+            scrape2.register_categories(conn, run_id, jobs)
+            catalog = scrape2.ProductCatalog.load(conn)
+            throttle = scrape2.AdaptiveThrottle(rps, max_rate=max(rps, 4.0), burst=max(1, workers))
+            if workers > 1:
+                successful, failed, products = scrape2.run_concurrent(
+                    conn, jobs, workers, throttle, metrics=metrics,
+                    history_mode=history_mode, run_id=run_id, catalog=catalog, queue_size=queue_size)
+            else:
+                successful, failed, products = scrape2.run_sequential(
+                    conn, jobs, throttle, metrics=metrics,
+                    history_mode=history_mode, run_id=run_id, catalog=catalog, queue_size=queue_size)
+            scrape2.finish_crawl_run(conn, run_id)
+            crawl_seconds = time.perf_counter() - started
+            rollup_started = time.perf_counter()
+            scrape2.refresh_rollups(conn)
+            rollup_seconds = time.perf_counter() - rollup_started
+            conn.close()
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    requests_made = mock.graphql_requests + mock.home_requests - requests_before
+    stages = metrics.to_dict()['stages']
+    db_write = stages.get('db_write', {'sum': 0.0, 'count': 0})
+    return {
+        'jobs': len(jobs),
+        'successful': successful,
+        'failed': failed,
+        'products': products,
+        'requests': requests_made,
+        'throttled': mock.throttled - throttled_before,
+        'crawl_seconds': crawl_seconds,
+        'products_per_sec': products / crawl_seconds if crawl_seconds else 0.0,
+        'requests_per_sec': requests_made / crawl_seconds if crawl_seconds else 0.0,
+        'write_seconds': db_write['sum'],
+        'write_batches': db_write['count'],
+        'rollup_seconds': rollup_seconds,
+        'peak_traced_mb': peak_traced / 1e6,
+        # ru_maxrss is in kilobytes on Linux
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'stages': stages,
+    }
+
+def format_result(result):
+    return (f"{result['products']} products from {result['jobs']} jobs "
+            f"({result['failed']} failed) in {result['crawl_seconds']:.2f}s: "
+            f"{result['products_per_sec']:.0f} products/s, "
+            f"{result['requests_per_sec']:.1f} requests/s, "
+            f"{result['throttled']} throttled; "
+            f"DB writes {result['write_seconds']:.3f}s over {result['write_batches']} batches, "
+            f"rollups {result['rollup_seconds']:.3f}s; "
+            f"peak {result['peak_traced_mb']:.1f} MB traced, {result['max_rss_mb']:.0f} MB RSS")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the crawler against a local mock GraphQL server")
+    parser.add_argument('--categories', type=int, default=10, help="synthetic categories per store")
+    parser.add_argument('--products', type=int, default=200, help="synthetic products per category")
+    parser.add_argument('--stores', default="793", help="comma-separated store ids")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--rps', type=float, default=1000.0,
+                        help="starting request rate; high by default so the server is the limit")
+    parser.add_argument('--latency', type=float, default=0.0, help="server latency in ms")
+    parser.add_argument('--jitter', type=float, default=0.0, help="extra random latency in ms")
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help="fraction of GraphQL requests answered with 429")
+    parser.add_argument('--retry-after', type=int, default=0, help="Retry-After seconds sent with a 429")
+    parser.add_argument('--history-mode', choices=['compact', 'full'], default='compact')
+    parser.add_argument('--queue-size', type=int, default=scrape2.PIPELINE_QUEUE_SIZE,
+                        help="crawl pipeline queue size (0 writes inline)")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="crawl this many times into the same database (prices change each time)")
+    parser.add_argument('--recorded', metavar='DIR', default=None,
+                        help="replay recorded pages from DIR/<categoryId>.json instead of synthetic ones")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--verbose', action='store_true', help="show the crawler's own output")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    stores = [int(store_id) for store_id in args.stores.split(',') if store_id.strip()]
+    if args.recorded:
+        categories = [(category_id, f"Recorded {category_id}")
+                      for category_id in recorded_categories(args.recorded)]
+    else:
+        categories = [(str(1000 + i), f"Category {i}") for i in range(args.categories)]
+
+    mock = MockGraphQLServer(args.products, latency=args.latency / 1000,
+                             jitter=args.jitter / 1000, throttle_rate=args.throttle_rate,
+                             retry_after=args.retry_after, recorded_dir=args.recorded).start()
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as scratch:
+            db_path = os.path.join(scratch, 'bench.db')
+            for run in range(args.repeat):
+                mock.price_seed = run
+                result = run_benchmark(mock, categories, stores, args.workers, args.rps,
+                                       args.history_mode, db_path=db_path, verbose=args.verbose,
+                                       queue_size=args.queue_size)
+                conn = sqlite3.connect(db_path)
+                result['history_rows'] = conn.execute('SELECT COUNT(*) FROM price_history').fetchone()[0]
+                conn.close()
+                result['run'] = run + 1
+                results.append(result)
+                if not args.json:
+                    print(f"Run {run + 1}: {format_result(result)}")
+    finally:
+        mock.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
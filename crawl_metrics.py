@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Stage timers and counters for the crawler.
+
+CrawlMetrics is shared by every worker thread. Time a stage with
+`with metrics.timer('http'):` and count events with `metrics.inc('429')`.
+Each stage keeps a latency histogram (Prometheus-style cumulative
+buckets plus count, sum and max) from which p50/p95/p99 are estimated.
+At the end of a run the metrics are written as JSON and as a Prometheus
+text file that node_exporter's textfile collector can pick up.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from a fast DB write to a long backoff
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+class Histogram:
+    """Latency histogram with fixed buckets; not thread-safe on its own"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating inside its bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for i, count in enumerate(self.counts):
+            upper = self.buckets[i] if i < len(self.buckets) else self.max
+            if count and seen + count >= rank:
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+            lower = upper
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+class CrawlMetrics:
+    """Thread-safe stage timers, counters and gauges for one crawl run"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.started_at = time.time()
+        self.started = time.monotonic()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """Time the block into the stage's histogram, even if it raises"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - start)
+
+    def inc(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def count(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'started_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started_at)),
+                'elapsed_seconds': self.elapsed(),
+                'counters': dict(sorted(self.counters.items())),
+                'gauges': dict(sorted(self.gauges.items())),
+                'stages': {stage: histogram.to_dict()
+                           for stage, histogram in sorted(self.stages.items())},
+            }
+
+    def to_prometheus(self, prefix='heb_crawl'):
+        """Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            lines.append(f"# HELP {prefix}_stage_seconds Time spent per crawl stage")
+            lines.append(f"# TYPE {prefix}_stage_seconds histogram")
+            for stage, histogram in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+            lines.append(f"# HELP {prefix}_events_total Crawl events (requests, responses by status, retries, ...)")
+            lines.append(f"# TYPE {prefix}_events_total counter")
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'{prefix}_events_total{{event="{name}"}} {value}')
+
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f"# TYPE {prefix}_{name} gauge")
+                lines.append(f"{prefix}_{name} {value}")
+        lines.append(f"# TYPE {prefix}_elapsed_seconds gauge")
+        lines.append(f"{prefix}_elapsed_seconds {self.elapsed()}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        _write_atomically(path, json.dumps(self.to_dict(), indent=2) + "\n")
+
+    def write_prometheus(self, path):
+        _write_atomically(path, self.to_prometheus())
+
+    def format_summary(self):
+        """Human-readable table of stage latencies and counters"""
+        data = self.to_dict()
+        lines = [f"{'stage':<16}{'count':>8}{'total':>10}{'mean':>10}{'p50':>10}{'p95':>10}{'max':>10}"]
+        for stage, s in data['stages'].items():
+            lines.append(f"{stage:<16}{s['count']:>8}{s['sum']:>9.2f}s"
+                         f"{s['mean'] * 1000:>8.0f}ms{s['p50'] * 1000:>8.0f}ms"
+                         f"{s['p95'] * 1000:>8.0f}ms{s['max'] * 1000:>8.0f}ms")
+        if data['counters']:
+            lines.append(", ".join(f"{name}={value}" for name, value in data['counters'].items()))
+        return "\n".join(lines)
+
+def _write_atomically(path, text):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+class ProgressLine:
+    """Background thread redrawing a one-line crawl status on stderr"""
+
+    def __init__(self, metrics, total_jobs, throttle=None, interval=1.0, stream=None):
+        self.metrics = metrics
+        self.total_jobs = total_jobs
+        self.throttle = throttle
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self._draw()
+        self.stream.write("\n")
+        self.stream.flush()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._draw()
+
+    def _draw(self):
+        m = self.metrics
+        elapsed = max(m.elapsed(), 1e-9)
+        jobs_done = m.count('categories_done') + m.count('categories_failed')
+        rate = f" rate {self.throttle.rate:.2f}/s" if self.throttle is not None else ""
+        self.stream.write(
+            f"\r[{elapsed:6.0f}s] categories {jobs_done}/{self.total_jobs} "
+            f"pages {m.count('pages')} products {m.count('products')} "
+            f"({m.count('products') / elapsed:.1f}/s) requests {m.count('requests')} "
+            f"429s {m.count('status_429')} retries {m.count('retries')}{rate}   ")
+        self.stream.flush()
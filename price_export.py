@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Export price_history to month-partitioned Parquet files.
+
+Each month goes to <out>/year_month=YYYY-MM/part-0.parquet with the product
+and category attributes joined in, so analysis can read only the columns
+and months it needs without touching the scraper's SQLite database.
+
+Only partitions that changed since the last export are rewritten. Price
+intervals never span months and new prices are only written at or after
+the latest last_seen, so just the months from the previous high-water
+mark onwards can grow; older months are re-exported only if their row
+count changed (e.g. after `scrape2.py --compact-history`).
+"""
+import argparse
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
+
+DEFAULT_EXPORT_DIR = 'price_parquet'
+MANIFEST_NAME = '_manifest.json'
+
+EXPORT_QUERY = """
+    SELECT
+        ph.product_id,
+        ph.store_id,
+        ph.price,
+        ph.recorded_at,
+        ph.last_seen,
+        ph.observations,
+        p.product_name,
+        p.brand_name,
+        p.category_id,
+        p.category_name
+    FROM price_history ph
+    LEFT JOIN products p ON p.product_id = ph.product_id
+    WHERE %s
+    ORDER BY ph.store_id, ph.product_id, ph.recorded_at
+"""
+
+MONTH_FILTER = "ph.recorded_at >= :start AND ph.recorded_at < :end"
+
+# On the v2 layout (scrape2.py --migrate-v2) price_history is a view; filter
+# on its raw epoch columns so the last_seen index is used. An interval that
+# starts in the month cannot have been last seen before it.
+MONTH_FILTER_V2 = (
+    "ph.recorded_epoch >= CAST(strftime('%s', :start) AS INTEGER) "
+    "AND ph.recorded_epoch < CAST(strftime('%s', :end) AS INTEGER) "
+    "AND ph.last_seen_epoch >= CAST(strftime('%s', :start) AS INTEGER)"
+)
+
+def month_bounds(year_month):
+    """First day of the month and first day of the next one, as text"""
+    year, month = map(int, year_month.split('-'))
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return f"{year:04d}-{month:02d}-01", f"{next_year:04d}-{next_month:02d}-01"
+
+def partition_path(out_dir, year_month):
+    return os.path.join(out_dir, f"year_month={year_month}", "part-0.parquet")
+
+def load_manifest(out_dir):
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {'high_water': None, 'partitions': {}}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(out_dir, manifest):
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def write_partition(conn, out_dir, year_month):
+    """Write one month's rows to its partition file, replacing it atomically"""
+    start, end = month_bounds(year_month)
+    is_v2 = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'price_history_v2'").fetchone()
+    df = pd.read_sql_query(EXPORT_QUERY % (MONTH_FILTER_V2 if is_v2 else MONTH_FILTER), conn,
+                           params={'start': start, 'end': end})
+    df['price'] = df['price'].astype(float)
+    path = partition_path(out_dir, year_month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    df.to_parquet(tmp_path, engine='pyarrow', index=False)
+    os.replace(tmp_path, path)
+    return len(df)
+
+def export_price_history(db_path='heb_products.db', out_dir=DEFAULT_EXPORT_DIR, full=False):
+    """
+    Sync the Parquet export with the database.
+
+    Returns the list of months that were (re)written.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        manifest = {'high_water': None, 'partitions': {}} if full else load_manifest(out_dir)
+        new_high_water = conn.execute('SELECT MAX(last_seen) FROM price_history').fetchone()[0]
+
+        # Row counts per month only need the recorded_at index
+        counts = dict(conn.execute("""
+            SELECT strftime('%Y-%m', recorded_at), COUNT(*)
+            FROM price_history
+            GROUP BY 1
+        """).fetchall())
+        open_from = manifest['high_water'][:7] if manifest['high_water'] else ''
+
+        changed = [ym for ym, count in sorted(counts.items())
+                   if ym >= open_from
+                   or manifest['partitions'].get(ym) != count
+                   or not os.path.exists(partition_path(out_dir, ym))]
+
+        for year_month in changed:
+            manifest['partitions'][year_month] = write_partition(conn, out_dir, year_month)
+
+        # Drop partitions whose month no longer has any rows
+        for year_month in sorted(set(manifest['partitions']) - set(counts)):
+            path = partition_path(out_dir, year_month)
+            if os.path.exists(path):
+                os.remove(path)
+            del manifest['partitions'][year_month]
+
+        os.makedirs(out_dir, exist_ok=True)
+        manifest['high_water'] = new_high_water
+        manifest['exported_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        save_manifest(out_dir, manifest)
+        return changed
+    finally:
+        conn.close()
+
+def read_price_history(out_dir=DEFAULT_EXPORT_DIR, columns=None, store_id=None,
+                       start_month=None, end_month=None):
+    """
+    Read exported price intervals, loading only `columns` and only the
+    partitions between start_month and end_month ('YYYY-MM', inclusive).
+    """
+    filters = []
+    if start_month is not None:
+        filters.append(('year_month', '>=', start_month))
+    if end_month is not None:
+        filters.append(('year_month', '<=', end_month))
+    if store_id is not None:
+        filters.append(('store_id', '=', store_id))
+    df = pd.read_parquet(out_dir, engine='pyarrow', columns=columns,
+                         filters=filters or None)
+    if 'year_month' in df.columns:
+        df['year_month'] = df['year_month'].astype(str)
+    return df
+
+def main():
+    parser = argparse.ArgumentParser(description="Export price history to month-partitioned Parquet")
+    parser.add_argument('--db', default='heb_products.db', help="SQLite database path")
+    parser.add_argument('--out', default=DEFAULT_EXPORT_DIR, help="export directory")
+    parser.add_argument('--full', action='store_true', help="rewrite every partition")
+    args = parser.parse_args()
+
+    changed = export_price_history(args.db, args.out, full=args.full)
+    if changed:
+        print(f"Exported {len(changed)} partitions: {', '.join(changed)}")
+    else:
+        print("Export is up to date")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Vectorized price analytics over a product x month matrix.
+
+PriceMatrix loads the price data once (two queries: product_price_summary
+for first/last prices and monthly_product_prices for the monthly averages)
+and answers every report metric with NumPy operations on the loaded arrays,
+so many metrics and windows cost no further SQL.
+
+Rows are (product, store) pairs, columns are months. Months a product was
+not seen in are NaN in `prices` and False in `mask`.
+"""
+import sqlite3
+import numpy as np
+import pandas as pd
+
+INDEX_FORMULAS = ('jevons', 'dutot', 'carli')
+
+# First/last prices per (product, store), one matrix row each
+SUMMARY_QUERY = """
+    SELECT
+        s.product_id,
+        s.store_id,
+        p.product_name,
+        p.category_name,
+        s.first_price,
+        s.first_seen,
+        s.last_price,
+        s.last_seen
+    FROM product_price_summary s
+    JOIN products p ON p.product_id = s.product_id
+    WHERE :store_id IS NULL OR s.store_id = :store_id
+    ORDER BY s.store_id, s.product_id
+"""
+
+# Observation-weighted monthly prices, the matrix cells
+MONTHLY_QUERY = """
+    SELECT product_id, store_id, year_month, price_sum, observations
+    FROM monthly_product_prices
+    WHERE :store_id IS NULL OR store_id = :store_id
+"""
+
+def _group_mean(codes, values, num_groups):
+    """Per-group count and mean of values, given integer group codes"""
+    counts = np.bincount(codes, minlength=num_groups)
+    sums = np.bincount(codes, weights=values, minlength=num_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return counts, sums / counts
+
+class PriceMatrix:
+    """Product x month price matrix with a missing-value mask"""
+
+    def __init__(self, rows, periods, price_sums, observations):
+        """
+        rows: DataFrame with one line per (product_id, store_id) and columns
+        product_name, category_name, first_price, first_seen, last_price,
+        last_seen. periods: sorted array of 'YYYY-MM' strings.
+        price_sums / observations: len(rows) x len(periods) arrays.
+        """
+        self.rows = rows.reset_index(drop=True)
+        self.periods = np.asarray(periods)
+        self.price_sums = price_sums
+        self.observations = observations
+        self.mask = observations > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.prices = np.where(self.mask, price_sums / observations, np.nan)
+
+        self.first_price = self.rows['first_price'].to_numpy(dtype=float)
+        self.last_price = self.rows['last_price'].to_numpy(dtype=float)
+        self.first_seen = self.rows['first_seen'].to_numpy(dtype=object)
+        self.last_seen = self.rows['last_seen'].to_numpy(dtype=object)
+        # Products seen only once have no change to report
+        self.tracked = self.first_seen != self.last_seen
+
+    @classmethod
+    def load(cls, db_path='heb_products.db', store_id=None):
+        """Load the matrix for one store, or for all stores when store_id is None"""
+        conn = sqlite3.connect(db_path)
+        try:
+            return cls.from_connection(conn, store_id)
+        finally:
+            conn.close()
+
+    @classmethod
+    def from_connection(cls, conn, store_id=None):
+        """Like load(), over an already open connection"""
+        params = {'store_id': store_id}
+        rows = pd.read_sql_query(SUMMARY_QUERY, conn, params=params)
+        monthly = pd.read_sql_query(MONTHLY_QUERY, conn, params=params)
+        return cls.from_frames(rows, monthly)
+
+    @classmethod
+    def load_parquet(cls, export_dir='price_parquet', store_id=None, start_month=None, end_month=None):
+        """
+        Load the matrix from a price_export.py export instead of SQLite,
+        reading only the needed columns and the partitions in the window.
+        First/last prices are then those of the window.
+        """
+        from price_export import read_price_history
+        history = read_price_history(
+            export_dir,
+            columns=['product_id', 'store_id', 'price', 'recorded_at', 'last_seen',
+                     'observations', 'product_name', 'category_name', 'year_month'],
+            store_id=store_id, start_month=start_month, end_month=end_month)
+
+        keys = ['product_id', 'store_id']
+        history = history.sort_values(keys + ['recorded_at'], kind='stable')
+        grouped = history.groupby(keys, sort=True)
+        first = grouped.head(1).set_index(keys)
+        last = history.sort_values(keys + ['last_seen'], kind='stable').groupby(keys).tail(1).set_index(keys)
+        rows = pd.DataFrame({
+            'product_name': first['product_name'],
+            'category_name': first['category_name'],
+            'first_price': first['price'],
+            'first_seen': first['recorded_at'],
+            'last_price': last['price'],
+            'last_seen': last['last_seen'],
+        }).reset_index()
+
+        history['price_sum'] = history['price'] * history['observations']
+        monthly = history.groupby(keys + ['year_month'], as_index=False)[['price_sum', 'observations']].sum()
+        return cls.from_frames(rows, monthly)
+
+    @classmethod
+    def from_frames(cls, rows, monthly):
+        """Build the matrix from a summary frame and a monthly rollup frame"""
+        periods, period_idx = np.unique(monthly['year_month'].to_numpy(dtype=str),
+                                        return_inverse=True)
+        row_keys = pd.MultiIndex.from_arrays([rows['product_id'], rows['store_id']])
+        row_idx = row_keys.get_indexer(
+            pd.MultiIndex.from_arrays([monthly['product_id'], monthly['store_id']]))
+        known = row_idx >= 0
+
+        shape = (len(rows), len(periods))
+        price_sums = np.zeros(shape)
+        observations = np.zeros(shape, dtype=np.int64)
+        price_sums[row_idx[known], period_idx[known]] = monthly['price_sum'].to_numpy(dtype=float)[known]
+        observations[row_idx[known], period_idx[known]] = monthly['observations'].to_numpy()[known]
+        return cls(rows, periods, price_sums, observations)
+
+    def _window(self, start=None, end=None):
+        """Column slice for the months start..end inclusive"""
+        lo = 0 if start is None else int(np.searchsorted(self.periods, start, side='left'))
+        hi = len(self.periods) if end is None else int(np.searchsorted(self.periods, end, side='right'))
+        return slice(lo, hi)
+
+    def _first_last_change(self):
+        """Percent change from first to last observed price, per row"""
+        return (self.last_price - self.first_price) / self.first_price * 100
+
+    def overall_change(self):
+        """Average first-to-last change and the increased/decreased/unchanged split"""
+        tracked = self.tracked
+        first, last = self.first_price[tracked], self.last_price[tracked]
+        change = self._first_last_change()[tracked]
+        return pd.DataFrame([{
+            'total_products': int(tracked.sum()),
+            'avg_percent_change': change.mean() if len(change) else None,
+            'earliest_date': min(self.first_seen[tracked]) if tracked.any() else None,
+            'latest_date': max(self.last_seen[tracked]) if tracked.any() else None,
+            'num_increased': int((last > first).sum()),
+            'num_decreased': int((last < first).sum()),
+            'num_unchanged': int((last == first).sum()),
+        }])
+
+    def category_breakdown(self):
+        """Average first-to-last change per category, largest first"""
+        tracked = self.tracked
+        names, codes = np.unique(self.rows['category_name'].to_numpy(dtype=str)[tracked],
+                                 return_inverse=True)
+        first, last = self.first_price[tracked], self.last_price[tracked]
+        counts, mean_change = _group_mean(codes, self._first_last_change()[tracked], len(names))
+        df = pd.DataFrame({
+            'category_name': names,
+            'num_products': counts,
+            'avg_percent_change': mean_change,
+            'num_increased': np.bincount(codes, weights=last > first, minlength=len(names)).astype(int),
+            'num_decreased': np.bincount(codes, weights=last < first, minlength=len(names)).astype(int),
+        })
+        return df.sort_values('avg_percent_change', ascending=False, kind='stable').reset_index(drop=True)
+
+    def store_breakdown(self):
+        """Average first-to-last change and latest average price per store"""
+        tracked = self.tracked
+        stores, codes = np.unique(self.rows['store_id'].to_numpy()[tracked], return_inverse=True)
+        counts, mean_change = _group_mean(codes, self._first_last_change()[tracked], len(stores))
+        _, mean_last = _group_mean(codes, self.last_price[tracked], len(stores))
+        df = pd.DataFrame({
+            'store_id': stores,
+            'num_products': counts,
+            'avg_percent_change': mean_change,
+            'avg_last_price': mean_last,
+        })
+        return df.sort_values('avg_percent_change', ascending=False, kind='stable').reset_index(drop=True)
+
+    def monthly_index(self, start=None, end=None):
+        """
+        Fixed-base index: each month's average price relative to the first
+        month of the window, over the products present in that first month.
+        """
+        window = self._window(start, end)
+        prices = self.prices[:, window]
+        periods = self.periods[window]
+        if not len(periods):
+            return pd.DataFrame(columns=['year_month', 'num_products',
+                                         'avg_inflation_from_baseline', 'avg_product_price'])
+        base = prices[:, 0]
+        present = ~np.isnan(prices) & ~np.isnan(base)[:, None]
+        counts = present.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ratio = np.where(present, prices / base[:, None], 0.0).sum(axis=0) / counts
+            avg_price = np.where(present, prices, 0.0).sum(axis=0) / counts
+        keep = counts > 0
+        return pd.DataFrame({
+            'year_month': periods[keep],
+            'num_products': counts[keep],
+            'avg_inflation_from_baseline': ratio[keep] * 100 - 100,
+            'avg_product_price': avg_price[keep],
+        })
+
+    def chained_index(self, formula='jevons', start=None, end=None):
+        """
+        Chained index, 100 at the first month of the window.
+
+        Each month is linked to the previous one over the products seen in
+        both, so products entering or leaving the assortment only affect the
+        links where they can be matched. `formula` picks the elementary
+        index for each link: 'jevons' (geometric mean of price relatives),
+        'dutot' (ratio of average prices) or 'carli' (mean of relatives).
+        """
+        if formula not in INDEX_FORMULAS:
+            raise ValueError(f"formula must be one of {', '.join(INDEX_FORMULAS)}")
+        window = self._window(start, end)
+        prices = self.prices[:, window]
+        periods = self.periods[window]
+        if not len(periods):
+            return pd.DataFrame(columns=['year_month', 'matched_products', 'link', 'index'])
+
+        prev, cur = prices[:, :-1], prices[:, 1:]
+        matched = ~np.isnan(prev) & ~np.isnan(cur)
+        counts = matched.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            relatives = np.where(matched, cur / prev, 1.0)
+            if formula == 'jevons':
+                links = np.exp(np.log(relatives).sum(axis=0) / counts)
+            elif formula == 'carli':
+                links = np.where(matched, relatives, 0.0).sum(axis=0) / counts
+            else:
+                links = np.where(matched, cur, 0.0).sum(axis=0) / np.where(matched, prev, 0.0).sum(axis=0)
+        # A month with nothing to match carries the index forward unchanged
+        links = np.where(counts > 0, links, 1.0)
+        return pd.DataFrame({
+            'year_month': periods,
+            'matched_products': np.concatenate([[int((~np.isnan(prices[:, 0])).sum())], counts]),
+            'link': np.concatenate([[1.0], links]),
+            'index': 100 * np.cumprod(np.concatenate([[1.0], links])),
+        })
+
+    def basket_cost(self, items):
+        """
+        Monthly cost of a basket given as {item_name: (quantity, [product_id, ...])}.
+        Each product is averaged across stores weighted by observations; an
+        item costs the mean of its products seen that month times its
+        quantity, so alternative products are not added up.
+        """
+        row_products = self.rows['product_id'].to_numpy(dtype=str)
+        basket_products = {product_id for _, product_ids in items.values() for product_id in product_ids}
+        in_basket = np.isin(row_products, list(basket_products))
+        product_ids, codes = np.unique(row_products[in_basket], return_inverse=True)
+        shape = (len(product_ids), len(self.periods))
+        sums = np.zeros(shape)
+        counts = np.zeros(shape)
+        np.add.at(sums, codes, self.price_sums[in_basket])
+        np.add.at(counts, codes, self.observations[in_basket])
+        present = counts > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            product_prices = np.where(present, sums / counts, 0.0)
+
+        product_rows = {product_id: i for i, product_id in enumerate(product_ids)}
+        basket_cost = np.zeros(len(self.periods))
+        num_items = np.zeros(len(self.periods), dtype=int)
+        for quantity, item_products in items.values():
+            rows = [product_rows[p] for p in item_products if p in product_rows]
+            if not rows:
+                continue
+            seen = present[rows].sum(axis=0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                item_price = np.where(seen > 0, product_prices[rows].sum(axis=0) / seen, 0.0)
+            basket_cost += item_price * quantity
+            num_items += seen > 0
+        keep = num_items > 0
+        return pd.DataFrame({
+            'year_month': self.periods[keep],
+            'basket_cost': basket_cost[keep],
+            'num_items': num_items[keep],
+        })
+
+    def period_change(self, start=None, end=None):
+        """
+        Per-row percent change between the first and last month of the
+        window that each product was seen in. NaN where it was seen once.
+        """
+        window = self._window(start, end)
+        prices = self.prices[:, window]
+        seen = ~np.isnan(prices)
+        has_any = seen.any(axis=1)
+        first_col = np.argmax(seen, axis=1)
+        last_col = prices.shape[1] - 1 - np.argmax(seen[:, ::-1], axis=1)
+        rows = np.arange(len(prices))
+        first = np.where(has_any, prices[rows, first_col], np.nan)
+        last = np.where(has_any, prices[rows, last_col], np.nan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(first_col < last_col, (last - first) / first * 100, np.nan)
+
+    def top_movers(self, n=15, direction='increase'):
+        """
+        The n largest first-to-last price increases or decreases, by amount.
+        """
+        diff = self.last_price - self.first_price
+        if direction == 'increase':
+            candidates = np.flatnonzero(diff > 0)
+            order = candidates[np.argsort(-diff[candidates], kind='stable')]
+        elif direction == 'decrease':
+            candidates = np.flatnonzero(diff < 0)
+            order = candidates[np.argsort(diff[candidates], kind='stable')]
+        else:
+            raise ValueError("direction must be 'increase' or 'decrease'")
+        top = self.rows.iloc[order[:n]].copy()
+        top['price_difference'] = diff[order[:n]]
+        top['percent_change'] = top['price_difference'] / top['first_price'] * 100
+        return top.reset_index(drop=True)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Local read-only HTTP/JSON service for price queries.
+
+Dashboards and scripts can poll this instead of re-running the reports:
+
+    python price_service.py --db heb_products.db --port 8765
+
+    GET /products/<product_id>[?store=793]  price history and summary per store
+    GET /products/<product_id>/daily[?store=793]
+                                            daily average price per store
+    GET /movers[?top=15&store=793]          top price increases and decreases
+    GET /categories[?store=793]             first-to-last change per category
+    GET /categories/<name>/daily[?store=793]
+    GET /categories/<name>/monthly[?store=793]
+                                            category average price per day or month
+    GET /baskets/<name>[?store=793]         monthly basket cost
+    GET /changes?since=YYYY-MM-DD[&store=793&limit=50]
+                                            price changes recorded since a date
+    GET /status                             data version and cache statistics
+
+Queries run on a small pool of read-only connections (mode=ro), so the
+service never takes a write lock and the scraper's WAL writes go on while
+it reads. Encoded results are kept in an LRU cache of `--cache-size`
+entries. The cache is emptied when the data version changes: the latest
+finished crawl run and the rollup high-water mark, which scrape2.py moves
+at the end of every crawl, and the latest price_change event, which moves
+as soon as a crawl writes a changed price.
+"""
+import argparse
+import json
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+from basket import calculate_basket_cost, get_basket_id, get_basket_items
+from price_matrix import PriceMatrix
+from visualize_prices import (CHANGE_FIELDS, MOVER_FIELDS, get_price_changes,
+                              get_price_histories, get_top_movers)
+
+DEFAULT_PORT = 8765
+
+# The daily and monthly rollups scrape2.py refreshes after every crawl
+ROLLUP_QUERIES = {
+    ('products', 'daily'): '''
+        SELECT day, store_id, avg_price
+        FROM daily_product_prices
+        WHERE product_id = :key AND (:store_id IS NULL OR store_id = :store_id)
+        ORDER BY store_id, day
+    ''',
+    ('categories', 'daily'): '''
+        SELECT day, store_id, avg_price, num_products
+        FROM daily_category_prices
+        WHERE category_name = :key AND (:store_id IS NULL OR store_id = :store_id)
+        ORDER BY store_id, day
+    ''',
+    ('categories', 'monthly'): '''
+        SELECT year_month, store_id, avg_price, num_products
+        FROM monthly_category_prices
+        WHERE category_name = :key AND (:store_id IS NULL OR store_id = :store_id)
+        ORDER BY store_id, year_month
+    ''',
+}
+
+VERSION_QUERY = """
+    SELECT
+        (SELECT MAX(finished_at) FROM crawl_runs),
+        (SELECT high_water FROM rollup_state WHERE name = 'price_rollups'),
+        {latest_change}
+"""
+
+class LRUCache:
+    """Size-bounded least-recently-used cache; thread-safe"""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'max_entries': self.max_entries,
+                    'hits': self.hits, 'misses': self.misses}
+
+class ReadOnlyPool:
+    """Fixed pool of read-only connections shared by the request threads"""
+
+    def __init__(self, db_path, size=4):
+        self.idle = queue.Queue()
+        for _ in range(size):
+            conn = sqlite3.connect(f"file:{quote(db_path)}?mode=ro", uri=True, check_same_thread=False)
+            self.idle.put(conn)
+        self.size = size
+
+    @contextmanager
+    def connection(self):
+        conn = self.idle.get()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def close(self):
+        for _ in range(self.size):
+            self.idle.get().close()
+
+class NotFound(Exception):
+    pass
+
+def frame_records(df):
+    """DataFrame rows as JSON-ready dicts, with NaN as None"""
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+def json_default(value):
+    # numpy scalars
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+class PriceService:
+    """Query handlers plus the cache and the connection pool"""
+
+    def __init__(self, db_path, pool_size=4, cache_size=256):
+        self.db_path = db_path
+        self.pool = ReadOnlyPool(db_path, pool_size)
+        self.cache = LRUCache(cache_size)
+        self.version = None
+        self.version_lock = threading.Lock()
+        # Databases not crawled since price_change events were added have no table yet
+        with self.pool.connection() as conn:
+            has_changes = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'price_changes'").fetchone()
+        self.version_query = VERSION_QUERY.format(
+            latest_change='(SELECT MAX(id) FROM price_changes)' if has_changes else 'NULL')
+
+    def data_version(self, conn):
+        """Current data version; empties the cache when it moved"""
+        version = tuple(conn.execute(self.version_query).fetchone())
+        with self.version_lock:
+            if version != self.version:
+                self.cache.clear()
+                self.version = version
+        return version
+
+    def handle(self, path, params):
+        """(status, JSON body bytes) for one GET request"""
+        parts = [unquote(part) for part in path.strip('/').split('/') if part]
+        try:
+            store_id = int(params['store']) if 'store' in params else None
+            with self.pool.connection() as conn:
+                version = self.data_version(conn)
+                if parts == ['status']:
+                    return 200, self.encode({'db': self.db_path, 'data_version': version,
+                                             'cache': self.cache.stats()})
+                if len(parts) == 2 and parts[0] == 'products':
+                    key = ('products', parts[1], store_id)
+                    compute = lambda: self.product(conn, parts[1], store_id)
+                elif parts == ['movers']:
+                    top = int(params.get('top', 15))
+                    key = ('movers', top, store_id)
+                    compute = lambda: self.movers(conn, top, store_id)
+                elif len(parts) == 3 and (parts[0], parts[2]) in ROLLUP_QUERIES:
+                    key = ('rollup', parts[0], parts[1], parts[2], store_id)
+                    compute = lambda: self.rollup(conn, parts[0], parts[1], parts[2], store_id)
+                elif parts == ['changes']:
+                    if 'since' not in params:
+                        raise ValueError("since is required")
+                    limit = int(params.get('limit', 50))
+                    key = ('changes', params['since'], store_id, limit)
+                    compute = lambda: [dict(zip(CHANGE_FIELDS, row)) for row in
+                                       get_price_changes(conn.cursor(), params['since'], store_id, limit)]
+                elif parts == ['categories']:
+                    key = ('categories', store_id)
+                    compute = lambda: self.categories(conn, store_id)
+                elif len(parts) == 2 and parts[0] == 'baskets':
+                    # Basket edits don't move the data version, so the items are part of the key
+                    items = tuple((item, quantity, tuple(product_ids)) for item, (quantity, product_ids)
+                                  in sorted(get_basket_items(conn, parts[1]).items()))
+                    key = ('baskets', parts[1], store_id, items)
+                    compute = lambda: self.basket(conn, parts[1], store_id)
+                else:
+                    raise NotFound(f"no endpoint {path}")
+
+                # Keyed by the version read above, so a slow request that finishes
+                # after a newer version cleared the cache can't serve stale data
+                key = (version,) + key
+                body = self.cache.get(key)
+                if body is None:
+                    body = self.encode(compute())
+                    self.cache.put(key, body)
+                return 200, body
+        except NotFound as e:
+            return 404, self.encode({'error': str(e)})
+        except ValueError as e:
+            return 400, self.encode({'error': f"bad parameter: {e}"})
+        except sqlite3.Error as e:
+            return 500, self.encode({'error': f"database error: {e}"})
+
+    def encode(self, result):
+        return json.dumps(result, default=json_default).encode()
+
+    def product(self, conn, product_id, store_id):
+        histories = get_price_histories(conn.cursor(), [product_id], store_id)
+        if not histories:
+            raise NotFound(f"no prices for product {product_id}")
+        summaries = {
+            row[0]: dict(zip(('first_price', 'first_seen', 'last_price', 'last_seen', 'min_price',
+                              'max_price', 'distinct_prices', 'observations'), row[1:]))
+            for row in conn.execute('''
+                SELECT store_id, first_price, first_seen, last_price, last_seen,
+                       min_price, max_price, distinct_prices, record_count
+                FROM product_price_summary
+                WHERE product_id = ? AND (? IS NULL OR store_id = ?)
+            ''', (product_id, store_id, store_id))
+        }
+        return {
+            'product_id': product_id,
+            'stores': [
+                {'store_id': row_store_id, 'product_name': name,
+                 'summary': summaries.get(row_store_id),
+                 'history': [[date, float(price)] for date, price in data]}
+                for (_, row_store_id), (name, data) in histories.items()
+            ],
+        }
+
+    def movers(self, conn, top, store_id):
+        increases, decreases = get_top_movers(conn.cursor(), top, store_id)
+        return {
+            'increases': [dict(zip(MOVER_FIELDS, row)) for row in increases],
+            'decreases': [dict(zip(MOVER_FIELDS, row)) for row in decreases],
+        }
+
+    def rollup(self, conn, kind, name, period, store_id):
+        cursor = conn.execute(ROLLUP_QUERIES[(kind, period)], {'key': name, 'store_id': store_id})
+        columns = [column[0] for column in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor]
+        if not rows:
+            label = 'product' if kind == 'products' else 'category'
+            raise NotFound(f"no {period} prices for {label} {name}")
+        return rows
+
+    def categories(self, conn, store_id):
+        return frame_records(PriceMatrix.from_connection(conn, store_id).category_breakdown())
+
+    def basket(self, conn, name, store_id):
+        if get_basket_id(conn, name) is None:
+            raise NotFound(f"no basket named {name}")
+        return frame_records(calculate_basket_cost(conn, name, store_id))
+
+    def close(self):
+        self.pool.close()
+
+def make_server(service, host='127.0.0.1', port=DEFAULT_PORT):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            status, body = service.handle(url.path, params)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve price queries as JSON over HTTP")
+    parser.add_argument('--db', default='heb_products.db', help="SQLite database path")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--pool-size', type=int, default=4, help="read-only connections")
+    parser.add_argument('--cache-size', type=int, default=256, help="cached results")
+    args = parser.parse_args()
+
+    service = PriceService(args.db, args.pool_size, args.cache_size)
+    server = make_server(service, args.host, args.port)
+    print(f"Serving {args.db} on http://{args.host}:{server.server_address[1]}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Archive of raw browseCategory responses, and offline re-ingest from it.
+
+With `scrape2.py --archive DIR` every page the crawler receives is kept
+as it came off the wire. Pages are appended to compressed segment files
+(DIR/segment-NNNNNN.gz, one gzip member per page, so `zcat` reads a whole
+segment) and each page gets a line in the segment's index
+(segment-NNNNNN.idx: run, store, category, page, fetch time, byte offset
+and length). Segments are never rewritten; a new one is started when the
+current one reaches `segment_bytes` and whenever a writer opens.
+
+Replaying runs the current extraction code over archived pages and writes
+them with their original fetch times, so a parsing fix or a schema change
+can be applied to old history without touching heb.com. Pages the target
+database already holds (stored by the crawl that archived them, per its
+crawl checkpoints, or by an earlier replay, per replayed_pages) are
+skipped unless `--force` is given:
+
+    python response_archive.py list --archive response_archive
+    python response_archive.py replay --archive response_archive --db rebuilt.db --workers 4
+    python response_archive.py replay --archive response_archive --db rebuilt.db --run 12
+"""
+import argparse
+import gzip
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+DEFAULT_ARCHIVE_DIR = 'response_archive'
+SEGMENT_BYTES = 64 * 1024 * 1024
+
+def segment_paths(archive_dir, number):
+    base = os.path.join(archive_dir, f"segment-{number:06d}")
+    return base + '.gz', base + '.idx'
+
+def segment_numbers(archive_dir):
+    if not os.path.isdir(archive_dir):
+        return []
+    return sorted(int(name[len('segment-'):-len('.idx')]) for name in os.listdir(archive_dir)
+                  if name.startswith('segment-') and name.endswith('.idx'))
+
+class ResponseArchive:
+    """Append-only writer for raw pages; safe to share between crawl threads"""
+
+    def __init__(self, archive_dir=DEFAULT_ARCHIVE_DIR, segment_bytes=SEGMENT_BYTES):
+        os.makedirs(archive_dir, exist_ok=True)
+        self.archive_dir = archive_dir
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.pages = 0
+        self.bytes_written = 0
+        numbers = segment_numbers(archive_dir)
+        self.segment = numbers[-1] if numbers else 0
+        self.data_file = self.index_file = None
+        self._next_segment()
+
+    def _next_segment(self):
+        self.close()
+        self.segment += 1
+        data_path, index_path = segment_paths(self.archive_dir, self.segment)
+        self.data_file = open(data_path, 'ab')
+        self.index_file = open(index_path, 'a')
+
+    def append(self, run_id, store_id, category_id, category_name, page, body, fetched_at=None):
+        """Store one raw response body (bytes) for a category page"""
+        fetched_at = fetched_at or datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        # Compress outside the lock so workers only serialize on the write
+        member = gzip.compress(body, compresslevel=6)
+        with self.lock:
+            if self.data_file.tell() + len(member) > self.segment_bytes and self.data_file.tell():
+                self._next_segment()
+            offset = self.data_file.tell()
+            self.data_file.write(member)
+            self.data_file.flush()
+            # The index line goes last: a page is only visible once its bytes are on disk
+            self.index_file.write(json.dumps({
+                'run_id': run_id,
+                'store_id': store_id,
+                'category_id': str(category_id),
+                'category_name': category_name,
+                'page': page,
+                'fetched_at': fetched_at,
+                'offset': offset,
+                'length': len(member),
+            }) + "\n")
+            self.index_file.flush()
+            self.pages += 1
+            self.bytes_written += len(member)
+
+    def close(self):
+        for f in (self.data_file, self.index_file):
+            if f is not None:
+                f.close()
+        self.data_file = self.index_file = None
+
+def read_index(archive_dir=DEFAULT_ARCHIVE_DIR, run_ids=None, store_id=None, category_ids=None):
+    """Archived pages matching the filters, oldest first, each with its segment number"""
+    entries = []
+    for number in segment_numbers(archive_dir):
+        with open(segment_paths(archive_dir, number)[1]) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if run_ids and entry['run_id'] not in run_ids:
+                    continue
+                if store_id is not None and entry['store_id'] != store_id:
+                    continue
+                if category_ids and entry['category_id'] not in category_ids:
+                    continue
+                entry['segment'] = number
+                entries.append(entry)
+    entries.sort(key=lambda entry: (entry['fetched_at'], entry['segment'], entry['offset']))
+    return entries
+
+def read_page(archive_dir, entry):
+    """Raw response body of one index entry"""
+    with open(segment_paths(archive_dir, entry['segment'])[0], 'rb') as f:
+        f.seek(entry['offset'])
+        return gzip.decompress(f.read(entry['length']))
+
+def parse_page(job):
+    """Decompress and parse one archived page into product_info dicts (runs in a worker process)"""
+    import scrape2
+    archive_dir, entry = job
+    data = json.loads(read_page(archive_dir, entry))
+    browse_data = (data.get('data') or {}).get('browseCategory')
+    if not browse_data:
+        return entry, []
+    return entry, [scrape2.extract_product_info(product, entry['category_id'],
+                                                entry['category_name'], entry['store_id'])
+                   for product in browse_data['records']]
+
+def create_replay_table(conn):
+    """replayed_pages: the archived pages a database has been replayed from"""
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS replayed_pages (
+                run_id INTEGER NOT NULL,
+                store_id INTEGER NOT NULL,
+                category_id TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                fetched_at TIMESTAMP NOT NULL,
+                replayed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (run_id, store_id, category_id, page, fetched_at)
+            )
+        ''')
+
+def page_key(entry):
+    return (entry['run_id'], entry['store_id'], entry['category_id'], entry['page'], entry['fetched_at'])
+
+def already_ingested(entry, checkpoint_pages, replayed):
+    """
+    True if the database already holds the page: the crawl that archived it
+    checkpointed past it, or an earlier replay wrote it.
+    """
+    next_page = checkpoint_pages.get((entry['run_id'], entry['store_id'], entry['category_id']), 1)
+    return entry['page'] < next_page or page_key(entry) in replayed
+
+def replay(db_path, archive_dir=DEFAULT_ARCHIVE_DIR, run_ids=None, store_id=None,
+           category_ids=None, workers=1, history_mode='compact', force=False):
+    """
+    Re-ingest archived pages into db_path in fetch order.
+
+    Decompression, JSON decoding and extraction run in `workers`
+    processes; a single writer applies the pages in order, each with its
+    original fetch time. Pages already in the database are skipped unless
+    `force`. Returns (pages, products).
+    """
+    import scrape2
+    entries = read_index(archive_dir, run_ids, store_id, category_ids)
+    if not entries:
+        return 0, 0
+
+    conn = scrape2.create_database(db_path)
+    create_replay_table(conn)
+    if not force:
+        checkpoint_pages = {
+            (run_id, checkpoint_store, category_id): page
+            for run_id, checkpoint_store, category_id, page in conn.execute(
+                'SELECT run_id, store_id, category_id, page FROM crawl_checkpoints')
+        }
+        replayed = {tuple(row) for row in conn.execute(
+            'SELECT run_id, store_id, category_id, page, fetched_at FROM replayed_pages')}
+        remaining = [entry for entry in entries
+                     if not already_ingested(entry, checkpoint_pages, replayed)]
+        if len(remaining) < len(entries):
+            print(f"Skipping {len(entries) - len(remaining)} pages already in {db_path} "
+                  f"(--force to replay them anyway)")
+        entries = remaining
+        if not entries:
+            conn.close()
+            return 0, 0
+
+    newest = conn.execute('SELECT MAX(last_seen) FROM product_price_summary').fetchone()[0]
+    out_of_order = newest is not None and entries[0]['fetched_at'] < newest
+    if out_of_order:
+        print(f"Database already has prices up to {newest}, newer than the archived pages; "
+              f"price intervals may be split, the summary, price changes and rollups "
+              f"will be rebuilt")
+
+    catalog = scrape2.ProductCatalog.load(conn)
+    jobs = [(archive_dir, entry) for entry in entries]
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    pages = products = 0
+    try:
+        results = executor.map(parse_page, jobs, chunksize=16) if executor else map(parse_page, jobs)
+        for entry, product_infos in results:
+            # price_change events keep the run that fetched the page
+            catalog.run_id = entry['run_id']
+            written = scrape2.insert_products_batch(conn, product_infos, history_mode,
+                                                    catalog=catalog,
+                                                    recorded_at=entry['fetched_at'])
+            if product_infos and not written:
+                continue
+            with conn:
+                conn.execute('''
+                    INSERT OR IGNORE INTO replayed_pages (run_id, store_id, category_id, page, fetched_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', page_key(entry))
+            products += written
+            pages += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if out_of_order:
+        scrape2.rebuild_price_summary(conn)
+        scrape2.rebuild_price_changes(conn)
+    scrape2.refresh_rollups(conn, full=out_of_order)
+    conn.close()
+    return pages, products
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or re-ingest archived GraphQL responses")
+    parser.add_argument('--archive', default=DEFAULT_ARCHIVE_DIR, help="archive directory")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    sub.add_parser('list', help="archived pages per crawl run")
+
+    p = sub.add_parser('replay', help="re-ingest archived pages into a database")
+    p.add_argument('--db', default='heb_products.db', help="SQLite database path")
+    p.add_argument('--run', type=int, action='append', default=[], help="crawl run id (repeatable)")
+    p.add_argument('--store', type=int, default=None)
+    p.add_argument('--category', action='append', default=[], help="category id (repeatable)")
+    p.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                   help="processes decoding pages")
+    p.add_argument('--history-mode', choices=['compact', 'full'], default='compact')
+    p.add_argument('--force', action='store_true',
+                   help="also replay pages the database already holds")
+
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        runs = defaultdict(lambda: {'pages': 0, 'bytes': 0, 'first': None, 'last': None})
+        for entry in read_index(args.archive):
+            run = runs[entry['run_id']]
+            run['pages'] += 1
+            run['bytes'] += entry['length']
+            run['first'] = run['first'] or entry['fetched_at']
+            run['last'] = entry['fetched_at']
+        if not runs:
+            print(f"No archived pages in {args.archive}")
+        for run_id, run in sorted(runs.items(), key=lambda item: item[1]['first']):
+            print(f"run {run_id}: {run['pages']} pages, {run['bytes'] / 1e6:.1f} MB "
+                  f"({run['first']} .. {run['last']})")
+
+    elif args.command == 'replay':
+        started = time.perf_counter()
+        pages, products = replay(args.db, args.archive, set(args.run), args.store,
+                                 set(args.category), args.workers, args.history_mode, args.force)
+        print(f"Replayed {pages} pages ({products} products) into {args.db} "
+              f"in {time.perf_counter() - started:.1f}s")
+
+if __name__ == "__main__":
+    main()
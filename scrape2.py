@@ -1,21 +1,365 @@
 print("Test 1: Starting")
-import pandas as pd
+import os
 import requests
 from requests.sessions import Session
 import time
-from datetime import datetime
+import argparse
+import json
+import queue
+import random
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import sqlite3
 from sqlite3 import Error
+from basket import create_basket_tables
+from crawl_metrics import CrawlMetrics, ProgressLine
+from response_archive import ResponseArchive
 print("Test 2: All imports successful")
 
+# GraphQL request headers
+HEADERS = {
+    'Content-Type': 'application/json',
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'application/json',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Origin': 'https://www.heb.com',
+    'Referer': 'https://www.heb.com/'
+}
 
+URL = 'https://www.heb.com/graphql'
 
-def create_database():
+HOME_URL = 'https://www.heb.com/'  # fetched to warm up a session's cookies
+
+QUERY = """
+query {
+    browseCategory(
+        categoryId: "%s"
+        storeId: %s
+        shoppingContext: CURBSIDE_PICKUP
+        limit: 50
+        %s
+    ) {
+        pageTitle
+        records {
+            id
+            displayName
+            brand {
+                name
+                isOwnBrand
+            }
+            SKUs {
+                id
+                contextPrices {
+                    listPrice {
+                        formattedAmount
+                    }
+                }
+            }
+        }
+        total
+        hasMoreRecords
+        nextCursor
+    }
+}
+"""
+
+# Category tree discovery: the category's size and its direct subcategories.
+# limit: 1 keeps the response small; only total and subCategories are used.
+CATEGORY_QUERY = """
+query {
+    browseCategory(
+        categoryId: "%s"
+        storeId: %s
+        shoppingContext: CURBSIDE_PICKUP
+        limit: 1
+    ) {
+        pageTitle
+        total
+        subCategories {
+            id
+            displayName
+        }
+    }
+}
+"""
+
+MAX_PAGES = 100  # Increased from 20 to 100
+
+PAGE_LIMIT = 50  # records per page, the `limit` in QUERY
+
+# A category with more products than this is truncated by MAX_PAGES, so
+# discovery crawls its subcategories instead
+CATEGORY_CAPACITY = MAX_PAGES * PAGE_LIMIT
+
+DISCOVERY_MAX_AGE = 7 * 24 * 3600  # seconds before a discovered category is re-checked
+
+DEFAULT_STORE_ID = 793  # the only store crawled before prices were keyed by store
+
+SESSION_MAX_AGE = 30 * 60  # seconds before a pooled session is re-warmed
+
+SESSION_SETUP_ATTEMPTS = 3  # homepage warm-ups tried before a session setup fails
+
+PIPELINE_QUEUE_SIZE = 8  # pages buffered between fetchers, parser and writer
+
+# Responses that mean our cookies were rejected rather than the request
+SESSION_REJECTED_STATUSES = (401, 403)
+
+# Responses that mean "slow down": back off and retry the same page
+THROTTLED_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Thread-safe token bucket shared by every crawl worker.
+
+    Tokens refill at `rate` per second up to `capacity`. Each request to
+    heb.com takes one token, so the whole crawl never exceeds the budget
+    no matter how many workers are running.
+    """
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.last_refill
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        """Block until a token is available, then take it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop handing out tokens to all workers for `seconds` (e.g. after a 429)"""
+        with self.lock:
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = 0
+            self.last_refill = self.paused_until
+
+    def set_rate(self, rate):
+        """Change the refill rate, keeping the tokens earned at the old rate"""
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.paused_until:
+                self._refill(now)
+            self.rate = float(rate)
+
+
+class AdaptiveThrottle:
+    """
+    AIMD request throttle on top of a shared TokenBucket.
+
+    Every healthy response raises the rate by `increase` requests/sec (up
+    to `max_rate`) while latency stays close to the best seen; a 429 or 5xx
+    multiplies it by `decrease` (down to `min_rate`) and pauses all workers,
+    for the server's Retry-After when it sends one or else for an
+    exponential backoff with jitter. The rate is cut once per congestion
+    event: responses throttled while the pause is on, or within one
+    latency window of the last cut, come from requests already in flight
+    and only extend the pause.
+    """
+
+    def __init__(self, rate, min_rate=0.05, max_rate=4.0, increase=0.05, decrease=0.5,
+                 burst=None, backoff_base=2.0, backoff_cap=120.0, max_retries=5):
+        self.bucket = TokenBucket(rate, burst)
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.max_retries = max_retries
+        self.latency_ewma = None
+        self.best_latency = None
+        self.successes = 0
+        self.throttled = 0
+        self.decreases = 0
+        self.last_decrease = None
+        self.lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def acquire(self):
+        """Block until the current rate allows another request"""
+        self.bucket.acquire()
+
+    def pause(self, seconds):
+        self.bucket.pause(seconds)
+
+    def on_success(self, latency):
+        """Additive increase, held back while responses are getting slower"""
+        with self.lock:
+            self.successes += 1
+            if self.latency_ewma is None:
+                self.latency_ewma = latency
+            else:
+                self.latency_ewma = 0.8 * self.latency_ewma + 0.2 * latency
+            if self.best_latency is None or latency < self.best_latency:
+                self.best_latency = latency
+            if self.latency_ewma <= 2 * self.best_latency:
+                self.bucket.set_rate(min(self.max_rate, self.rate + self.increase))
+
+    def on_throttled(self, attempt, retry_after=None):
+        """
+        Multiplicative decrease and a pause for every worker.
+
+        `attempt` counts consecutive throttled tries of the same request.
+        Returns the number of seconds paused.
+        """
+        with self.lock:
+            self.throttled += 1
+            now = time.monotonic()
+            window = self.latency_ewma if self.latency_ewma is not None else 1.0
+            same_event = (now < self.bucket.paused_until or
+                          (self.last_decrease is not None and now - self.last_decrease < window))
+            if not same_event:
+                self.decreases += 1
+                self.last_decrease = now
+                self.bucket.set_rate(max(self.min_rate, self.rate * self.decrease))
+        if retry_after is not None:
+            delay = retry_after
+        else:
+            delay = self.backoff_delay(attempt)
+        self.bucket.pause(delay)
+        return delay
+
+    def backoff_delay(self, attempt):
+        """Exponential backoff with equal jitter, capped at `backoff_cap`"""
+        delay = min(self.backoff_cap, self.backoff_base * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date), or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+PRICE_HISTORY_SCHEMA = f'''(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    product_id TEXT NOT NULL,
+    price DECIMAL(10,2) NOT NULL,
+    recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_seen TIMESTAMP,
+    observations INTEGER NOT NULL DEFAULT 1,
+    store_id INTEGER NOT NULL DEFAULT {DEFAULT_STORE_ID},
+    FOREIGN KEY (product_id) REFERENCES products(product_id)
+)'''
+
+# v2 layout (scrape2.py --migrate-v2): integer product keys (products.id),
+# prices in cents and UTC unix-second timestamps, clustered by product,
+# store and start time. Intervals are unique on that key.
+PRICE_HISTORY_V2_SCHEMA = '''(
+    product_key INTEGER NOT NULL,
+    store_id INTEGER NOT NULL,
+    recorded_at INTEGER NOT NULL,
+    last_seen INTEGER NOT NULL,
+    price_cents INTEGER NOT NULL,
+    observations INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (product_key, store_id, recorded_at)
+) WITHOUT ROWID'''
+
+# Read view with the v1 price_history columns, so the reports work on
+# either layout. The start time stands in for the old row id (it is
+# unique per product and store), and the raw columns are exposed for
+# range filters that should use price_history_v2's index.
+PRICE_HISTORY_V2_VIEW = '''
+    CREATE VIEW price_history AS
+    SELECT
+        ph.recorded_at AS id,
+        p.product_id,
+        ph.price_cents / 100.0 AS price,
+        datetime(ph.recorded_at, 'unixepoch') AS recorded_at,
+        datetime(ph.last_seen, 'unixepoch') AS last_seen,
+        ph.observations,
+        ph.store_id,
+        ph.product_key,
+        ph.price_cents,
+        ph.recorded_at AS recorded_epoch,
+        ph.last_seen AS last_seen_epoch
+    FROM price_history_v2 ph
+    JOIN products p ON p.id = ph.product_key
+'''
+
+def price_history_version(conn):
+    """2 once the database has been migrated to price_history_v2, else 1"""
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'price_history_v2'").fetchone()
+    return 2 if row else 1
+
+def to_epoch(timestamp):
+    """Unix seconds of a 'YYYY-MM-DD HH:MM:SS' UTC timestamp"""
+    return int(datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp())
+
+def create_price_history_indexes(c):
+    """
+    Index price_history for per-product and per-store access.
+
+    (product_id, store_id, recorded_at) serves the latest-interval lookup on
+    ingest and one product across stores; (store_id, recorded_at) serves
+    time-range scans of a single store and (recorded_at) the incremental
+    rollup refresh across all stores.
+    """
+    index_columns = [row[2] for row in c.execute("PRAGMA index_info('idx_price_history')")]
+    if index_columns and 'store_id' not in index_columns:
+        c.execute('DROP INDEX idx_price_history')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_price_history ON price_history(product_id, store_id, recorded_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_price_history_store ON price_history(store_id, recorded_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_price_history_recorded ON price_history(recorded_at)')
+
+def configure_connection(conn):
+    """
+    Switch the connection to WAL with relaxed syncing and a bigger page cache.
+
+    WAL lets readers (the report scripts) run while the scraper writes, and
+    synchronous=NORMAL only fsyncs at checkpoints, which is safe in WAL mode.
+    """
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-64000')  # ~64MB
+    conn.execute('PRAGMA temp_store=MEMORY')
+
+def create_database(db_path='heb_products.db', check_same_thread=True):
     """Create SQLite database and tables with proper indexes"""
     try:
-        conn = sqlite3.connect('heb_products.db')
+        conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
+        configure_connection(conn)
         c = conn.cursor()
-        
+
         # Create main products table
         c.execute('''
             CREATE TABLE IF NOT EXISTS products (
@@ -30,24 +374,220 @@ def create_database():
                 date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        
-        # Create price history table
+
+        # Create price history table. Each row is a price interval: the price
+        # was first seen at recorded_at, last seen at last_seen and observed
+        # `observations` times in between. A row written in full mode is an
+        # interval with a single observation. Migrated databases keep their
+        # intervals in price_history_v2 behind a price_history view instead.
+        history_v1 = price_history_version(conn) == 1
+        if history_v1:
+            c.execute('CREATE TABLE IF NOT EXISTS price_history ' + PRICE_HISTORY_SCHEMA)
+
+            # Upgrade databases created before price intervals and stores existed
+            columns = [row[1] for row in c.execute('PRAGMA table_info(price_history)')]
+            if 'last_seen' not in columns:
+                c.execute('ALTER TABLE price_history ADD COLUMN last_seen TIMESTAMP')
+            if 'observations' not in columns:
+                c.execute('ALTER TABLE price_history ADD COLUMN observations INTEGER NOT NULL DEFAULT 1')
+            if 'store_id' not in columns:
+                c.execute(f'ALTER TABLE price_history ADD COLUMN store_id INTEGER NOT NULL DEFAULT {DEFAULT_STORE_ID}')
+            c.execute('UPDATE price_history SET last_seen = recorded_at WHERE last_seen IS NULL')
+
+        # price_change events written at ingest, one per price that differs
+        # from the product's last known price in that store
         c.execute('''
-            CREATE TABLE IF NOT EXISTS price_history (
+            CREATE TABLE IF NOT EXISTS price_changes (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 product_id TEXT NOT NULL,
-                price DECIMAL(10,2) NOT NULL,
-                recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (product_id) REFERENCES products(product_id)
+                store_id INTEGER NOT NULL,
+                category_name TEXT,
+                old_price DECIMAL(10,2) NOT NULL,
+                new_price DECIMAL(10,2) NOT NULL,
+                delta DECIMAL(10,2) NOT NULL,
+                percent_change REAL,
+                changed_at TIMESTAMP NOT NULL,
+                run_id INTEGER
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_price_changes_time ON price_changes(changed_at)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_price_changes_store ON price_changes(store_id, changed_at)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_price_changes_product ON price_changes(product_id, store_id, changed_at)')
+
+        # Audit trail of catalog metadata changes, one row per changed field
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS product_changes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id TEXT NOT NULL,
+                field TEXT NOT NULL,
+                old_value TEXT,
+                new_value TEXT,
+                changed_at TIMESTAMP NOT NULL,
+                FOREIGN KEY (product_id) REFERENCES products (product_id)
             )
         ''')
-        
+        c.execute('CREATE INDEX IF NOT EXISTS idx_product_changes_product ON product_changes(product_id, changed_at)')
+
         # Create indexes for faster querying
         c.execute('CREATE INDEX IF NOT EXISTS idx_product_id ON products(product_id)')
         c.execute('CREATE INDEX IF NOT EXISTS idx_category ON products(category_id)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_price_history ON price_history(product_id, recorded_at)')
-        
+        if history_v1:
+            create_price_history_indexes(c)
+
+        # Per-product, per-store first/last/min/max price, kept up to date at
+        # ingest time so the reports don't have to rescan price_history
+        summary_columns = [row[1] for row in c.execute('PRAGMA table_info(product_price_summary)')]
+        if summary_columns and 'store_id' not in summary_columns:
+            # Derived data: drop it and let the rebuild below key it by store
+            c.execute('DROP TABLE product_price_summary')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS product_price_summary (
+                product_id TEXT NOT NULL,
+                store_id INTEGER NOT NULL,
+                first_price DECIMAL(10,2) NOT NULL,
+                first_seen TIMESTAMP NOT NULL,
+                last_price DECIMAL(10,2) NOT NULL,
+                last_seen TIMESTAMP NOT NULL,
+                min_price DECIMAL(10,2) NOT NULL,
+                max_price DECIMAL(10,2) NOT NULL,
+                distinct_prices INTEGER NOT NULL,
+                record_count INTEGER NOT NULL,
+                PRIMARY KEY (product_id, store_id),
+                FOREIGN KEY (product_id) REFERENCES products(product_id)
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_price_summary_store ON product_price_summary(store_id)')
+
+        # Crawl runs and per-category checkpoints, written after every page
+        # so an interrupted crawl can be resumed where it stopped
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS crawl_runs (
+                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP,
+                status TEXT NOT NULL DEFAULT 'running'
+            )
+        ''')
+        checkpoint_columns = [row[1] for row in c.execute('PRAGMA table_info(crawl_checkpoints)')]
+        if checkpoint_columns and 'store_id' not in checkpoint_columns:
+            c.execute('ALTER TABLE crawl_checkpoints RENAME TO crawl_checkpoints_old')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS crawl_checkpoints (
+                run_id INTEGER NOT NULL,
+                store_id INTEGER NOT NULL,
+                category_id TEXT NOT NULL,
+                next_cursor TEXT NOT NULL DEFAULT '',
+                page INTEGER NOT NULL DEFAULT 1,
+                products INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL DEFAULT 'in_progress',
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (run_id, store_id, category_id),
+                FOREIGN KEY (run_id) REFERENCES crawl_runs(run_id)
+            )
+        ''')
+        if checkpoint_columns and 'store_id' not in checkpoint_columns:
+            c.execute(f'''
+                INSERT INTO crawl_checkpoints
+                    (run_id, store_id, category_id, next_cursor, page, products, status, updated_at)
+                SELECT run_id, {DEFAULT_STORE_ID}, category_id, next_cursor, page, products, status, updated_at
+                FROM crawl_checkpoints_old
+            ''')
+            c.execute('DROP TABLE crawl_checkpoints_old')
+
+        # Daily and monthly price rollups per product and per category, kept
+        # current by refresh_rollups from a high-water mark on last_seen
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS daily_product_prices (
+                day TEXT NOT NULL,
+                store_id INTEGER NOT NULL,
+                product_id TEXT NOT NULL,
+                avg_price REAL NOT NULL,
+                PRIMARY KEY (day, store_id, product_id)
+            ) WITHOUT ROWID
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS monthly_product_prices (
+                year_month TEXT NOT NULL,
+                store_id INTEGER NOT NULL,
+                product_id TEXT NOT NULL,
+                price_sum REAL NOT NULL,
+                observations INTEGER NOT NULL,
+                PRIMARY KEY (year_month, store_id, product_id)
+            ) WITHOUT ROWID
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS daily_category_prices (
+                day TEXT NOT NULL,
+                store_id INTEGER NOT NULL,
+                category_name TEXT NOT NULL,
+                avg_price REAL NOT NULL,
+                num_products INTEGER NOT NULL,
+                PRIMARY KEY (day, store_id, category_name)
+            ) WITHOUT ROWID
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS monthly_category_prices (
+                year_month TEXT NOT NULL,
+                store_id INTEGER NOT NULL,
+                category_name TEXT NOT NULL,
+                avg_price REAL NOT NULL,
+                num_products INTEGER NOT NULL,
+                PRIMARY KEY (year_month, store_id, category_name)
+            ) WITHOUT ROWID
+        ''')
+        # Categories to crawl, copied from the spreadsheet whenever its mtime changes
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS categories (
+                position INTEGER PRIMARY KEY,
+                category_id INTEGER NOT NULL UNIQUE,
+                category_name TEXT NOT NULL
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS category_sources (
+                path TEXT PRIMARY KEY,
+                mtime REAL NOT NULL,
+                synced_at TIMESTAMP
+            )
+        ''')
+
+        # Category tree found by --discover: parent/child links, product
+        # totals and when each node was last fetched
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS category_tree (
+                category_id TEXT PRIMARY KEY,
+                parent_id TEXT,
+                category_name TEXT,
+                depth INTEGER NOT NULL DEFAULT 0,
+                total INTEGER,
+                num_children INTEGER NOT NULL DEFAULT 0,
+                active INTEGER NOT NULL DEFAULT 1,
+                first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                checked_at REAL
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_category_tree_parent ON category_tree(parent_id)')
+
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS rollup_state (
+                name TEXT PRIMARY KEY,
+                high_water TIMESTAMP
+            )
+        ''')
+
         conn.commit()
+
+        # Basket definitions and the full-text index on product names
+        create_basket_tables(conn)
+
+        # Fill the summary for databases that already have history
+        summary_empty = c.execute('SELECT NOT EXISTS (SELECT 1 FROM product_price_summary)').fetchone()[0]
+        history_empty = c.execute('SELECT NOT EXISTS (SELECT 1 FROM price_history)').fetchone()[0]
+        if summary_empty and not history_empty:
+            rebuild_price_summary(conn)
+        if not history_empty and get_rollup_high_water(conn) is None:
+            refresh_rollups(conn)
+
         return conn
     except Error as e:
         print(f"Database error: {e}")
@@ -60,31 +600,694 @@ def validate_price(price_str):
     except (ValueError, AttributeError):
         return None
 
-def get_fresh_session():
+def get_fresh_session(rate_limiter=None):
     """Create a new session with fresh cookies for each request"""
     session = Session()
-    
+
     headers = {
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
         'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
         'Accept-Language': 'en-US,en;q=0.9'
     }
-    
-    session.get('https://www.heb.com/', headers=headers)
-    time.sleep(2)
+
+    if rate_limiter is not None:
+        rate_limiter.acquire()
+    session.get(HOME_URL, headers=headers)
+    if rate_limiter is None:
+        time.sleep(2)
     return session
 
-def insert_or_update_product(conn, product_info):
-    """Insert or update product and price information"""
-    cursor = conn.cursor()
-    try:
-        # Try to insert new product
-        cursor.execute('''
-            INSERT OR IGNORE INTO products 
-            (category_id, category_name, product_id, product_name, 
-             brand_name, is_own_brand, sku_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
+def write_price_history(conn, prices, recorded_at, history_mode='compact'):
+    """
+    Record (product_id, store_id, price) observations taken at `recorded_at`.
+
+    In 'full' mode every observation gets its own row. In 'compact' mode an
+    observation that matches the product's latest interval only extends that
+    interval, and a new row is written when the price changes. Intervals are
+    closed at month boundaries so monthly averages stay exact.
+    """
+    if price_history_version(conn) == 2:
+        write_price_history_v2(conn, prices, recorded_at, history_mode)
+        return
+
+    if history_mode == 'full':
+        conn.executemany('''
+            INSERT INTO price_history (product_id, store_id, price, recorded_at, last_seen)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(product_id, store_id, price, recorded_at, recorded_at)
+              for product_id, store_id, price in prices])
+        return
+
+    extend_rows = []
+    insert_rows = []
+    for product_id, store_id, price in prices:
+        latest = conn.execute('''
+            SELECT id, price, recorded_at
+            FROM price_history
+            WHERE product_id = ? AND store_id = ?
+            ORDER BY recorded_at DESC, id DESC
+            LIMIT 1
+        ''', (product_id, store_id)).fetchone()
+        if latest is not None and latest[1] == price and latest[2][:7] == recorded_at[:7]:
+            extend_rows.append((recorded_at, latest[0]))
+        else:
+            insert_rows.append((product_id, store_id, price, recorded_at, recorded_at))
+
+    conn.executemany('''
+        UPDATE price_history
+        SET last_seen = ?, observations = observations + 1
+        WHERE id = ?
+    ''', extend_rows)
+    conn.executemany('''
+        INSERT INTO price_history (product_id, store_id, price, recorded_at, last_seen)
+        VALUES (?, ?, ?, ?, ?)
+    ''', insert_rows)
+
+def write_price_history_v2(conn, prices, recorded_at, history_mode='compact'):
+    """write_price_history for the v2 layout; products must already be in products"""
+    product_ids = list({product_id for product_id, _, _ in prices})
+    keys = {}
+    for first in range(0, len(product_ids), 500):
+        chunk = product_ids[first:first + 500]
+        keys.update(conn.execute(
+            f"SELECT product_id, id FROM products WHERE product_id IN ({', '.join('?' * len(chunk))})",
+            chunk).fetchall())
+    missing = sum(1 for product_id, _, _ in prices if product_id not in keys)
+    if missing:
+        print(f"Skipping {missing} prices of products missing from the catalog")
+    epoch = to_epoch(recorded_at)
+
+    extend_rows = []
+    insert_rows = []
+    for product_id, store_id, price in prices:
+        product_key = keys.get(product_id)
+        if product_key is None:
+            continue
+        price_cents = round(price * 100)
+        latest = None
+        if history_mode != 'full':
+            latest = conn.execute('''
+                SELECT recorded_at, price_cents
+                FROM price_history_v2
+                WHERE product_key = ? AND store_id = ?
+                ORDER BY recorded_at DESC
+                LIMIT 1
+            ''', (product_key, store_id)).fetchone()
+        if (latest is not None and latest[1] == price_cents
+                and datetime.fromtimestamp(latest[0], timezone.utc).strftime('%Y-%m') == recorded_at[:7]):
+            extend_rows.append((epoch, product_key, store_id, latest[0]))
+        else:
+            insert_rows.append((product_key, store_id, epoch, epoch, price_cents))
+
+    conn.executemany('''
+        UPDATE price_history_v2
+        SET last_seen = ?, observations = observations + 1
+        WHERE product_key = ? AND store_id = ? AND recorded_at = ?
+    ''', extend_rows)
+    # Seen twice within the same second (e.g. listed in two categories):
+    # one interval with the latest price
+    conn.executemany('''
+        INSERT INTO price_history_v2 (product_key, store_id, recorded_at, last_seen, price_cents)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(product_key, store_id, recorded_at) DO UPDATE SET
+            last_seen = MAX(last_seen, excluded.last_seen),
+            observations = observations + 1,
+            price_cents = excluded.price_cents
+    ''', insert_rows)
+
+def migrate_price_history_v2(conn):
+    """
+    Move price_history into the v2 layout (one-shot migration).
+
+    Intervals are copied to price_history_v2 keyed by products.id, with
+    prices in cents and unix-second timestamps, and price_history becomes
+    a read view over it. Prices of products missing from products are
+    dropped. Returns (rows before, rows after, bytes before, bytes after).
+    """
+    def database_bytes():
+        return (conn.execute('PRAGMA page_count').fetchone()[0]
+                * conn.execute('PRAGMA page_size').fetchone()[0])
+
+    before = conn.execute('SELECT COUNT(*) FROM price_history').fetchone()[0]
+    bytes_before = database_bytes()
+    with conn:
+        conn.execute('CREATE TABLE price_history_v2 ' + PRICE_HISTORY_V2_SCHEMA)
+        conn.execute('''
+            INSERT INTO price_history_v2
+                (product_key, store_id, recorded_at, last_seen, price_cents, observations)
+            SELECT
+                p.id,
+                ph.store_id,
+                CAST(strftime('%s', ph.recorded_at) AS INTEGER),
+                CAST(strftime('%s', COALESCE(ph.last_seen, ph.recorded_at)) AS INTEGER),
+                CAST(ROUND(ph.price * 100) AS INTEGER),
+                ph.observations
+            FROM price_history ph
+            JOIN products p ON p.product_id = ph.product_id
+            WHERE true
+            ORDER BY 1, 2, 3, ph.id
+            ON CONFLICT(product_key, store_id, recorded_at) DO UPDATE SET
+                last_seen = MAX(last_seen, excluded.last_seen),
+                observations = observations + excluded.observations,
+                price_cents = excluded.price_cents
+        ''')
+        conn.execute('DROP TABLE price_history')
+        conn.execute(PRICE_HISTORY_V2_VIEW)
+        # Rollup refreshes and exports filter on last_seen
+        conn.execute('CREATE INDEX idx_price_history_v2_last_seen ON price_history_v2(last_seen)')
+    conn.execute('VACUUM')
+    after = conn.execute('SELECT COUNT(*) FROM price_history_v2').fetchone()[0]
+    return before, after, bytes_before, database_bytes()
+
+def compress_price_history(conn):
+    """
+    Merge runs of unchanged prices into intervals (one-shot migration).
+
+    Consecutive rows of a product in a store with the same price in the
+    same month become one row spanning first to last observation. Returns the number
+    of rows before and after.
+    """
+    before = conn.execute('SELECT COUNT(*) FROM price_history').fetchone()[0]
+    with conn:
+        conn.execute('DROP TABLE IF EXISTS price_history_compact')
+        conn.execute('CREATE TABLE price_history_compact ' + PRICE_HISTORY_SCHEMA)
+        conn.execute('''
+            INSERT INTO price_history_compact
+                (id, product_id, store_id, price, recorded_at, last_seen, observations)
+            WITH ordered AS (
+                SELECT
+                    id, product_id, store_id, price, recorded_at,
+                    COALESCE(last_seen, recorded_at) AS last_seen,
+                    observations,
+                    strftime('%Y-%m', recorded_at) AS year_month,
+                    LAG(price) OVER w AS prev_price,
+                    LAG(strftime('%Y-%m', recorded_at)) OVER w AS prev_year_month
+                FROM price_history
+                WINDOW w AS (PARTITION BY product_id, store_id ORDER BY recorded_at, id)
+            ),
+            runs AS (
+                SELECT
+                    *,
+                    SUM(CASE WHEN price = prev_price AND year_month = prev_year_month
+                             THEN 0 ELSE 1 END)
+                        OVER (PARTITION BY product_id, store_id ORDER BY recorded_at, id) AS run_id
+                FROM ordered
+            )
+            SELECT MIN(id), product_id, store_id, price, MIN(recorded_at), MAX(last_seen), SUM(observations)
+            FROM runs
+            GROUP BY product_id, store_id, run_id
+        ''')
+        conn.execute('DROP TABLE price_history')
+        conn.execute('ALTER TABLE price_history_compact RENAME TO price_history')
+        create_price_history_indexes(conn.cursor())
+    conn.execute('VACUUM')
+    after = conn.execute('SELECT COUNT(*) FROM price_history').fetchone()[0]
+    return before, after
+
+def update_price_summary(conn, prices, recorded_at, last_prices=None):
+    """
+    Fold (product_id, store_id, price) observations into product_price_summary.
+
+    Must run before the observations are written to price_history, so the
+    distinct-price check only sees earlier prices. With `last_prices`
+    ({(product_id, store_id): last_price}, see ProductCatalog) a price equal
+    to the last one only moves last_seen and the count, skipping the
+    distinct-price lookup.
+    """
+    if last_prices is not None:
+        unchanged = [(recorded_at, product_id, store_id)
+                     for product_id, store_id, price in prices
+                     if last_prices.get((product_id, store_id)) == price]
+        conn.executemany('''
+            UPDATE product_price_summary
+            SET last_seen = ?, record_count = record_count + 1
+            WHERE product_id = ? AND store_id = ?
+        ''', unchanged)
+        prices = [(product_id, store_id, price)
+                  for product_id, store_id, price in prices
+                  if last_prices.get((product_id, store_id)) != price]
+
+    conn.executemany('''
+        INSERT INTO product_price_summary
+            (product_id, store_id, first_price, first_seen, last_price, last_seen,
+             min_price, max_price, distinct_prices, record_count)
+        VALUES (:product_id, :store_id, :price, :recorded_at, :price, :recorded_at,
+                :price, :price, 1, 1)
+        ON CONFLICT(product_id, store_id) DO UPDATE SET
+            last_price = excluded.last_price,
+            last_seen = excluded.last_seen,
+            min_price = MIN(min_price, excluded.min_price),
+            max_price = MAX(max_price, excluded.max_price),
+            distinct_prices = distinct_prices + (NOT EXISTS (
+                SELECT 1 FROM price_history ph
+                WHERE ph.product_id = excluded.product_id
+                  AND ph.store_id = excluded.store_id
+                  AND ph.price = excluded.last_price
+            )),
+            record_count = record_count + 1
+    ''', [
+        {'product_id': product_id, 'store_id': store_id, 'price': price, 'recorded_at': recorded_at}
+        for product_id, store_id, price in prices
+    ])
+
+def rebuild_price_summary(conn):
+    """Recompute product_price_summary from scratch out of price_history"""
+    with conn:
+        conn.execute('DELETE FROM product_price_summary')
+        conn.execute('''
+            INSERT INTO product_price_summary
+                (product_id, store_id, first_price, first_seen, last_price, last_seen,
+                 min_price, max_price, distinct_prices, record_count)
+            WITH ranked AS (
+                SELECT
+                    product_id, store_id, price, recorded_at, last_seen, observations,
+                    ROW_NUMBER() OVER (PARTITION BY product_id, store_id
+                                       ORDER BY recorded_at, id) AS first_rank,
+                    ROW_NUMBER() OVER (PARTITION BY product_id, store_id
+                                       ORDER BY last_seen DESC, id DESC) AS last_rank
+                FROM price_history
+            )
+            SELECT
+                product_id,
+                store_id,
+                MAX(CASE WHEN first_rank = 1 THEN price END),
+                MIN(recorded_at),
+                MAX(CASE WHEN last_rank = 1 THEN price END),
+                MAX(last_seen),
+                MIN(price),
+                MAX(price),
+                COUNT(DISTINCT price),
+                SUM(observations)
+            FROM ranked
+            GROUP BY product_id, store_id
+        ''')
+    return conn.execute('SELECT COUNT(*) FROM product_price_summary').fetchone()[0]
+
+def get_rollup_high_water(conn):
+    """Latest last_seen already folded into the rollups, or None"""
+    row = conn.execute("SELECT high_water FROM rollup_state WHERE name = 'price_rollups'").fetchone()
+    return row[0] if row else None
+
+def refresh_rollups(conn, full=False):
+    """
+    Bring the daily/monthly product and category rollups up to date.
+
+    Only days from the high-water mark's day onwards (and their months) are
+    recomputed, so a refresh costs the same however long the history is.
+    The high-water day itself is always redone: it may have been partial,
+    and a later run can write in the same second. An interval extended
+    across missed crawls also covers days before the high-water day, so
+    the refresh starts at the earliest interval touched since then; that
+    is never before the high-water month. A product's daily price is the average of the price intervals covering
+    that day; the monthly price is weighted by observations, matching the
+    monthly trend computed from price_history. `full` rebuilds everything.
+    Returns the first day that was recomputed, or None if nothing changed.
+    """
+    if price_history_version(conn) == 2:
+        # Filter on the raw epoch columns so price_history_v2's index is used
+        new_high_water = conn.execute(
+            "SELECT datetime(MAX(last_seen), 'unixepoch') FROM price_history_v2").fetchone()[0]
+        touched_query = '''
+            SELECT date(MIN(recorded_at), 'unixepoch') FROM price_history_v2
+            WHERE last_seen > CAST(strftime('%s', :high_water) AS INTEGER)
+        '''
+        span_filter = ("recorded_epoch >= CAST(strftime('%s', :month_start) AS INTEGER) "
+                       "AND last_seen_epoch >= CAST(strftime('%s', :start_day) AS INTEGER)")
+        month_filter = "recorded_epoch >= CAST(strftime('%s', :month_start) AS INTEGER)"
+    else:
+        new_high_water = conn.execute('SELECT MAX(last_seen) FROM price_history').fetchone()[0]
+        touched_query = '''
+            SELECT date(MIN(recorded_at)) FROM price_history
+            WHERE recorded_at >= :month_start AND last_seen > :high_water
+        '''
+        span_filter = "recorded_at >= :month_start AND last_seen >= :start_day"
+        month_filter = "recorded_at >= :month_start"
+    high_water = None if full else get_rollup_high_water(conn)
+    if new_high_water is None or (high_water is not None and high_water > new_high_water):
+        return None
+
+    if high_water is None:
+        start_day = conn.execute('SELECT date(MIN(recorded_at)) FROM price_history').fetchone()[0]
+    else:
+        touched = conn.execute(touched_query, {'high_water': high_water,
+                                               'month_start': high_water[:7] + '-01'}).fetchone()[0]
+        start_day = min(high_water[:10], touched or high_water[:10])
+    # Price intervals never span months, so every interval touching
+    # start_day or later was first seen in start_day's month or later
+    month_start = start_day[:7] + '-01'
+
+    with conn:
+        conn.execute('DELETE FROM daily_product_prices WHERE day >= ?', (start_day,))
+        conn.execute(f'''
+            INSERT INTO daily_product_prices (day, store_id, product_id, avg_price)
+            WITH RECURSIVE span(store_id, product_id, price, day, last_day) AS (
+                SELECT store_id, product_id, price,
+                       MAX(date(recorded_at), :start_day), date(last_seen)
+                FROM price_history
+                WHERE {span_filter}
+                UNION ALL
+                SELECT store_id, product_id, price, date(day, '+1 day'), last_day
+                FROM span
+                WHERE day < last_day
+            )
+            SELECT day, store_id, product_id, AVG(price)
+            FROM span
+            GROUP BY day, store_id, product_id
+        ''', {'start_day': start_day, 'month_start': month_start})
+
+        conn.execute('DELETE FROM monthly_product_prices WHERE year_month >= ?', (start_day[:7],))
+        conn.execute(f'''
+            INSERT INTO monthly_product_prices
+                (year_month, store_id, product_id, price_sum, observations)
+            SELECT strftime('%Y-%m', recorded_at), store_id, product_id,
+                   SUM(price * observations), SUM(observations)
+            FROM price_history
+            WHERE {month_filter}
+            GROUP BY 1, 2, 3
+        ''', {'month_start': month_start})
+
+        conn.execute('DELETE FROM daily_category_prices WHERE day >= ?', (start_day,))
+        conn.execute('''
+            INSERT INTO daily_category_prices (day, store_id, category_name, avg_price, num_products)
+            SELECT d.day, d.store_id, p.category_name, AVG(d.avg_price), COUNT(*)
+            FROM daily_product_prices d
+            JOIN products p ON p.product_id = d.product_id
+            WHERE d.day >= ?
+            GROUP BY d.day, d.store_id, p.category_name
+        ''', (start_day,))
+
+        conn.execute('DELETE FROM monthly_category_prices WHERE year_month >= ?', (start_day[:7],))
+        conn.execute('''
+            INSERT INTO monthly_category_prices
+                (year_month, store_id, category_name, avg_price, num_products)
+            SELECT m.year_month, m.store_id, p.category_name,
+                   AVG(m.price_sum / m.observations), COUNT(*)
+            FROM monthly_product_prices m
+            JOIN products p ON p.product_id = m.product_id
+            WHERE m.year_month >= ?
+            GROUP BY m.year_month, m.store_id, p.category_name
+        ''', (start_day[:7],))
+
+        conn.execute('''
+            INSERT INTO rollup_state (name, high_water) VALUES ('price_rollups', ?)
+            ON CONFLICT(name) DO UPDATE SET high_water = excluded.high_water
+        ''', (new_high_water,))
+    return start_day
+
+# Rollup tables and their columns as compared by check_rollups, with the
+# averages rounded so a different summation order does not count as a difference
+ROLLUP_COLUMNS = {
+    'daily_product_prices': 'day, store_id, product_id, ROUND(avg_price, 6)',
+    'monthly_product_prices': 'year_month, store_id, product_id, ROUND(price_sum, 6), observations',
+    'daily_category_prices': 'day, store_id, category_name, ROUND(avg_price, 6), num_products',
+    'monthly_category_prices': 'year_month, store_id, category_name, ROUND(avg_price, 6), num_products',
+}
+
+def check_rollups(conn):
+    """
+    Compare the incrementally refreshed rollups with a full rebuild, done
+    on a scratch copy of the database so the rollups themselves are left
+    alone. Returns {table: number of rows that differ}.
+    """
+    with tempfile.TemporaryDirectory() as scratch:
+        path = os.path.join(scratch, 'rollups.db')
+        copy = sqlite3.connect(path)
+        conn.backup(copy)
+        refresh_rollups(copy, full=True)
+        copy.close()
+        conn.execute('ATTACH DATABASE ? AS rebuilt', (path,))
+        try:
+            differences = {}
+            for table, columns in ROLLUP_COLUMNS.items():
+                differences[table] = conn.execute(f'''
+                    SELECT
+                        (SELECT COUNT(*) FROM (SELECT {columns} FROM main.{table}
+                                               EXCEPT SELECT {columns} FROM rebuilt.{table}))
+                      + (SELECT COUNT(*) FROM (SELECT {columns} FROM rebuilt.{table}
+                                               EXCEPT SELECT {columns} FROM main.{table}))
+                ''').fetchone()[0]
+        finally:
+            conn.execute('DETACH DATABASE rebuilt')
+    return differences
+
+def start_crawl_run(conn, resume=False):
+    """
+    Return the run id to crawl under.
+
+    With `resume` the latest unfinished run is picked up again; otherwise
+    (or when every run finished) a new run is started.
+    """
+    if resume:
+        row = conn.execute('''
+            SELECT run_id FROM crawl_runs
+            WHERE status != 'done'
+            ORDER BY run_id DESC
+            LIMIT 1
+        ''').fetchone()
+        if row is not None:
+            with conn:
+                conn.execute("UPDATE crawl_runs SET status = 'running' WHERE run_id = ?", (row[0],))
+            return row[0], True
+
+    with conn:
+        cursor = conn.execute("INSERT INTO crawl_runs (status) VALUES ('running')")
+    return cursor.lastrowid, False
+
+def register_categories(conn, run_id, jobs):
+    """Give every (store, category) of the run a checkpoint so unfinished ones are visible"""
+    with conn:
+        conn.executemany('''
+            INSERT OR IGNORE INTO crawl_checkpoints (run_id, store_id, category_id)
+            VALUES (?, ?, ?)
+        ''', [(run_id, store_id, str(category_id)) for store_id, category_id, _ in jobs])
+
+def finish_crawl_run(conn, run_id):
+    """Mark the run done if every category finished, otherwise leave it resumable"""
+    unfinished = conn.execute('''
+        SELECT COUNT(*) FROM crawl_checkpoints
+        WHERE run_id = ? AND status != 'done'
+    ''', (run_id,)).fetchone()[0]
+    status = 'done' if unfinished == 0 else 'incomplete'
+    with conn:
+        conn.execute('''
+            UPDATE crawl_runs SET status = ?, finished_at = CURRENT_TIMESTAMP
+            WHERE run_id = ?
+        ''', (status, run_id))
+    return status
+
+def load_checkpoint(conn, run_id, store_id, category_id):
+    """Return (next_cursor, page, products, status) saved for a store's category, or None"""
+    return conn.execute('''
+        SELECT next_cursor, page, products, status FROM crawl_checkpoints
+        WHERE run_id = ? AND store_id = ? AND category_id = ?
+    ''', (run_id, store_id, str(category_id))).fetchone()
+
+def save_checkpoint(conn, checkpoint):
+    """
+    Upsert a category's crawl position without committing.
+
+    `checkpoint` holds run_id, store_id, category_id, next_cursor, page,
+    products and status. Callers write it in the same transaction as the page it follows,
+    so a resumed crawl never stores a page twice.
+    """
+    conn.execute('''
+        INSERT INTO crawl_checkpoints
+            (run_id, store_id, category_id, next_cursor, page, products, status, updated_at)
+        VALUES (:run_id, :store_id, :category_id, :next_cursor, :page, :products, :status,
+                CURRENT_TIMESTAMP)
+        ON CONFLICT(run_id, store_id, category_id) DO UPDATE SET
+            next_cursor = excluded.next_cursor,
+            page = excluded.page,
+            products = excluded.products,
+            status = excluded.status,
+            updated_at = excluded.updated_at
+    ''', {**checkpoint, 'category_id': str(checkpoint['category_id'])})
+
+CATALOG_FIELDS = ('product_name', 'brand_name', 'is_own_brand', 'sku_id')
+
+class ProductCatalog:
+    """
+    In-memory copy of the catalog: product_id -> hash of its metadata, and
+    (product_id, store_id) -> last price.
+
+    Loaded once per crawl, it lets a page be sorted without touching the
+    database: unknown products are inserted, products whose name, brand or
+    SKU changed are updated (with a row per changed field in
+    product_changes), and unchanged products skip the catalog write. A
+    product keeps the category it was first found in, so products listed
+    in several categories are not seen as changing. A price that differs
+    from the last one becomes a price_change event (see price_changes),
+    tagged with `run_id` and also written as a JSON line to `event_stream`
+    when given. Not thread-safe on its own; use it under the crawl's DB
+    lock.
+    """
+
+    def __init__(self, metadata_hashes=None, last_prices=None, run_id=None, event_stream=None):
+        self.metadata_hashes = metadata_hashes or {}
+        self.last_prices = last_prices or {}
+        self.run_id = run_id
+        self.event_stream = event_stream
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.price_changes = 0
+
+    @classmethod
+    def load(cls, conn, run_id=None, event_stream=None):
+        metadata_hashes = {
+            row[0]: hash(row[1:])
+            for row in conn.execute(f"SELECT product_id, {', '.join(CATALOG_FIELDS)} FROM products")
+        }
+        last_prices = {
+            (product_id, store_id): price
+            for product_id, store_id, price in conn.execute(
+                'SELECT product_id, store_id, last_price FROM product_price_summary')
+        }
+        return cls(metadata_hashes, last_prices, run_id, event_stream)
+
+    def plan(self, product_infos):
+        """Split a page into (new products, changed products, {product_id: metadata hash})"""
+        new, changed, hashes = [], [], {}
+        for product_info in product_infos:
+            product_id = product_info['product_id']
+            if product_id in hashes:
+                continue
+            metadata_hash = hash(tuple(product_info[field] for field in CATALOG_FIELDS))
+            known = self.metadata_hashes.get(product_id)
+            if known is None:
+                new.append(product_info)
+            elif known != metadata_hash:
+                changed.append(product_info)
+            hashes[product_id] = metadata_hash
+        return new, changed, hashes
+
+    def detect_price_changes(self, prices, categories, changed_at):
+        """price_change events for the (product_id, store_id, price) observations that moved"""
+        events = []
+        latest = {}
+        for product_id, store_id, price in prices:
+            key = (product_id, store_id)
+            old_price = latest.get(key, self.last_prices.get(key))
+            latest[key] = price
+            if old_price is None or old_price == price:
+                continue
+            events.append({
+                'event': 'price_change',
+                'product_id': product_id,
+                'store_id': store_id,
+                'category_name': categories.get(product_id),
+                'old_price': old_price,
+                'new_price': price,
+                'delta': round(price - old_price, 2),
+                'percent_change': (price - old_price) / old_price * 100 if old_price else None,
+                'changed_at': changed_at,
+                'run_id': self.run_id,
+            })
+        return events
+
+    def commit(self, new, changed, hashes, prices, events=()):
+        """Apply a batch to the cache once its transaction has committed"""
+        self.inserted += len(new)
+        self.updated += len(changed)
+        self.unchanged += len(hashes) - len(new) - len(changed)
+        self.metadata_hashes.update(hashes)
+        for product_id, store_id, price in prices:
+            self.last_prices[(product_id, store_id)] = price
+        self.price_changes += len(events)
+        if self.event_stream is not None and events:
+            self.event_stream.write(''.join(json.dumps(event) + "\n" for event in events))
+            self.event_stream.flush()
+
+def write_price_changes(conn, events):
+    conn.executemany('''
+        INSERT INTO price_changes
+            (product_id, store_id, category_name, old_price, new_price, delta,
+             percent_change, changed_at, run_id)
+        VALUES (:product_id, :store_id, :category_name, :old_price, :new_price, :delta,
+                :percent_change, :changed_at, :run_id)
+    ''', events)
+
+def rebuild_price_changes(conn):
+    """
+    Recompute price_changes from price_history (one-shot backfill).
+
+    Every interval whose price differs from the previous interval of the
+    same product and store is a change at its recorded_at. Backfilled
+    events have no run_id. Returns the number of events.
+    """
+    with conn:
+        conn.execute('DELETE FROM price_changes')
+        conn.execute('''
+            INSERT INTO price_changes
+                (product_id, store_id, category_name, old_price, new_price, delta,
+                 percent_change, changed_at)
+            WITH ordered AS (
+                SELECT
+                    product_id, store_id, price, recorded_at,
+                    LAG(price) OVER (PARTITION BY product_id, store_id
+                                     ORDER BY recorded_at, id) AS old_price
+                FROM price_history
+            )
+            SELECT
+                o.product_id, o.store_id, p.category_name, o.old_price, o.price,
+                ROUND(o.price - o.old_price, 2),
+                CASE WHEN o.old_price != 0 THEN (o.price - o.old_price) * 100.0 / o.old_price END,
+                o.recorded_at
+            FROM ordered o
+            LEFT JOIN products p ON p.product_id = o.product_id
+            WHERE o.old_price IS NOT NULL AND o.price != o.old_price
+            ORDER BY o.recorded_at
+        ''')
+    return conn.execute('SELECT COUNT(*) FROM price_changes').fetchone()[0]
+
+def update_changed_products(conn, product_infos, changed_at):
+    """Update the metadata of existing products and record each changed field"""
+    changes = []
+    for product_info in product_infos:
+        old = conn.execute(f"SELECT {', '.join(CATALOG_FIELDS)} FROM products WHERE product_id = ?",
+                           (product_info['product_id'],)).fetchone()
+        for field, old_value in zip(CATALOG_FIELDS, old or ()):
+            if old_value != product_info[field]:
+                changes.append((product_info['product_id'], field, old_value,
+                                product_info[field], changed_at))
+    conn.executemany('''
+        INSERT INTO product_changes (product_id, field, old_value, new_value, changed_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', changes)
+    conn.executemany(f'''
+        UPDATE products SET {', '.join(f'{field} = ?' for field in CATALOG_FIELDS)}
+        WHERE product_id = ?
+    ''', [tuple(product_info[field] for field in CATALOG_FIELDS) + (product_info['product_id'],)
+          for product_info in product_infos])
+
+def insert_products_batch(conn, product_infos, history_mode='compact', checkpoint=None, catalog=None,
+                          recorded_at=None):
+    """
+    Insert a page of products and their prices in a single transaction.
+
+    Both tables are written with executemany, so a whole GraphQL page costs
+    one commit instead of one per product. If anything fails the batch is
+    rolled back on its own and earlier batches stay committed. A crawl
+    checkpoint, when given, is committed together with the page. With a
+    ProductCatalog only new or changed products are written to products,
+    and prices that moved are recorded as price_change events.
+    `recorded_at` defaults to now; replays pass the page's fetch time.
+    Returns the number of products written (0 on failure).
+    """
+    if not product_infos:
+        if checkpoint is not None:
+            with conn:
+                save_checkpoint(conn, checkpoint)
+        return 0
+
+    changed = []
+    events = []
+    if catalog is not None:
+        new_products, changed, hashes = catalog.plan(product_infos)
+    else:
+        new_products = product_infos
+    product_rows = [
+        (
             product_info['category_id'],
             product_info['category_name'],
             product_info['product_id'],
@@ -92,194 +1295,1039 @@ def insert_or_update_product(conn, product_info):
             product_info['brand_name'],
             product_info['is_own_brand'],
             product_info['sku_id']
-        ))
-        
-        # Insert price history
+        )
+        for product_info in new_products
+    ]
+    prices = []
+    for product_info in product_infos:
         price = validate_price(product_info['price'])
         if price is not None:
-            cursor.execute('''
-                INSERT INTO price_history (product_id, price)
-                VALUES (?, ?)
-            ''', (product_info['product_id'], price))
-        
-        conn.commit()
-        return True
+            prices.append((product_info['product_id'], product_info['store_id'], price))
+
+    # Same format as CURRENT_TIMESTAMP, so old and new rows sort together
+    recorded_at = recorded_at or datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    if catalog is not None:
+        events = catalog.detect_price_changes(
+            prices, {product_info['product_id']: product_info['category_name']
+                     for product_info in product_infos},
+            recorded_at)
+
+    try:
+        with conn:
+            conn.executemany('''
+                INSERT OR IGNORE INTO products
+                (category_id, category_name, product_id, product_name,
+                 brand_name, is_own_brand, sku_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', product_rows)
+            if changed:
+                update_changed_products(conn, changed, recorded_at)
+            update_price_summary(conn, prices, recorded_at,
+                                 catalog.last_prices if catalog is not None else None)
+            write_price_history(conn, prices, recorded_at, history_mode)
+            write_price_changes(conn, events)
+            if checkpoint is not None:
+                save_checkpoint(conn, {**checkpoint, 'products': checkpoint['products'] + len(product_infos)})
+        if catalog is not None:
+            catalog.commit(new_products, changed, hashes, prices, events)
+        return len(product_infos)
     except Error as e:
-        print(f"Error inserting/updating product {product_info['product_id']}: {e}")
-        conn.rollback()
-        return False
+        first_id = product_infos[0]['product_id']
+        print(f"Error inserting batch of {len(product_infos)} products starting at {first_id}: {e}")
+        return 0
 
-try:
-    start_time = datetime.now()
-    
-    # Initialize database
-    conn = create_database()
-    if conn is None:
-        raise Exception("Failed to create database connection")
-    
-    # Read Excel
-    df = pd.read_excel('categoryid.xlsx')
-    total_categories = len(df)
-    print(f"Test 3: Read Excel file with {total_categories} rows")
-    
-    # GraphQL request headers
-    headers = {
-        'Content-Type': 'application/json',
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Accept': 'application/json',
-        'Accept-Language': 'en-US,en;q=0.9',
-        'Origin': 'https://www.heb.com',
-        'Referer': 'https://www.heb.com/'
-    }
-    
-    url = 'https://www.heb.com/graphql'
-    successful = 0
-    failed = 0
-    products_processed = 0
-    
-    for index, row in df.iterrows():
-        category_start_time = datetime.now()
-        print(f"\nProcessing category {index + 1}/{total_categories}: {row.categoryID} - {row.CATEGORY}")
-        
-        session = get_fresh_session()
-        
-        query = """
-        query {
-            browseCategory(
-                categoryId: "%s"
-                storeId: 793
-                shoppingContext: CURBSIDE_PICKUP
-                limit: 50
-                %s
-            ) {
-                pageTitle
-                records {
-                    id
-                    displayName
-                    brand {
-                        name
-                        isOwnBrand
-                    }
-                    SKUs {
-                        id
-                        contextPrices {
-                            listPrice {
-                                formattedAmount
-                            }
-                        }
-                    }
-                }
-                total
-                hasMoreRecords
-                nextCursor
-            }
-        }
-        """
-        
+class SessionPool:
+    """
+    Fixed-size pool of warmed-up, long-lived HTTP sessions.
+
+    A session is created (homepage GET for cookies) the first time it is
+    needed and then reused, keeping its cookies and keep-alive connections.
+    It is only re-warmed once it is older than `max_age` or after the
+    server rejects it. Warm-ups are timed as the 'session_setup' stage and
+    tried SESSION_SETUP_ATTEMPTS times. A warm-up that still fails is
+    raised to the caller without losing the pool slot: a new slot is given
+    back, and an entry that failed to refresh stays in the pool marked
+    expired, so the next acquire() warms it again.
+    """
+
+    def __init__(self, size, rate_limiter=None, max_age=SESSION_MAX_AGE, metrics=None):
+        self.size = size
+        self.rate_limiter = rate_limiter
+        self.max_age = max_age
+        self.metrics = metrics or CrawlMetrics()
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.refreshes = 0
+
+    def _new_entry(self):
+        for attempt in range(1, SESSION_SETUP_ATTEMPTS + 1):
+            try:
+                with self.metrics.timer('session_setup'):
+                    session = get_fresh_session(self.rate_limiter)
+                return {'session': session, 'created_at': time.monotonic()}
+            except requests.RequestException as e:
+                self.metrics.inc('session_setup_errors')
+                if attempt == SESSION_SETUP_ATTEMPTS:
+                    raise
+                print(f"Session warm-up failed ({e}), retrying "
+                      f"(attempt {attempt}/{SESSION_SETUP_ATTEMPTS})")
+                time.sleep(2 ** attempt)
+
+    def acquire(self):
+        """Take a session out of the pool, creating one if the pool isn't full yet"""
+        with self.lock:
+            can_create = self.created < self.size and self.idle.empty()
+            if can_create:
+                self.created += 1
+        if can_create:
+            try:
+                entry = self._new_entry()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+            self.metrics.inc('sessions_created')
+            return entry
+
+        entry = self.idle.get()
+        if time.monotonic() - entry['created_at'] > self.max_age:
+            try:
+                return self.refresh(entry)
+            except Exception:
+                self.release(entry)
+                raise
+        return entry
+
+    def release(self, entry):
+        """Hand a session back for the next category"""
+        self.idle.put(entry)
+
+    def refresh(self, entry):
+        """Replace an expired or rejected session with a freshly warmed one, in place"""
+        entry['session'].close()
+        with self.lock:
+            self.refreshes += 1
+        self.metrics.inc('session_refreshes')
         try:
-            has_more = True
-            cursor = ""
-            category_products = 0
-            page = 1
-            max_pages = 100  # Increased from 20 to 100
-            
-            while has_more and page <= max_pages:
-                page_start_time = datetime.now()
-                print(f"  Processing page {page}/{max_pages}")
-                current_query = query % (str(row.categoryID), f'cursor: "{cursor}"' if cursor else '')
-                
-                response = session.post(url,
-                                      json={'query': current_query},
-                                      headers=headers)
-                
-                if response.status_code == 200:
+            entry.update(self._new_entry())
+        except Exception:
+            entry['created_at'] = float('-inf')
+            raise
+        return entry
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get()['session'].close()
+
+class PagePipeline:
+    """
+    Parse and write stages behind the fetching threads.
+
+    Fetchers submit decoded browseCategory pages and go straight on to the
+    next request. A parser thread turns the records into product_info dicts
+    and a single writer thread, the only one writing to the connection,
+    stores each page together with its checkpoint, in submission order.
+    Both hand-offs are bounded queues, so fetchers block (timed as
+    'pipeline_backpressure') when the writer falls behind. A page that
+    fails to parse or to be stored fails its category at that page, and
+    the category's later pages are dropped; any other error in a stage stops
+    the pipeline and is raised to the fetchers on their next submit and
+    from close(). The connection must allow use from other threads
+    (check_same_thread=False); `db_lock` guards it for fetchers reading
+    checkpoints.
+    """
+
+    def __init__(self, conn, db_lock=None, history_mode='compact', catalog=None,
+                 metrics=None, queue_size=PIPELINE_QUEUE_SIZE):
+        self.conn = conn
+        self.db_lock = db_lock or threading.Lock()
+        self.history_mode = history_mode
+        self.catalog = catalog
+        self.metrics = metrics or CrawlMetrics()
+        self.parse_queue = queue.Queue(queue_size)
+        self.write_queue = queue.Queue(queue_size)
+        self.error = None
+        self.failed_categories = set()
+        self.write_failed = set()
+        self.products_written = 0
+        self.threads = [threading.Thread(target=self._run_parser, name='page-parser', daemon=True),
+                        threading.Thread(target=self._run_writer, name='page-writer', daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def check(self):
+        """Raise the error that stopped the pipeline, if any"""
+        if self.error is not None:
+            raise RuntimeError(f"crawl pipeline stopped: {self.error!r}") from self.error
+
+    def _put(self, item):
+        self.check()
+        with self.metrics.timer('pipeline_backpressure'):
+            self.parse_queue.put(item)
+
+    def submit_page(self, records, category_id, category_name, store_id, checkpoint=None,
+                    cursor=None, page=1, products=0):
+        """
+        Queue a page's records. `cursor`, `page` and `products` describe the
+        request that returned it, for the failed checkpoint if it can't be parsed.
+        """
+        self._put(('page', records, category_id, category_name, store_id, checkpoint,
+                   cursor, page, products))
+
+    def category_failed(self, store_id, category_id):
+        return (store_id, category_id) in self.failed_categories
+
+    def submit_failure(self, run_id, store_id, category_id, cursor, page, products):
+        """Queue a failed-category checkpoint behind the category's pending pages"""
+        self._put(('failed', run_id, store_id, category_id, cursor, page, products))
+
+    def _run_parser(self):
+        while True:
+            item = self.parse_queue.get()
+            if item is None:
+                self.write_queue.put(None)
+                return
+            if self.error is not None or item[0] != 'page':
+                self.write_queue.put(item)
+                continue
+            _, records, category_id, category_name, store_id, checkpoint, cursor, page, products = item
+            if (store_id, category_id) in self.failed_categories:
+                continue
+            try:
+                with self.metrics.timer('parse'):
+                    product_infos = [extract_product_info(product, category_id, category_name, store_id)
+                                     for product in records]
+            except Exception as e:
+                print(f"  [{store_id}:{category_id}] Could not parse page {page}: {e!r}")
+                self.metrics.inc('parse_errors')
+                self.failed_categories.add((store_id, category_id))
+                if checkpoint is not None:
+                    self.write_queue.put(('failed', checkpoint['run_id'], store_id, category_id,
+                                          cursor, page, products))
+                continue
+            self.write_queue.put(('batch', product_infos, checkpoint, store_id, category_id,
+                                  cursor, page, products))
+
+    def _run_writer(self):
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue  # keep draining so blocked fetchers can see the error
+            try:
+                self._write(item)
+            except Exception as e:
+                self.error = e
+
+    def _write(self, item):
+        if item[0] == 'failed':
+            # A category stopped by a failed write keeps that page's checkpoint
+            if item[2:4] not in self.write_failed:
+                mark_category_failed(self.conn, self.db_lock, *item[1:])
+            return
+        _, product_infos, checkpoint, store_id, category_id, cursor, page, products = item
+        if (store_id, category_id) in self.write_failed:
+            return
+        lock_wait_start = time.monotonic()
+        with self.db_lock:
+            self.metrics.observe('db_lock_wait', time.monotonic() - lock_wait_start)
+            with self.metrics.timer('db_write'):
+                written = insert_products_batch(self.conn, product_infos, self.history_mode,
+                                                checkpoint, self.catalog)
+        self.products_written += written
+        self.metrics.inc('products', written)
+        if product_infos and not written:
+            # The page and its checkpoint were rolled back; retry it on --resume
+            print(f"  [{store_id}:{category_id}] Stopping: page {page} could not be stored")
+            self.metrics.inc('failed_inserts', len(product_infos))
+            self.write_failed.add((store_id, category_id))
+            self.failed_categories.add((store_id, category_id))
+            if checkpoint is not None:
+                mark_category_failed(self.conn, self.db_lock, checkpoint['run_id'], store_id,
+                                     category_id, cursor, page, products)
+
+    def close(self):
+        """Wait for every queued page to be written, then raise any stage error"""
+        self.parse_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.check()
+
+def insert_or_update_product(conn, product_info):
+    """Insert or update product and price information"""
+    return insert_products_batch(conn, [product_info]) == 1
+
+def extract_product_info(product, category_id, category_name, store_id=DEFAULT_STORE_ID):
+    """Flatten a browseCategory record into the dict stored in the database"""
+    return {
+        'store_id': store_id,
+        'category_id': category_id,
+        'category_name': category_name,
+        'product_id': product['id'],
+        'product_name': product['displayName'],
+        'brand_name': product['brand']['name'] if product['brand'] else 'N/A',
+        'is_own_brand': product['brand']['isOwnBrand'] if product['brand'] else 'N/A',
+        'sku_id': product['SKUs'][0]['id'] if product['SKUs'] else 'N/A',
+        'price': product['SKUs'][0]['contextPrices'][0]['listPrice']['formattedAmount'] if product['SKUs'] else 'N/A'
+    }
+
+def crawl_category(conn, category_id, category_name, throttle=None, db_lock=None,
+                   history_mode='compact', run_id=None, session_pool=None,
+                   store_id=DEFAULT_STORE_ID, metrics=None, catalog=None, archive=None,
+                   pipeline=None):
+    """
+    Crawl every page of one category in one store and store its products.
+
+    Every request waits on the shared AdaptiveThrottle instead of a fixed
+    delay, and reports its latency or 429/5xx back to it. A throttled page
+    is retried up to `throttle.max_retries` times before the category fails.
+    With a run_id the category's position is checkpointed after each page
+    and a saved checkpoint is picked up where it stopped. Sessions come
+    from `session_pool` when given, otherwise a fresh one is made.
+    Each stage (throttle wait, HTTP, JSON decoding, parsing, DB lock wait
+    and write) is timed into `metrics`, with counters for requests,
+    statuses, retries and failed inserts. A shared ProductCatalog skips
+    catalog writes for products that have not changed, and a
+    ResponseArchive keeps every raw page for offline replay. With a
+    PagePipeline pages are only fetched and decoded here; parsing and
+    writing happen on the pipeline's threads while the next page is
+    requested, and the count returned is of products handed over.
+    Returns (products written by this call, whether the category finished
+    without failing); products restored from a checkpoint are not counted.
+    """
+    label = f"[{store_id}:{category_id}]"
+    db_lock = db_lock or nullcontext()
+    metrics = metrics or CrawlMetrics()
+
+    has_more = True
+    cursor = ""
+    category_products = 0
+    written = 0
+    failed = False
+    page = 1
+
+    if run_id is not None:
+        with db_lock:
+            saved = load_checkpoint(conn, run_id, store_id, category_id)
+        if saved is not None:
+            cursor, page, category_products, status = saved
+            if status == 'done':
+                print(f"  {label} Already finished in run {run_id}, skipping")
+                return 0, True
+            if page > 1:
+                print(f"  {label} Resuming run {run_id} at page {page}")
+
+    if pipeline is not None:
+        pipeline.check()
+    if throttle is None:
+        throttle = AdaptiveThrottle(0.5)
+    if session_pool is None:
+        session_pool = SessionPool(1, throttle, metrics=metrics)
+    entry = None
+    session_rejections = 0
+    throttled_attempts = 0
+
+    try:
+        entry = session_pool.acquire()
+        while has_more and page <= MAX_PAGES:
+            page_start_time = datetime.now()
+            print(f"  {label} Processing page {page}/{MAX_PAGES}")
+            current_query = QUERY % (str(category_id), int(store_id),
+                                     f'cursor: "{cursor}"' if cursor else '')
+
+            with metrics.timer('throttle_wait'):
+                throttle.acquire()
+            request_start = time.monotonic()
+            response = entry['session'].post(URL,
+                                             json={'query': current_query},
+                                             headers=HEADERS)
+            latency = time.monotonic() - request_start
+            metrics.observe('http', latency)
+            metrics.inc('requests')
+            metrics.inc(f'status_{response.status_code}')
+
+            if response.status_code == 200:
+                throttle.on_success(latency)
+                throttled_attempts = 0
+                if archive is not None:
+                    with metrics.timer('archive_write'):
+                        archive.append(run_id, store_id, category_id, category_name, page,
+                                       response.content)
+                with metrics.timer('json_decode'):
                     data = response.json()
-                    if 'data' in data and 'browseCategory' in data['data']:
-                        browse_data = data['data']['browseCategory']
-                        total_available = browse_data.get('total', 0)
-                        print(f"  Total available products in category: {total_available}")
-                        
-                        products = browse_data['records']
-                        
-                        successful_inserts = 0
-                        for product in products:
-                            product_info = {
-                                'category_id': row.categoryID,
-                                'category_name': row.CATEGORY,
-                                'product_id': product['id'],
-                                'product_name': product['displayName'],
-                                'brand_name': product['brand']['name'] if product['brand'] else 'N/A',
-                                'is_own_brand': product['brand']['isOwnBrand'] if product['brand'] else 'N/A',
-                                'sku_id': product['SKUs'][0]['id'] if product['SKUs'] else 'N/A',
-                                'price': product['SKUs'][0]['contextPrices'][0]['listPrice']['formattedAmount'] if product['SKUs'] else 'N/A'
-                            }
-                            
-                            if insert_or_update_product(conn, product_info):
-                                successful_inserts += 1
-                                products_processed += 1
-                        
-                        category_products += successful_inserts
-                        
-                        has_more = browse_data['hasMoreRecords']
-                        cursor = browse_data['nextCursor']
-                        
-                        page_duration = datetime.now() - page_start_time
-                        print(f"  Added {successful_inserts} products (Total in category: {category_products})")
-                        print(f"  Page {page} processing time: {page_duration}")
-                        
-                        page += 1
-                        if page <= max_pages:
-                            time.sleep(2)
+                if 'data' in data and 'browseCategory' in data['data']:
+                    browse_data = data['data']['browseCategory']
+                    total_available = browse_data.get('total', 0)
+                    print(f"  {label} Total available products in category: {total_available}")
+
+                    products = browse_data['records']
+                    request_cursor = cursor
+                    has_more = browse_data['hasMoreRecords']
+                    cursor = browse_data['nextCursor']
+
+                    checkpoint = None
+                    if run_id is not None:
+                        checkpoint = {
+                            'run_id': run_id,
+                            'store_id': store_id,
+                            'category_id': category_id,
+                            'next_cursor': cursor or '',
+                            'page': page + 1,
+                            'products': category_products,
+                            'status': 'in_progress' if has_more and page < MAX_PAGES else 'done'
+                        }
+
+                    if pipeline is not None:
+                        if pipeline.category_failed(store_id, category_id):
+                            print(f"  {label} Stopping: an earlier page could not be parsed or stored")
+                            failed = True
+                            break
+                        pipeline.submit_page(products, category_id, category_name, store_id,
+                                             checkpoint, request_cursor, page, category_products)
+                        successful_inserts = len(products)
+                        metrics.inc('pages')
                     else:
-                        print("No data in response")
-                        has_more = False
-                elif response.status_code == 429:  # Rate limited
-                    print("Rate limited, waiting 30 seconds...")
-                    time.sleep(30)
-                    continue
+                        with metrics.timer('parse'):
+                            product_infos = [extract_product_info(product, category_id, category_name, store_id)
+                                             for product in products]
+                        lock_wait_start = time.monotonic()
+                        with db_lock:
+                            metrics.observe('db_lock_wait', time.monotonic() - lock_wait_start)
+                            with metrics.timer('db_write'):
+                                successful_inserts = insert_products_batch(conn, product_infos, history_mode,
+                                                                           checkpoint, catalog)
+                        metrics.inc('pages')
+                        metrics.inc('products', successful_inserts)
+                        if product_infos and not successful_inserts:
+                            # The page and its checkpoint were rolled back; retry it on --resume
+                            metrics.inc('failed_inserts', len(product_infos))
+                            print(f"  {label} Stopping: page {page} could not be stored")
+                            fail_category(conn, db_lock, None, run_id, store_id, category_id,
+                                          request_cursor, page, category_products)
+                            failed = True
+                            break
+                    category_products += successful_inserts
+                    written += successful_inserts
+
+                    page_duration = datetime.now() - page_start_time
+                    metrics.observe('page', page_duration.total_seconds())
+                    print(f"  {label} {'Queued' if pipeline is not None else 'Added'} {successful_inserts} products "
+                          f"(Total in category: {category_products})")
+                    print(f"  {label} Page {page} processing time: {page_duration}")
+
+                    page += 1
                 else:
-                    print(f"Error response: {response.status_code}")
+                    print(f"  {label} No data in response")
+                    metrics.inc('empty_responses')
                     has_more = False
-            
+                    failed = True
+                    fail_category(conn, db_lock, pipeline, run_id, store_id, category_id,
+                                  cursor, page, category_products)
+            elif response.status_code in SESSION_REJECTED_STATUSES and session_rejections < 2:
+                session_rejections += 1
+                metrics.inc('session_rejections')
+                print(f"  {label} Session rejected ({response.status_code}), refreshing cookies...")
+                session_pool.refresh(entry)
+                continue
+            elif response.status_code in THROTTLED_STATUSES and throttled_attempts < throttle.max_retries:
+                throttled_attempts += 1
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                delay = throttle.on_throttled(throttled_attempts, retry_after)
+                metrics.inc('retries')
+                metrics.observe('backoff', delay)
+                print(f"  {label} Throttled ({response.status_code}), backing off {delay:.1f}s "
+                      f"(attempt {throttled_attempts}/{throttle.max_retries}, "
+                      f"rate now {throttle.rate:.2f} req/s)")
+                continue
+            else:
+                print(f"  {label} Error response: {response.status_code}")
+                metrics.inc('error_responses')
+                has_more = False
+                failed = True
+                fail_category(conn, db_lock, pipeline, run_id, store_id, category_id,
+                              cursor, page, category_products)
+    finally:
+        if entry is not None:
+            session_pool.release(entry)
+
+    return written, not failed
+
+def mark_category_failed(conn, db_lock, run_id, store_id, category_id, cursor, page, products):
+    """Checkpoint a category that stopped on a bad response so --resume retries it"""
+    if run_id is None:
+        return
+    with db_lock:
+        with conn:
+            save_checkpoint(conn, {
+                'run_id': run_id,
+                'store_id': store_id,
+                'category_id': category_id,
+                'next_cursor': cursor or '',
+                'page': page,
+                'products': products,
+                'status': 'failed'
+            })
+
+def fail_category(conn, db_lock, pipeline, run_id, store_id, category_id, cursor, page, products):
+    """mark_category_failed, queued behind the category's pages when they go through a pipeline"""
+    if pipeline is not None:
+        pipeline.submit_failure(run_id, store_id, category_id, cursor, page, products)
+    else:
+        mark_category_failed(conn, db_lock, run_id, store_id, category_id, cursor, page, products)
+
+def read_category_sheet(path):
+    """(categoryID, CATEGORY) rows of the category spreadsheet, in sheet order"""
+    # openpyxl is only needed when the sheet has changed since the last sync
+    from openpyxl import load_workbook
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(cell).strip() if cell is not None else '' for cell in next(rows)]
+        id_col, name_col = header.index('categoryID'), header.index('CATEGORY')
+        return [(row[id_col], row[name_col]) for row in rows
+                if row[id_col] is not None and row[name_col] is not None]
+    finally:
+        workbook.close()
+
+def sync_categories(conn, path='categoryid.xlsx'):
+    """
+    Copy the category spreadsheet into the categories table if it changed.
+
+    The sheet's mtime is remembered in category_sources, so an unchanged
+    sheet is never opened. Returns True if the table was rewritten.
+    """
+    if not os.path.exists(path):
+        return False
+    mtime = os.path.getmtime(path)
+    source = os.path.abspath(path)
+    row = conn.execute('SELECT mtime FROM category_sources WHERE path = ?', (source,)).fetchone()
+    if row is not None and row[0] == mtime:
+        return False
+
+    categories = read_category_sheet(path)
+    with conn:
+        conn.execute('DELETE FROM categories')
+        conn.executemany('INSERT OR REPLACE INTO categories (category_id, category_name, position) VALUES (?, ?, ?)',
+                         [(category_id, category_name, position)
+                          for position, (category_id, category_name) in enumerate(categories)])
+        conn.execute('''
+            INSERT INTO category_sources (path, mtime, synced_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(path) DO UPDATE SET mtime = excluded.mtime, synced_at = excluded.synced_at
+        ''', (source, mtime))
+    return True
+
+def load_categories(conn, path='categoryid.xlsx'):
+    """Return the (categoryID, CATEGORY) pairs to crawl, syncing the sheet first"""
+    if sync_categories(conn, path):
+        print(f"Synced categories from {path}")
+    return conn.execute('SELECT category_id, category_name FROM categories ORDER BY position').fetchall()
+
+def fetch_category_node(session_pool, throttle, category_id, store_id=DEFAULT_STORE_ID, metrics=None):
+    """
+    One CATEGORY_QUERY request: (name, total, [(child_id, child_name), ...]),
+    or None if the category could not be fetched. Throttled responses are
+    retried like crawl pages.
+    """
+    metrics = metrics or CrawlMetrics()
+    query = CATEGORY_QUERY % (str(category_id), int(store_id))
+    entry = None
+    try:
+        entry = session_pool.acquire()
+        for attempt in range(1, throttle.max_retries + 2):
+            with metrics.timer('throttle_wait'):
+                throttle.acquire()
+            request_start = time.monotonic()
+            response = entry['session'].post(URL, json={'query': query}, headers=HEADERS)
+            latency = time.monotonic() - request_start
+            metrics.observe('discovery_http', latency)
+            metrics.inc('discovery_requests')
+            metrics.inc(f'status_{response.status_code}')
+
+            if response.status_code == 200:
+                throttle.on_success(latency)
+                browse_data = (response.json().get('data') or {}).get('browseCategory')
+                if not browse_data:
+                    return None
+                children = [(str(child['id']), child.get('displayName'))
+                            for child in browse_data.get('subCategories') or []]
+                return browse_data.get('pageTitle'), browse_data.get('total'), children
+            if response.status_code in SESSION_REJECTED_STATUSES:
+                session_pool.refresh(entry)
+            elif response.status_code in THROTTLED_STATUSES and attempt <= throttle.max_retries:
+                metrics.inc('retries')
+                throttle.on_throttled(attempt, parse_retry_after(response.headers.get('Retry-After')))
+            else:
+                return None
+        return None
+    finally:
+        if entry is not None:
+            session_pool.release(entry)
+
+def discover_categories(conn, roots, throttle, session_pool, store_id=DEFAULT_STORE_ID,
+                        max_age=DISCOVERY_MAX_AGE, metrics=None):
+    """
+    Walk the category tree below `roots` ((category_id, name) pairs) and
+    store it in category_tree.
+
+    Nodes fetched less than `max_age` seconds ago are not requested again;
+    their cached children are walked instead, so a refresh only costs
+    requests for stale or new categories. Children that disappear from a
+    refetched parent are marked inactive. Returns (fetched, cached).
+    """
+    now = time.time()
+    fetched = cached = 0
+    pending = [(str(category_id), name, None, 0) for category_id, name in roots]
+    seen = set()
+
+    while pending:
+        category_id, name, parent_id, depth = pending.pop(0)
+        if category_id in seen:
+            continue
+        seen.add(category_id)
+
+        row = conn.execute('SELECT checked_at FROM category_tree WHERE category_id = ?',
+                           (category_id,)).fetchone()
+        if row is not None and row[0] is not None and now - row[0] < max_age:
+            cached += 1
+            children = conn.execute('''
+                SELECT category_id, category_name FROM category_tree
+                WHERE parent_id = ? AND active = 1
+                ORDER BY category_id
+            ''', (category_id,)).fetchall()
+        else:
+            node = fetch_category_node(session_pool, throttle, category_id, store_id, metrics)
+            if node is None:
+                print(f"  Could not fetch category {category_id} for discovery")
+                continue
+            fetched += 1
+            page_title, total, children = node
+            with conn:
+                conn.execute('''
+                    INSERT INTO category_tree
+                        (category_id, parent_id, category_name, depth, total, num_children, active, checked_at)
+                    VALUES (?, ?, ?, ?, ?, ?, 1, ?)
+                    ON CONFLICT(category_id) DO UPDATE SET
+                        parent_id = excluded.parent_id,
+                        category_name = COALESCE(excluded.category_name, category_name),
+                        depth = excluded.depth,
+                        total = excluded.total,
+                        num_children = excluded.num_children,
+                        active = 1,
+                        checked_at = excluded.checked_at
+                ''', (category_id, parent_id, name or page_title, depth, total, len(children), now))
+                child_ids = [child_id for child_id, _ in children]
+                conn.execute(f'''
+                    UPDATE category_tree SET active = 0
+                    WHERE parent_id = ? AND category_id NOT IN ({', '.join('?' * len(child_ids)) or "''"})
+                ''', [category_id] + child_ids)
+            print(f"  Discovered {category_id} ({name or page_title}): "
+                  f"{total} products, {len(children)} subcategories")
+
+        pending.extend((child_id, child_name, category_id, depth + 1)
+                       for child_id, child_name in children)
+
+    return fetched, cached
+
+def plan_categories(conn, roots, capacity=CATEGORY_CAPACITY):
+    """
+    The (category_id, name) pairs to crawl for `roots`: a category that
+    fits in MAX_PAGES pages is crawled whole, a bigger one is replaced by
+    its subcategories, recursively. An oversized leaf is still crawled,
+    with a warning that it will be truncated.
+    """
+    plan = []
+    pending = [(str(category_id), name) for category_id, name in roots]
+    while pending:
+        category_id, name = pending.pop(0)
+        row = conn.execute('SELECT category_name, total FROM category_tree WHERE category_id = ?',
+                           (category_id,)).fetchone()
+        total = row[1] if row else None
+        children = conn.execute('''
+            SELECT category_id, category_name FROM category_tree
+            WHERE parent_id = ? AND active = 1
+            ORDER BY category_id
+        ''', (category_id,)).fetchall()
+        if total is not None and total > capacity and children:
+            pending[:0] = children
+            continue
+        if total is not None and total > capacity:
+            print(f"  Warning: category {category_id} has {total} products but no subcategories; "
+                  f"only the first {capacity} will be crawled")
+        plan.append((category_id, name or (row[0] if row else None)))
+    return plan
+
+def build_jobs(stores, categories):
+    """Every (store_id, category_id, category_name) combination to crawl"""
+    return [(store_id, category_id, category_name)
+            for store_id in stores
+            for category_id, category_name in categories]
+
+def start_pipeline(conn, db_lock, metrics, queue_size, crawl_options):
+    """A PagePipeline taking over the write options, or None when queue_size is 0"""
+    if not queue_size:
+        return None
+    return PagePipeline(conn, db_lock, crawl_options.pop('history_mode', 'compact'),
+                        crawl_options.pop('catalog', None), metrics, queue_size)
+
+def finish_pipeline(pipeline, failed_jobs, metrics):
+    """
+    Drain the pipeline and correct the run totals: categories whose pages
+    failed to parse or to be stored after their fetching finished were
+    counted as done. Returns (failed (store_id, category_id) jobs, products
+    written).
+    """
+    pipeline.close()
+    late_failures = pipeline.failed_categories - failed_jobs
+    if late_failures:
+        metrics.inc('categories_done', -len(late_failures))
+        metrics.inc('categories_failed', len(late_failures))
+    return failed_jobs | late_failures, pipeline.products_written
+
+def run_sequential(conn, jobs, throttle, session_max_age=SESSION_MAX_AGE, metrics=None,
+                   queue_size=PIPELINE_QUEUE_SIZE, **crawl_options):
+    """
+    Original one-category-at-a-time crawl, reusing one session. Pages are
+    parsed and written by a PagePipeline unless queue_size is 0. Returns
+    (successful, failed, products written); a category fails if it
+    stopped on an error, whatever it stored before.
+    """
+    metrics = metrics or CrawlMetrics()
+    session_pool = SessionPool(1, throttle, session_max_age, metrics)
+    db_lock = threading.Lock()
+    pipeline = start_pipeline(conn, db_lock, metrics, queue_size, crawl_options)
+    failed_jobs = set()
+    products_processed = 0
+    total_categories = len(jobs)
+
+    for index, (store_id, category_id, category_name) in enumerate(jobs):
+        category_start_time = datetime.now()
+        print(f"\nProcessing category {index + 1}/{total_categories}: "
+              f"{category_id} - {category_name} (store {store_id})")
+
+        try:
+            category_products, ok = crawl_category(conn, category_id, category_name, throttle, db_lock,
+                                                   session_pool=session_pool, store_id=store_id,
+                                                   metrics=metrics, pipeline=pipeline, **crawl_options)
+            products_processed += category_products
+
             category_duration = datetime.now() - category_start_time
-            if category_products > 0:
-                successful += 1
-                print(f"Completed category with {category_products} total products")
+            if ok:
+                metrics.inc('categories_done')
+                print(f"Completed category with {category_products} products")
                 print(f"Total category processing time: {category_duration}")
             else:
-                failed += 1
-                
+                failed_jobs.add((store_id, category_id))
+                metrics.inc('categories_failed')
+
         except Exception as e:
-            failed += 1
+            failed_jobs.add((store_id, category_id))
+            metrics.inc('categories_failed')
+            metrics.inc('category_exceptions')
             print(f"Error processing category: {str(e)}")
-        
-        time.sleep(3)
-    
-    # Print summary
-    end_time = datetime.now()
-    duration = end_time - start_time
-    
-    # Get some statistics from the database
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(DISTINCT product_id) FROM products")
-    total_unique_products = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM price_history")
-    total_price_records = cursor.fetchone()[0]
-    
-    print("\n=== SUMMARY ===")
-    print(f"Total categories processed: {total_categories}")
-    print(f"Successful categories: {successful}")
-    print(f"Failed categories: {failed}")
-    print(f"Total products processed: {products_processed}")
-    print(f"Unique products in database: {total_unique_products}")
-    print(f"Total price history records: {total_price_records}")
-    print(f"Total time taken: {duration}")
-    
-    # Close database connection
-    conn.close()
-    
-except Exception as e:
-    print("Error:", str(e))
-    import traceback
-    print("Full error:", traceback.format_exc())
+
+    session_pool.close()
+    if pipeline is not None:
+        failed_jobs, products_processed = finish_pipeline(pipeline, failed_jobs, metrics)
+    return total_categories - len(failed_jobs), len(failed_jobs), products_processed
+
+def run_concurrent(conn, jobs, workers, throttle, session_max_age=SESSION_MAX_AGE, metrics=None,
+                   queue_size=PIPELINE_QUEUE_SIZE, **crawl_options):
+    """
+    Crawl several (store, category) jobs at once with a pool of worker threads.
+
+    All workers share one AdaptiveThrottle, so its rate is the budget for
+    the whole crawl rather than for each worker, and one session per worker
+    is kept in a SessionPool. Pages go through one PagePipeline, so a
+    single writer thread does all database writes while the workers keep
+    fetching; with queue_size 0 each worker writes its own pages under a
+    lock around the shared connection. Returns the same totals as
+    run_sequential.
+    """
+    metrics = metrics or CrawlMetrics()
+    session_pool = SessionPool(workers, throttle, session_max_age, metrics)
+    db_lock = threading.Lock()
+    pipeline = start_pipeline(conn, db_lock, metrics, queue_size, crawl_options)
+    failed_jobs = set()
+    products_processed = 0
+    total_categories = len(jobs)
+
+    print(f"Crawling {total_categories} store categories with {workers} workers "
+          f"starting at {throttle.rate} requests/sec")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(crawl_category, conn, category_id, category_name,
+                            throttle, db_lock, session_pool=session_pool, store_id=store_id,
+                            metrics=metrics, pipeline=pipeline, **crawl_options): (store_id, category_id, category_name)
+            for store_id, category_id, category_name in jobs
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            store_id, category_id, category_name = futures[future]
+            try:
+                category_products, ok = future.result()
+                products_processed += category_products
+                if ok:
+                    metrics.inc('categories_done')
+                    print(f"Completed category {done}/{total_categories}: {category_id} - "
+                          f"{category_name} (store {store_id}) with {category_products} products")
+                else:
+                    failed_jobs.add((store_id, category_id))
+                    metrics.inc('categories_failed')
+            except Exception as e:
+                failed_jobs.add((store_id, category_id))
+                metrics.inc('categories_failed')
+                metrics.inc('category_exceptions')
+                print(f"Error processing category {category_id} (store {store_id}): {str(e)}")
+
+    session_pool.close()
+    print(f"Sessions created: {session_pool.created}, refreshed: {session_pool.refreshes}")
+    if pipeline is not None:
+        failed_jobs, products_processed = finish_pipeline(pipeline, failed_jobs, metrics)
+    return total_categories - len(failed_jobs), len(failed_jobs), products_processed
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Scrape HEB category prices into SQLite")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of categories crawled at once (1 keeps the original sequential crawl)")
+    parser.add_argument('--rps', type=float, default=0.5,
+                        help="starting requests per second shared by all workers")
+    parser.add_argument('--min-rps', type=float, default=0.05,
+                        help="floor the throttle never cuts the rate below")
+    parser.add_argument('--max-rps', type=float, default=4.0,
+                        help="ceiling the throttle never raises the rate above")
+    parser.add_argument('--max-retries', type=int, default=5,
+                        help="retries of a throttled (429/5xx) page before its category fails")
+    parser.add_argument('--burst', type=float, default=None,
+                        help="token bucket capacity (defaults to the rps budget)")
+    parser.add_argument('--db', default='heb_products.db', help="SQLite database path")
+    parser.add_argument('--categories', default='categoryid.xlsx',
+                        help="category spreadsheet, copied into the categories table when it changes")
+    parser.add_argument('--stores', default=str(DEFAULT_STORE_ID),
+                        help="comma-separated HEB store ids to crawl, all under one rate budget")
+    parser.add_argument('--history-mode', choices=['compact', 'full'], default='compact',
+                        help="'compact' only writes a price row when the price changes, "
+                             "'full' writes one row per product per crawl")
+    parser.add_argument('--compact-history', action='store_true',
+                        help="merge unchanged price runs in the existing history and exit")
+    parser.add_argument('--rebuild-price-changes', action='store_true',
+                        help="recompute the price_changes event table from price_history and exit")
+    parser.add_argument('--events-jsonl', metavar='PATH', default=None,
+                        help="also append each price_change event to PATH as a JSON line")
+    parser.add_argument('--migrate-v2', action='store_true',
+                        help="move price_history to the compact v2 layout (integer keys, cents, "
+                             "epoch seconds) behind a read view and exit")
+    parser.add_argument('--session-max-age', type=float, default=SESSION_MAX_AGE,
+                        help="seconds a pooled session is reused before its cookies are refreshed")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue the latest unfinished run, skipping finished categories")
+    parser.add_argument('--rebuild-summary', action='store_true',
+                        help="recompute product_price_summary from price_history and exit")
+    parser.add_argument('--rebuild-rollups', action='store_true',
+                        help="recompute the daily/monthly rollups from scratch and exit")
+    parser.add_argument('--check-rollups', action='store_true',
+                        help="compare the rollups with a full rebuild (on a scratch copy) and exit")
+    parser.add_argument('--queue-size', type=int, default=PIPELINE_QUEUE_SIZE,
+                        help="pages buffered between fetching, parsing and writing "
+                             "(0 parses and writes inline, as before)")
+    parser.add_argument('--archive', metavar='DIR', default=None,
+                        help="keep every raw GraphQL page in DIR for response_archive.py replay")
+    parser.add_argument('--discover', action='store_true',
+                        help="walk the category tree below the sheet's categories and crawl "
+                             "subcategories of categories too big for MAX_PAGES")
+    parser.add_argument('--discover-only', action='store_true',
+                        help="refresh the category tree, print the crawl plan and exit")
+    parser.add_argument('--discover-max-age', type=float, default=DISCOVERY_MAX_AGE,
+                        help="seconds before a discovered category is fetched again")
+    parser.add_argument('--metrics-json', default='crawl_metrics.json',
+                        help="write stage timings and counters here at the end of the run ('' to skip)")
+    parser.add_argument('--metrics-prom', default='crawl_metrics.prom',
+                        help="write the same metrics in Prometheus text format ('' to skip)")
+    parser.add_argument('--progress', action='store_true',
+                        help="keep a live progress line on stderr")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        start_time = datetime.now()
+
+        # Initialize database
+        # The pipeline's writer thread uses the connection too
+        conn = create_database(args.db, check_same_thread=args.workers <= 1 and not args.queue_size)
+        if conn is None:
+            raise Exception("Failed to create database connection")
+
+        if args.migrate_v2:
+            if price_history_version(conn) == 2:
+                print("Price history is already in the v2 layout")
+            else:
+                before, after, bytes_before, bytes_after = migrate_price_history_v2(conn)
+                print(f"Migrated {before} price intervals to price_history_v2 ({after} rows); "
+                      f"database {bytes_before / 1e6:.1f} MB -> {bytes_after / 1e6:.1f} MB")
+            conn.close()
+            return
+
+        if args.compact_history:
+            if price_history_version(conn) == 2:
+                print("Price history is in the v2 layout; compact it before migrating")
+                conn.close()
+                return
+            before, after = compress_price_history(conn)
+            print(f"Compressed price history from {before} to {after} rows")
+            refresh_rollups(conn, full=True)
+            conn.close()
+            return
+
+        if args.rebuild_price_changes:
+            events = rebuild_price_changes(conn)
+            print(f"Rebuilt {events} price_change events from price history")
+            conn.close()
+            return
+
+        if args.rebuild_summary:
+            summarized = rebuild_price_summary(conn)
+            print(f"Rebuilt price summary for {summarized} products")
+            conn.close()
+            return
+
+        if args.rebuild_rollups:
+            first_day = refresh_rollups(conn, full=True)
+            print(f"Rebuilt price rollups from {first_day}")
+            conn.close()
+            return
+
+        if args.check_rollups:
+            differences = check_rollups(conn)
+            for table, rows in differences.items():
+                print(f"{table}: {'OK' if rows == 0 else f'{rows} rows differ from a rebuild'}")
+            conn.close()
+            return
+
+        # Read Excel
+        categories = load_categories(conn, args.categories)
+        print(f"Test 3: Loaded {len(categories)} categories")
+
+        stores = [int(store_id) for store_id in args.stores.split(',') if store_id.strip()]
+
+        throttle = AdaptiveThrottle(args.rps, min_rate=args.min_rps, max_rate=args.max_rps,
+                                    burst=args.burst, max_retries=args.max_retries)
+        metrics = CrawlMetrics()
+
+        if args.discover or args.discover_only:
+            # The tree is assumed to be the same in every store, so it is walked in the first one
+            discovery_pool = SessionPool(1, throttle, args.session_max_age, metrics)
+            fetched, cached = discover_categories(conn, categories, throttle, discovery_pool,
+                                                  stores[0], args.discover_max_age, metrics)
+            discovery_pool.close()
+            planned = plan_categories(conn, categories)
+            print(f"Category discovery: {fetched} fetched, {cached} cached; "
+                  f"crawling {len(planned)} categories for {len(categories)} in the sheet")
+            if args.discover_only:
+                for category_id, name in planned:
+                    print(f"  {category_id}\t{name}")
+                conn.close()
+                return
+            categories = planned
+        jobs = build_jobs(stores, categories)
+        total_categories = len(jobs)
+
+        run_id, resumed = start_crawl_run(conn, args.resume)
+        print(f"{'Resuming' if resumed else 'Starting'} crawl run {run_id} "
+              f"over {len(stores)} store(s)")
+        register_categories(conn, run_id, jobs)
+
+        event_stream = open(args.events_jsonl, 'a') if args.events_jsonl else None
+        with metrics.timer('catalog_load'):
+            catalog = ProductCatalog.load(conn, run_id, event_stream)
+        print(f"Loaded catalog cache: {len(catalog.metadata_hashes)} products, "
+              f"{len(catalog.last_prices)} store prices")
+
+        archive = ResponseArchive(args.archive) if args.archive else None
+
+        progress = ProgressLine(metrics, total_categories, throttle).start() if args.progress else None
+
+        try:
+            if args.workers > 1:
+                successful, failed, products_processed = run_concurrent(
+                    conn, jobs, args.workers, throttle,
+                    session_max_age=args.session_max_age, metrics=metrics,
+                    history_mode=args.history_mode, run_id=run_id, catalog=catalog, archive=archive,
+                    queue_size=args.queue_size)
+            else:
+                successful, failed, products_processed = run_sequential(
+                    conn, jobs, throttle, session_max_age=args.session_max_age, metrics=metrics,
+                    history_mode=args.history_mode, run_id=run_id, catalog=catalog, archive=archive,
+                    queue_size=args.queue_size)
+        finally:
+            if progress is not None:
+                progress.stop()
+            if event_stream is not None:
+                event_stream.close()
+            if archive is not None:
+                archive.close()
+                print(f"Archived {archive.pages} pages ({archive.bytes_written / 1e6:.1f} MB) "
+                      f"to {args.archive}")
+
+        run_status = finish_crawl_run(conn, run_id)
+        with metrics.timer('rollup_refresh'):
+            refreshed_from = refresh_rollups(conn)
+        if refreshed_from is not None:
+            print(f"Refreshed price rollups from {refreshed_from}")
+
+        # Print summary
+        end_time = datetime.now()
+        duration = end_time - start_time
+
+        # Get some statistics from the database
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(DISTINCT product_id) FROM products")
+        total_unique_products = cursor.fetchone()[0]
+
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(observations), 0) FROM price_history")
+        total_price_records, total_observations = cursor.fetchone()
+
+        print("\n=== SUMMARY ===")
+        print(f"Total categories processed: {total_categories}")
+        print(f"Successful categories: {successful}")
+        print(f"Failed categories: {failed}")
+        print(f"Products written this run: {products_processed}")
+        print(f"Unique products in database: {total_unique_products}")
+        print(f"Total price history records: {total_price_records} ({total_observations} observations)")
+        print(f"Catalog: {catalog.inserted} new, {catalog.updated} changed, "
+              f"{catalog.unchanged} unchanged products")
+        print(f"Price changes: {catalog.price_changes}")
+        print(f"Total time taken: {duration}")
+        print(f"Crawl run {run_id}: {run_status}")
+        print(f"Throttle: {throttle.successes} ok, {throttle.throttled} throttled, "
+              f"final rate {throttle.rate:.2f} req/s, "
+              f"latency {(throttle.latency_ewma or 0) * 1000:.0f}ms (ewma)")
+
+        metrics.set_gauge('run_id', run_id)
+        metrics.set_gauge('throttle_rate', throttle.rate)
+        metrics.set_gauge('throttle_latency_ewma_seconds', throttle.latency_ewma or 0)
+        metrics.set_gauge('price_history_rows', total_price_records)
+        metrics.set_gauge('catalog_inserted', catalog.inserted)
+        metrics.set_gauge('catalog_updated', catalog.updated)
+        metrics.set_gauge('catalog_unchanged', catalog.unchanged)
+        metrics.set_gauge('price_changes', catalog.price_changes)
+        print("\n=== STAGE TIMINGS ===")
+        print(metrics.format_summary())
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json)
+            print(f"Metrics written to {args.metrics_json}")
+        if args.metrics_prom:
+            metrics.write_prometheus(args.metrics_prom)
+            print(f"Prometheus metrics written to {args.metrics_prom}")
+
+        # Close database connection
+        conn.close()
+
+    except Exception as e:
+        print("Error:", str(e))
+        import traceback
+        print("Full error:", traceback.format_exc())
+
+if __name__ == "__main__":
+    main()
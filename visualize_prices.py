@@ -1,14 +1,69 @@
 #!/usr/bin/env python3
+import argparse
+import json
+import shutil
 import sqlite3
 import sys
+from datetime import datetime
 
-def create_ascii_chart(data, width=50):
-    """Create a simple ASCII chart from price data"""
-    if not data:
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+def merge_price_runs(data):
+    """
+    Collapse consecutive rows with the same price into runs of
+    (first_date, last_date, price), reading data in a single pass.
+    """
+    runs = []
+    for date, price in data:
+        price = float(price)
+        date = date[:10]
+        if runs and runs[-1][2] == price:
+            runs[-1][1] = date
+        else:
+            runs.append([date, date, price])
+    return runs
+
+def downsample_runs(runs, max_lines):
+    """
+    Min/max bucketing: split the runs into max_lines // 2 buckets and keep
+    each bucket's lowest and highest run, in date order. Every bucket keeps
+    its extremes, so a price jump always survives as a change between lines.
+    The first and last runs are always kept.
+    """
+    if len(runs) <= max_lines:
+        return runs
+    num_buckets = max(1, (max_lines - 2) // 2)
+    bucket_size = len(runs) / num_buckets
+    kept = []
+    for b in range(num_buckets):
+        bucket = runs[int(b * bucket_size):int((b + 1) * bucket_size)]
+        if not bucket:
+            continue
+        low = min(range(len(bucket)), key=lambda i: bucket[i][2])
+        high = max(range(len(bucket)), key=lambda i: bucket[i][2])
+        for i in sorted({low, high}):
+            kept.append(bucket[i])
+    if kept[0] is not runs[0]:
+        kept.insert(0, runs[0])
+    if kept[-1] is not runs[-1]:
+        kept.append(runs[-1])
+    return kept
+
+def create_ascii_chart(data, width=50, height=None):
+    """
+    Create a simple ASCII chart from price data
+
+    Unchanged prices are merged into one line per date range. With height,
+    long histories are downsampled to at most that many lines.
+    """
+    runs = merge_price_runs(data)
+    if not runs:
         return "No data available"
+    if height is not None:
+        runs = downsample_runs(runs, height)
     
     # Find min and max prices for scaling
-    prices = [float(price) for _, price in data]
+    prices = [price for _, _, price in runs]
     max_price = max(prices)
     min_price = min(prices)
     price_range = max_price - min_price
@@ -19,8 +74,7 @@ def create_ascii_chart(data, width=50):
     
     # Create chart
     previous_price = None
-    for date, price in data:
-        price_float = float(price)
+    for first_date, last_date, price_float in runs:
         # Calculate bar length
         if price_range == 0:
             bar_length = width // 2
@@ -29,7 +83,7 @@ def create_ascii_chart(data, width=50):
         
         # Format the line with price aligned and show price change
         price_str = f"${price_float:6.2f}"
-        date_str = f"{date[:10]}"
+        date_str = first_date if first_date == last_date else f"{first_date}..{last_date}"
         
         # Add price change indicator
         if previous_price is not None:
@@ -39,174 +93,327 @@ def create_ascii_chart(data, width=50):
                 price_str += change_str
         
         bar = "█" * bar_length
-        output.append(f"{date_str} {price_str} |{bar}")
+        output.append(f"{date_str:<22} {price_str} |{bar}")
         previous_price = price_float
     
     output.append("-" * width)
     return "\n".join(output)
 
-def main():
-    # Connect to database
-    conn = sqlite3.connect('heb_products.db')
-    cursor = conn.cursor()
-    
-    # Get first and last prices for each product to properly detect increases and decreases
-    price_variations_query = """
-        WITH first_prices AS (
-            SELECT ph1.product_id, ph1.price, ph1.recorded_at
-            FROM price_history ph1
-            WHERE ph1.recorded_at = (
-                SELECT MIN(recorded_at) 
-                FROM price_history ph2 
-                WHERE ph2.product_id = ph1.product_id
-            )
-        ),
-        last_prices AS (
-            SELECT ph1.product_id, ph1.price, ph1.recorded_at
-            FROM price_history ph1
-            WHERE ph1.recorded_at = (
-                SELECT MAX(recorded_at) 
-                FROM price_history ph2 
-                WHERE ph2.product_id = ph1.product_id
-            )
-        ),
-        price_variations AS (
-            SELECT 
-                p.product_id,
-                p.product_name,
-                p.category_name,
-                COUNT(DISTINCT ph.price) as unique_prices,
-                MIN(ph.price) as min_price,
-                MAX(ph.price) as max_price,
-                date(fp.recorded_at) as first_price_date,
-                date(lp.recorded_at) as last_price_date,
-                fp.price as first_price,
-                lp.price as last_price,
-                COUNT(ph.id) as price_records,
-                (lp.price - fp.price) as price_difference
-            FROM products p 
-            JOIN price_history ph ON p.product_id = ph.product_id
-            JOIN first_prices fp ON p.product_id = fp.product_id
-            JOIN last_prices lp ON p.product_id = lp.product_id
-            GROUP BY p.product_id, p.product_name, p.category_name
-            HAVING COUNT(ph.id) > 1
-        )
+def create_sparkline(data, width=40):
     """
-    
-    # Get top 15 price increases
-    print("\n=== TOP 15 PRICE INCREASES ===")
-    cursor.execute(price_variations_query + """
+    One-line chart of a price history, `width` characters wide. Each
+    character is one slice of the date range; when the price moved within
+    a slice it shows the price furthest from the previous character, so a
+    short spike or dip still shows.
+    """
+    runs = merge_price_runs(data)
+    if not runs:
+        return ""
+    starts = [datetime.strptime(first_date, '%Y-%m-%d').toordinal() for first_date, _, _ in runs]
+    start = starts[0]
+    span = max(datetime.strptime(runs[-1][1], '%Y-%m-%d').toordinal() - start, 1)
+    prices = [price for _, _, price in runs]
+    min_price, max_price = min(prices), max(prices)
+    price_range = max_price - min_price
+
+    chars = []
+    previous = prices[0]
+    run_idx = 0
+    for i in range(width):
+        slice_end = start + span * (i + 1) / width
+        # The run in force at the start of the slice plus every run that starts in it
+        in_slice = [prices[run_idx]]
+        while run_idx + 1 < len(runs) and starts[run_idx + 1] <= slice_end:
+            run_idx += 1
+            in_slice.append(prices[run_idx])
+        price = max(in_slice, key=lambda p: abs(p - previous))
+        level = 0 if price_range == 0 else round((price - min_price) / price_range * (len(SPARK_CHARS) - 1))
+        chars.append(SPARK_CHARS[level])
+        previous = in_slice[-1]
+    return "".join(chars)
+
+# First and last prices for each product come from the summary table the
+# scraper maintains, so increases and decreases need no history scan. Both
+# top-N lists are ranked in the same pass over the variations.
+TOP_MOVERS_QUERY = """
+    WITH price_variations AS (
         SELECT 
-            product_id,
-            product_name,
-            category_name,
-            unique_prices,
-            min_price,
-            max_price,
-            first_price_date,
-            last_price_date,
-            first_price,
-            last_price,
-            price_records,
-            price_difference
-        FROM price_variations
-        WHERE price_difference > 0
-        ORDER BY price_difference DESC
-        LIMIT 15
-    """)
-    
-    increases = cursor.fetchall()
-    
-    # Get top 15 price decreases
-    print("\n=== TOP 15 PRICE DECREASES ===")
-    cursor.execute(price_variations_query + """
+            p.product_id,
+            p.product_name,
+            p.category_name,
+            s.distinct_prices as unique_prices,
+            s.min_price,
+            s.max_price,
+            date(s.first_seen) as first_price_date,
+            date(s.last_seen) as last_price_date,
+            s.first_price,
+            s.last_price,
+            s.record_count as price_records,
+            (s.last_price - s.first_price) as price_difference,
+            s.store_id
+        FROM products p 
+        JOIN product_price_summary s ON p.product_id = s.product_id
+        WHERE s.record_count > 1
+          AND s.last_price != s.first_price
+          AND (:store_id IS NULL OR s.store_id = :store_id)
+    ),
+    ranked AS (
         SELECT 
-            product_id,
-            product_name,
-            category_name,
-            unique_prices,
-            min_price,
-            max_price,
-            first_price_date,
-            last_price_date,
-            first_price,
-            last_price,
-            price_records,
-            price_difference
+            *,
+            ROW_NUMBER() OVER (
+                PARTITION BY price_difference > 0
+                ORDER BY ABS(price_difference) DESC
+            ) as move_rank
         FROM price_variations
-        WHERE price_difference < 0
-        ORDER BY price_difference ASC
-        LIMIT 15
-    """)
-    
-    decreases = cursor.fetchall()
-    
-    # Combine and display results
-    all_products = increases + decreases
-    
-    if not all_products:
-        print("No products with price changes found.")
-        return
-    
-    print("\n=== TOP 15 PRICE INCREASES ===")
-    for i, product in enumerate(increases, 1):
-        (pid, name, category, unique_prices, min_price, max_price, 
-         first_date, last_date, first_price, last_price, records, diff) = product
-        print(f"{i}. {name} ({category})")
-        print(f"   Price range: ${first_price:.2f} ({first_date}) → ${last_price:.2f} ({last_date})")
-        print(f"   Increase: ${diff:.2f} (+{(diff/first_price*100):.1f}%)")
-        print(f"   Number of unique prices: {unique_prices}")
-        print(f"   Total price records: {records}")
-        print()
-    
-    print("\n=== TOP 15 PRICE DECREASES ===")
-    for i, product in enumerate(decreases, 1):
+    )
+    SELECT 
+        product_id,
+        product_name,
+        category_name,
+        unique_prices,
+        min_price,
+        max_price,
+        first_price_date,
+        last_price_date,
+        first_price,
+        last_price,
+        price_records,
+        price_difference,
+        store_id
+    FROM ranked
+    WHERE move_rank <= :top
+    ORDER BY price_difference > 0 DESC, move_rank
+"""
+
+MOVER_FIELDS = ('product_id', 'product_name', 'category_name', 'unique_prices',
+                'min_price', 'max_price', 'first_price_date', 'last_price_date',
+                'first_price', 'last_price', 'price_records', 'price_difference',
+                'store_id')
+
+def get_top_movers(cursor, top=15, store_id=None):
+    """Top price increases and decreases, as two lists of rows, from one query"""
+    cursor.execute(TOP_MOVERS_QUERY, {'top': top, 'store_id': store_id})
+    rows = cursor.fetchall()
+    increases = [row for row in rows if row[11] > 0]
+    decreases = [row for row in rows if row[11] < 0]
+    return increases, decreases
+
+def get_price_histories(cursor, product_ids, store_id=None):
+    """
+    Price history for several products in one query, as
+    {(product_id, store_id): (product_name, [(date, price), ...])}.
+    A compacted interval is drawn at both the first and the last time its
+    price was seen.
+    """
+    if not product_ids:
+        return {}
+    product_ids = list(dict.fromkeys(product_ids))
+    placeholders = ', '.join('?' * len(product_ids))
+    cursor.execute(f"""
+        SELECT h.product_id, h.store_id, p.product_name, date(h.seen_at), h.price
+        FROM (
+            SELECT product_id, store_id, recorded_at AS seen_at, price, id
+            FROM price_history
+            WHERE product_id IN ({placeholders})
+            UNION ALL
+            SELECT product_id, store_id, last_seen AS seen_at, price, id
+            FROM price_history
+            WHERE product_id IN ({placeholders}) AND observations > 1
+        ) h
+        LEFT JOIN products p ON p.product_id = h.product_id
+        WHERE ? IS NULL OR h.store_id = ?
+        ORDER BY h.product_id, h.store_id, h.seen_at, h.id
+    """, product_ids + product_ids + [store_id, store_id])
+
+    histories = {}
+    for product_id, row_store_id, name, date, price in cursor.fetchall():
+        histories.setdefault((product_id, row_store_id), (name, []))[1].append((date, price))
+    # Keep the order the products were asked for
+    order = {product_id: i for i, product_id in enumerate(product_ids)}
+    return dict(sorted(histories.items(), key=lambda item: (order[item[0][0]], item[0][1])))
+
+# price_change events recorded by the scraper at ingest (scrape2.py), so
+# "what moved since" reads the change set instead of the whole history
+CHANGES_QUERY = """
+    SELECT
+        c.product_id,
+        p.product_name,
+        c.category_name,
+        c.store_id,
+        c.old_price,
+        c.new_price,
+        c.delta,
+        c.percent_change,
+        c.changed_at,
+        c.run_id
+    FROM price_changes c
+    LEFT JOIN products p ON p.product_id = c.product_id
+    WHERE c.changed_at >= :since
+      AND (:store_id IS NULL OR c.store_id = :store_id)
+    ORDER BY ABS(c.percent_change) DESC, c.changed_at
+    LIMIT :limit
+"""
+
+CHANGE_FIELDS = ('product_id', 'product_name', 'category_name', 'store_id', 'old_price',
+                 'new_price', 'delta', 'percent_change', 'changed_at', 'run_id')
+
+def get_price_changes(cursor, since, store_id=None, limit=50):
+    """Price changes recorded since `since` (a date or timestamp), biggest moves first"""
+    cursor.execute(CHANGES_QUERY, {'since': since, 'store_id': store_id, 'limit': limit})
+    return cursor.fetchall()
+
+def format_changes(since, changes):
+    lines = [f"\n=== PRICE CHANGES SINCE {since} ==="]
+    for i, (pid, name, category, store_id, old_price, new_price, delta,
+            percent, changed_at, run_id) in enumerate(changes, 1):
+        sign = '+' if delta > 0 else ''
+        lines.append(f"{i}. {name or pid} ({category}, store {store_id})")
+        change = f" ({sign}{percent:.1f}%)" if percent is not None else ""
+        lines.append(f"   ${old_price:.2f} → ${new_price:.2f}: {sign}{delta:.2f}{change} at {changed_at}")
+    return "\n".join(lines)
+
+def format_movers(title, movers, verb):
+    lines = [f"\n=== {title} ==="]
+    for i, product in enumerate(movers, 1):
         (pid, name, category, unique_prices, min_price, max_price, 
-         first_date, last_date, first_price, last_price, records, diff) = product
-        print(f"{i}. {name} ({category})")
-        print(f"   Price range: ${first_price:.2f} ({first_date}) → ${last_price:.2f} ({last_date})")
-        print(f"   Decrease: ${diff:.2f} ({(diff/first_price*100):.1f}%)")
-        print(f"   Number of unique prices: {unique_prices}")
-        print(f"   Total price records: {records}")
-        print()
-    
-    # Get user input
+         first_date, last_date, first_price, last_price, records, diff, store_id) = product
+        sign = '+' if diff > 0 else ''
+        lines.append(f"{i}. {name} ({category})")
+        lines.append(f"   Price range: ${first_price:.2f} ({first_date}) → ${last_price:.2f} ({last_date})")
+        lines.append(f"   {verb}: ${diff:.2f} ({sign}{(diff/first_price*100):.1f}%)")
+        lines.append(f"   Number of unique prices: {unique_prices}")
+        lines.append(f"   Total price records: {records}")
+        lines.append("")
+    return "\n".join(lines)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Top price movers and price history charts. Without --chart, "
+                    "--product or --format json it asks which product to chart.")
+    parser.add_argument('--db', default='heb_products.db', help="SQLite database path")
+    parser.add_argument('--top', type=int, default=15, help="size of each top-movers list")
+    parser.add_argument('--store', type=int, default=None, help="only this store id")
+    parser.add_argument('--chart', choices=['none', 'increases', 'decreases', 'both'], default=None,
+                        help="chart every product in these top-movers lists")
+    parser.add_argument('--product', action='append', default=[], metavar='PRODUCT_ID',
+                        help="chart this product (repeatable)")
+    parser.add_argument('--format', choices=['text', 'json'], default='text')
+    parser.add_argument('--height', type=int, default=None,
+                        help="maximum lines per chart (default: fit the terminal)")
+    parser.add_argument('--sparkline', action='store_true',
+                        help="draw each chart as a single line")
+    parser.add_argument('--since', metavar='DATE', default=None,
+                        help="list the --top biggest price changes recorded since DATE "
+                             "(YYYY-MM-DD) instead of the top movers")
+    return parser.parse_args(argv)
+
+def choose_interactively(increases, decreases):
+    """Ask which top mover to chart; returns [product_id, store_id] or None"""
     try:
         section = input("\nWhich section would you like to visualize? (I for Increases, D for Decreases): ").upper()
         if section not in ['I', 'D']:
             print("Invalid choice")
-            return
+            return None
             
         products = increases if section == 'I' else decreases
         if not products:
             print(f"No products found in the {'increases' if section == 'I' else 'decreases'} section.")
-            return
+            return None
             
         choice = int(input(f"Enter the number of the product to visualize (1-{len(products)}): "))
         if not 1 <= choice <= len(products):
             print("Invalid choice")
-            return
+            return None
     except ValueError:
         print("Please enter a valid number")
+        return None
+    return products[choice-1][0], products[choice-1][12]
+
+def main(argv=None):
+    args = parse_args(argv)
+    interactive = (args.chart is None and not args.product and args.since is None
+                   and args.format == 'text' and sys.stdin.isatty())
+
+    # Connect to database
+    conn = sqlite3.connect(args.db)
+    cursor = conn.cursor()
+
+    if args.since is not None:
+        try:
+            changes = get_price_changes(cursor, args.since, args.store, args.top)
+        except sqlite3.OperationalError:
+            print("No price_changes table; run a crawl or scrape2.py --rebuild-price-changes")
+            conn.close()
+            return
+        if args.format == 'json':
+            print(json.dumps([dict(zip(CHANGE_FIELDS, row)) for row in changes], indent=2))
+        elif changes:
+            print(format_changes(args.since, changes))
+        else:
+            print(f"No price changes since {args.since}.")
+        conn.close()
         return
     
-    product_id = products[choice-1][0]
-    
-    # Get price history for selected product
-    cursor.execute("""
-        SELECT date(recorded_at), price 
-        FROM price_history 
-        WHERE product_id = ? 
-        ORDER BY recorded_at
-    """, (product_id,))
-    
-    data = cursor.fetchall()
+    increases, decreases = get_top_movers(cursor, args.top, args.store)
+
+    # Work out which (product, store) price histories to chart
+    chart_keys = []
+    if args.chart in ('increases', 'both'):
+        chart_keys += [(row[0], row[12]) for row in increases]
+    if args.chart in ('decreases', 'both'):
+        chart_keys += [(row[0], row[12]) for row in decreases]
+    chart_products = [product_id for product_id, _ in chart_keys] + args.product
+    histories = get_price_histories(cursor, chart_products, args.store)
+    # Top movers are charted for their own store, --product for every store
+    wanted = set(chart_keys)
+    histories = {key: value for key, value in histories.items()
+                 if key in wanted or key[0] in args.product}
+
+    if args.format == 'json':
+        print(json.dumps({
+            'increases': [dict(zip(MOVER_FIELDS, row)) for row in increases],
+            'decreases': [dict(zip(MOVER_FIELDS, row)) for row in decreases],
+            'charts': [
+                {'product_id': product_id, 'store_id': store_id, 'product_name': name,
+                 'history': [[date, float(price)] for date, price in data]}
+                for (product_id, store_id), (name, data) in histories.items()
+            ],
+        }, indent=2))
+        conn.close()
+        return
+
+    if not increases and not decreases and not histories:
+        print("No products with price changes found.")
+        conn.close()
+        return
     
-    # Print product info
-    print(f"\nPrice history for: {products[choice-1][1]}")
-    print(create_ascii_chart(data))
+    print(format_movers(f"TOP {args.top} PRICE INCREASES", increases, "Increase"))
+    print(format_movers(f"TOP {args.top} PRICE DECREASES", decreases, "Decrease"))
+
+    if interactive:
+        choice = choose_interactively(increases, decreases)
+        if choice is None:
+            conn.close()
+            return
+        histories = get_price_histories(cursor, [choice[0]], choice[1])
+
+    # Charts are sized to the screen, whatever the length of the history
+    columns, lines = shutil.get_terminal_size()
+    height = args.height or max(lines - 6, 10)
+    if args.sparkline and histories:
+        print()
+        label_width = min(max(len(f"{name} ({store_id})") for (_, store_id), (name, _) in histories.items()), 40)
+        spark_width = max(columns - label_width - 24, 10)
+    for (product_id, store_id), (name, data) in histories.items():
+        if args.sparkline:
+            label = f"{name} ({store_id})"[:label_width]
+            print(f"{label:<{label_width}} {create_sparkline(data, spark_width)} "
+                  f"${float(data[0][1]):.2f} → ${float(data[-1][1]):.2f}")
+            continue
+        print(f"\nPrice history for: {name} (store {store_id})")
+        print(create_ascii_chart(data, height=height))
     
     conn.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()